@@ -22,13 +22,21 @@
 WeeWX driver for WeatherLink Live and AirLink
 """
 import logging
-import threading
+import time
+from typing import Optional, Dict, Callable, Tuple, Hashable
 
 import weewx.units
 from schemas import wview_extended
-from user.weatherlink_live import davis_http, data_host, scheduler
-from user.weatherlink_live.configuration import create_configuration
-from user.weatherlink_live.service import WllWindGustService
+from user.weatherlink_live import davis_http, data_host, scheduler, json_decoder, capture, metrics
+from user.weatherlink_live.async_engine import AsyncEngine
+from user.weatherlink_live.configuration import create_configuration, HostConfiguration
+from user.weatherlink_live.exporter import MetricsExporter
+from user.weatherlink_live.mappers import RainMapping
+from user.weatherlink_live.merger import RecordMerger
+from user.weatherlink_live.static import PacketSource
+from user.weatherlink_live.service import WllWindGustService, WllNowCastService
+from user.weatherlink_live.state import StateStore
+from user.weatherlink_live.static.config import ENGINE_THREADED, ENGINE_ASYNCIO
 from weewx import WeeWxIOError
 from weewx.drivers import AbstractDevice
 from weewx.engine import InitializationError
@@ -67,18 +75,36 @@ _temperature_fields = ["dewpoint2",
 _rain_count_fields = ['rainCount']  # unit: count
 _rain_count_rate_fields = ['rainCountRate']  # unit: count per hour
 _rain_amount_fields = ['rainSize']  # unit: technically rain amount (inch/mm)
+_rain_rate_fields = ['rainRate1', 'rainRate10', 'rainRate15']
+_wind_speed_fields = ['windSpeedAvg', 'windSpeedMin', 'windSpeedMax']
+_wind_dir_fields = ['windDirAvg']
+_concentration_fields = ['pm1_0_last', 'pm2_5_last', 'pm10_0_last',
+                         'pm2_5_1hour', 'pm2_5_3hour', 'pm2_5_24hour', 'pm2_5_nowcast',
+                         'pm10_0_1hour', 'pm10_0_3hour', 'pm10_0_24hour', 'pm10_0_nowcast',
+                         'nowcast_pm2_5', 'nowcast_pm10']
+_aqi_fields = ['pm2_5_aqi', 'pm10_0_aqi', 'aqi']
 
 schema = {
     'table': wview_extended.table
              + [(field, "REAL") for field in _temperature_fields]
              + [(field, "REAL") for field in _rain_count_fields]
              + [(field, "REAL") for field in _rain_count_rate_fields]
-             + [(field, "REAL") for field in _rain_amount_fields],
+             + [(field, "REAL") for field in _rain_amount_fields]
+             + [(field, "REAL") for field in _rain_rate_fields]
+             + [(field, "REAL") for field in _wind_speed_fields]
+             + [(field, "REAL") for field in _wind_dir_fields]
+             + [(field, "REAL") for field in _concentration_fields]
+             + [(field, "REAL") for field in _aqi_fields],
     'day_summaries': wview_extended.day_summaries
                      + [(field, "SCALAR") for field in _temperature_fields]
                      + [(field, "SCALAR") for field in _rain_count_fields]
                      + [(field, "SCALAR") for field in _rain_count_rate_fields]
                      + [(field, "SCALAR") for field in _rain_amount_fields]
+                     + [(field, "SCALAR") for field in _rain_rate_fields]
+                     + [(field, "SCALAR") for field in _wind_speed_fields]
+                     + [(field, "SCALAR") for field in _wind_dir_fields]
+                     + [(field, "SCALAR") for field in _concentration_fields]
+                     + [(field, "SCALAR") for field in _aqi_fields]
 }
 
 # Define units of new observation
@@ -86,6 +112,11 @@ weewx.units.obs_group_dict.update(dict([(observation, "group_temperature") for o
 weewx.units.obs_group_dict.update(dict([(observation, "group_count") for observation in _rain_count_fields]))
 weewx.units.obs_group_dict.update(dict([(observation, "group_rate") for observation in _rain_count_rate_fields]))
 weewx.units.obs_group_dict.update(dict([(observation, "group_rain") for observation in _rain_amount_fields]))
+weewx.units.obs_group_dict.update(dict([(observation, "group_rainrate") for observation in _rain_rate_fields]))
+weewx.units.obs_group_dict.update(dict([(observation, "group_speed") for observation in _wind_speed_fields]))
+weewx.units.obs_group_dict.update(dict([(observation, "group_direction") for observation in _wind_dir_fields]))
+weewx.units.obs_group_dict.update(dict([(observation, "group_concentration") for observation in _concentration_fields]))
+weewx.units.obs_group_dict.update(dict([(observation, "group_count") for observation in _aqi_fields]))
 
 # Define unit group 'group_rate'
 weewx.units.USUnits['group_rate'] = 'per_hour'
@@ -113,21 +144,52 @@ class WeatherlinkLiveDriver(AbstractDevice):
         """Initialize driver"""
 
         self.run = True
-        log.info("Initializing driver: %s v%s" % (DRIVER_NAME, DRIVER_VERSION))
+        log.info("Initializing driver: %s v%s", DRIVER_NAME, DRIVER_VERSION)
 
         self.configuration = create_configuration(conf_dict, DRIVER_NAME)
-        log.debug("Configuration: %s" % (repr(self.configuration)))
-
-        self.mappers = self.configuration.create_mappers()
+        log.debug("Configuration: %r", self.configuration)
+
+        # Metrics have to be enabled before creating any instrumented objects
+        if self.configuration.metrics or self.configuration.metrics_port > 0:
+            metrics.enable()
+
+        self.host_mappers = self.configuration.create_host_mappers()
+        self.mappers = [mapper for mappers in self.host_mappers.values() for mapper in mappers]
+        self.mapping_plans = dict([
+            (name, self.configuration.create_mapping_plan(mappers, name))
+            for name, mappers in self.host_mappers.items()
+        ])
+        log.debug("Mapping plans: %r", self.mapping_plans)
         self.wind_service = WllWindGustService(engine, conf_dict, self.mappers, self.configuration.log_success,
-                                               self.configuration.log_error)
+                                               self.configuration.log_error, self.configuration.gust_window)
+        self.nowcast_service = WllNowCastService(engine, conf_dict, self.mappers, self.configuration.log_success,
+                                                 self.configuration.log_error)
 
         self.is_running = False
-        self.scheduler = None
+        self.schedulers = []
         self.no_data_count = 0
-        self.data_event = None
-        self.poll_host = None
-        self.push_host = None
+        self.packets = None
+        self.poll_hosts = []
+        self.push_hosts = []
+        self.async_engine = None
+        # Rain amounts since the last record are added up when records are merged
+        self.rain_fields = [mapper.targets[key] for mapper in self.mappers if isinstance(mapper, RainMapping)
+                            for key in ('amount', 'count')]
+        self.merger = None
+        if self.configuration.merge_window > 0:
+            self.merger = RecordMerger(self.configuration.merge_window, self.rain_fields)
+        if self.merger is not None:
+            metrics.callback(metrics.RECORDS_MERGED, lambda: self.merger.merged_count, metrics.KIND_COUNTER)
+
+        self._metrics_log_time = time.monotonic()
+        self._metrics_loop_time = time.monotonic()
+        self.state_store = None
+        if self.configuration.state_file:
+            self.state_store = StateStore(self.configuration.state_file, self.configuration.state_max_age)
+        self._state_save_time = time.monotonic() + self.configuration.state_save_interval
+        self.exporter: Optional[MetricsExporter] = None
+        self._errors = metrics.counter(metrics.DRIVER_ERRORS)
+        metrics.callback(metrics.NO_DATA_ITERATIONS, lambda: self.no_data_count)
 
     @property
     def hardware_name(self):
@@ -151,75 +213,281 @@ class WeatherlinkLiveDriver(AbstractDevice):
         self._log_success("Entering driver loop")
         while True:
             self._check_no_data_count()
+            self._log_metrics()
+            self._save_state_periodically()
 
+            log.debug("Waiting for new packet")
             try:
-                self.scheduler.raise_error()
-                self.poll_host.raise_error()
-                self.push_host.raise_error()
+                item = self._next_record(self._wait_timeout(5))  # do a check every 5 secs
+            except weewx.StopNow:
+                raise
             except Exception as e:
+                self._errors.inc()
                 raise WeeWxIOError("Error while receiving or processing packets: %s" % str(e)) from e
 
-            log.debug("Waiting for new packet")
-            self.data_event.wait(5)  # do a check every 5 secs
-            self.data_event.clear()
+            if item is None and (self.merger is None or not self.merger.has_pending):
+                self._increase_no_data_count()
+                continue
+
+            if self.merger is not None:
+                yield from self._merge_records([item] if item is not None else [])
+                continue
+
+            record, _ = item
+            self._log_success("Emitting packet")
+            self._reset_data_count()
+            self._add_metrics(record)
+            yield record
+
+    def _next_record(self, timeout: float) -> Optional[Tuple[dict, Hashable]]:
+        """Wait for the next record of any host and its source. Errors of hosts and schedulers are raised"""
+        return self.packets.get(timeout)
+
+    def _wait_timeout(self, default: float) -> float:
+        if self.merger is None:
+            return default
+        return self.merger.timeout(default)
+
+    def _merge_records(self, items):
+        for record, source in items:
+            flushed = self.merger.add(record, source)
+            if flushed is not None:
+                yield self._emit_merged(flushed)
+
+        merged = self.merger.pop_ready()
+        if merged is None:
+            return
+        yield self._emit_merged(merged)
 
-            emitted_poll_packet = False
-            emitted_push_packet = False
+    def _emit_merged(self, merged: dict) -> dict:
+        self._log_success("Emitting merged packet")
+        self._reset_data_count()
+        self._add_metrics(merged)
+        return merged
 
-            while self.poll_host.packets:
-                self._log_success("Emitting poll packet")
-                self._reset_data_count()
-                emitted_poll_packet = True
-                yield self.poll_host.packets.popleft()
+    def metrics_snapshot(self) -> Dict[str, float]:
+        """Current values of all metrics (see metrics module). Empty if metrics are disabled"""
+        return metrics.snapshot()
 
-            while self.push_host.packets:
-                self._log_success("Emitting push (broadcast) packet")
-                self._reset_data_count()
-                emitted_push_packet = True
-                yield self.push_host.packets.popleft()
+    def _log_metrics(self):
+        interval = self.configuration.metrics_log_interval
+        if interval <= 0 or not metrics.is_enabled() or time.monotonic() < self._metrics_log_time:
+            return
 
-            if not emitted_poll_packet and not emitted_push_packet:
-                self._increase_no_data_count()
+        self._metrics_log_time = time.monotonic() + interval
+        if not log.isEnabledFor(logging.INFO):
+            return
+        snapshot = self.metrics_snapshot()
+        log.info("Metrics: %s", ", ".join(["%s=%s" % (key, value) for key, value in snapshot.items()]))
+
+    def _mapper_states(self) -> Dict[str, dict]:
+        states = dict()
+        for host_name, mappers in self.host_mappers.items():
+            for mapper in mappers:
+                state = mapper.get_state()
+                if state is not None:
+                    states["%s/%s" % (host_name, mapper)] = state
+        return states
+
+    def _restore_state(self):
+        if self.state_store is None:
+            return
+
+        snapshot = self.state_store.load()
+        if snapshot is None:
+            return
+
+        mapper_states = snapshot.get('mappers', {})
+        for host_name, mappers in self.host_mappers.items():
+            for mapper in mappers:
+                state = mapper_states.get("%s/%s" % (host_name, mapper))
+                if state is not None:
+                    mapper.set_state(state)
+        self.wind_service.set_state(snapshot.get('wind_gusts', {}), snapshot['time'])
+        log.info("Restored state of %d mappers", len(mapper_states))
+
+    def _save_state(self):
+        if self.state_store is None:
+            return
+
+        self._state_save_time = time.monotonic() + self.configuration.state_save_interval
+        self.state_store.save({
+            'mappers': self._mapper_states(),
+            'wind_gusts': self.wind_service.get_state()
+        })
+
+    def _save_state_periodically(self):
+        if self.state_store is None or time.monotonic() < self._state_save_time:
+            return
+        self._save_state()
+
+    def _add_metrics(self, record: dict):
+        interval = self.configuration.metrics_loop_interval
+        if interval <= 0 or not metrics.is_enabled() or time.monotonic() < self._metrics_loop_time:
+            return
+
+        self._metrics_loop_time = time.monotonic() + interval
+        for key, value in self.metrics_snapshot().items():
+            record[metrics.field_name(key)] = value
 
     def start(self):
         if self.is_running:
             return
 
+        engine = self.configuration.engine
+        if engine not in (ENGINE_THREADED, ENGINE_ASYNCIO):
+            raise ValueError("Unknown engine: %s" % repr(engine))
+
+        self._restore_state()
+
+        decoder = json_decoder.use_decoder(self.configuration.json_decoder)
+        log.info("Using JSON decoder: %s", decoder)
+        if self.configuration.capture_file:
+            capture.start(self.configuration.capture_file)
+        if self.configuration.metrics_port > 0:
+            self.exporter = MetricsExporter(metrics.get_registry(), self.configuration.metrics_address,
+                                            self.configuration.metrics_port)
+            self.exporter.start()
+
         self.is_running = True
-        self.data_event = threading.Event()
-        self.poll_host = data_host.WllPollHost(
-            self.configuration.host,
-            self.mappers,
-            self.data_event,
-            self.configuration.socket_timeout
+        # Records of all hosts are handed over using one queue. The capacity applies per host
+        self.packets = data_host.PacketQueue(
+            self.configuration.queue_capacity * len(self.configuration.hosts),
+            self.configuration.queue_policy,
+            self.rain_fields
+        )
+
+        if engine == ENGINE_ASYNCIO:
+            self.async_engine = AsyncEngine(
+                self.configuration.polling_interval,
+                self.packets,
+                self.configuration.socket_timeout,
+                self.configuration.http_keep_alive
+            )
+            for host in self.configuration.hosts:
+                self.async_engine.add_station(host.name, host.host, self.mapping_plans[host.name],
+                                              self._adaptive_polling_interval(host), not host.is_airlink,
+                                              host.device_id)
+            self.async_engine.start()
+            return
+
+        # AirLinks can only be polled. They are polled concurrently by the scheduler of the first WeatherLink Live
+        airlink_polls = dict([
+            (host.name, self._create_poll_host(host).poll) for host in self.configuration.hosts if host.is_airlink
+        ])
+        wll_hosts = [host for host in self.configuration.hosts if not host.is_airlink]
+        if len(wll_hosts) < 1:
+            name = next(iter(airlink_polls))
+            poll = airlink_polls.pop(name)
+            self.schedulers.append(scheduler.Scheduler(
+                self.configuration.polling_interval,
+                poll,
+                None,
+                self.packets.put_error,
+                name,
+                extra_polls=airlink_polls
+            ))
+            return
+
+        for index, host in enumerate(wll_hosts):
+            self._start_host(host, airlink_polls if index == 0 else None)
+
+    def _create_poll_host(self, host: HostConfiguration) -> data_host.WllPollHost:
+        poll_host = data_host.WllPollHost(
+            host.host,
+            self.mapping_plans[host.name],
+            self.packets,
+            self.configuration.socket_timeout,
+            self.configuration.http_pool_size,
+            self.configuration.http_keep_alive
         )
-        self.push_host = data_host.WLLBroadcastHost(
-            self.configuration.host,
-            self.mappers,
-            self.data_event,
-            self.configuration.socket_timeout
+        self.poll_hosts.append(poll_host)
+        return poll_host
+
+    def _start_host(self, host: HostConfiguration, extra_polls: Optional[Dict[str, Callable[[], None]]] = None):
+        """Start polling and broadcast reception of a WeatherLink Live. Each of them has its own scheduler"""
+
+        poll_host = self._create_poll_host(host)
+        push_host = data_host.WLLBroadcastHost(
+            host.host,
+            self.mapping_plans[host.name],
+            self.packets,
+            self.configuration.socket_timeout,
+            self.configuration.http_pool_size,
+            self.configuration.http_keep_alive,
+            host.device_id
         )
-        self.scheduler = scheduler.Scheduler(
+        self.push_hosts.append(push_host)
+
+        adaptive_polling = None
+        adaptive_polling_interval = self._adaptive_polling_interval(host)
+        if adaptive_polling_interval is not None:
+            adaptive_polling = scheduler.AdaptivePolling(host.name, adaptive_polling_interval,
+                                                         lambda: push_host.last_packet_time)
+
+        self.schedulers.append(scheduler.Scheduler(
             self.configuration.polling_interval,
-            self.poll_host.poll,
-            self.push_host.refresh_broadcast,
-            self.data_event
-        )
+            poll_host.poll,
+            push_host.refresh_broadcast,
+            self.packets.put_error,
+            host.name,
+            adaptive_polling,
+            extra_polls
+        ))
+
+    def _adaptive_polling_interval(self, host: HostConfiguration) -> Optional[float]:
+        """Slow polling interval of a host or None, if adaptive polling is disabled or not applicable"""
+
+        if not self.configuration.adaptive_polling or host.is_airlink:
+            return None
+
+        polling_interval = self.configuration.adaptive_polling_interval
+        if polling_interval < self.configuration.polling_interval:
+            raise ValueError("Adaptive polling interval shouldn't be less than polling interval (got: %d)" %
+                             polling_interval)
+
+        mapping_plan = self.mapping_plans[host.name]
+        data_structure_types = mapping_plan.data_structure_types(PacketSource.WEATHER_POLL)
+        # Rain mappings only reconcile missed counts when polled, so they don't need frequent polls
+        poll_hooks = [hook for hook in mapping_plan.hooks[PacketSource.WEATHER_POLL]
+                      if not isinstance(hook, RainMapping)]
+        if poll_hooks or not scheduler.AdaptivePolling.is_applicable(data_structure_types):
+            log.info("Not using adaptive polling for %s. Some mapped observations are only available by polling",
+                     host.name)
+            return None
+
+        return polling_interval
 
     def closePort(self):
         """Close connection"""
 
+        was_running = self.is_running
         self.is_running = False
-        if self.scheduler is not None:
-            self.scheduler.cancel()
-        if self.poll_host is not None:
-            self.poll_host.close()
-        if self.push_host is not None:
-            self.push_host.close()
+        if self.packets is not None:
+            # Release hosts blocked on a full queue
+            self.packets.close()
+        if self.async_engine is not None:
+            self.async_engine.close()
+            self.async_engine = None
+        for host_scheduler in self.schedulers:
+            host_scheduler.cancel()
+        for host in self.poll_hosts + self.push_hosts:
+            host.close()
+        if self.configuration.capture_file:
+            capture.stop()
+        if self.exporter is not None:
+            self.exporter.close()
+            self.exporter = None
+        if was_running:
+            # Hosts are stopped, so the state doesn't change while saving
+            self._save_state()
+        self.schedulers = []
+        self.poll_hosts = []
+        self.push_hosts = []
 
     def _increase_no_data_count(self):
         self.no_data_count += 1
-        self._log_failure("No data since %d iterations" % self.no_data_count, logging.WARNING)
+        self._log_failure("No data since %d iterations", self.no_data_count, level=logging.WARNING)
 
     def _reset_data_count(self):
         self.no_data_count = 0
@@ -232,15 +500,15 @@ class WeatherlinkLiveDriver(AbstractDevice):
         if self.no_data_count >= max_iterations:
             raise WeeWxIOError("Received no data for %d iterations" % max_iterations)
 
-    def _log_success(self, msg: str, level: int = logging.DEBUG) -> None:
+    def _log_success(self, msg: str, *args, level: int = logging.DEBUG) -> None:
         if not self.configuration.log_success:
             return
-        log.log(level, msg)
+        log.log(level, msg, *args)
 
-    def _log_failure(self, msg: str, level: int = logging.DEBUG) -> None:
+    def _log_failure(self, msg: str, *args, level: int = logging.DEBUG) -> None:
         if not self.configuration.log_error:
             return
-        log.log(level, msg)
+        log.log(level, msg, *args)
 
 
 class WeatherlinkLiveConfEditor(weewx.drivers.AbstractConfEditor):
@@ -0,0 +1,186 @@
+# Copyright © 2020-2021 Michael Schantl and contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+US EPA Air Quality Index of particulate matter
+
+Uses the breakpoints revised in 2024. The tables are converted to lower bounds and linear segments once, so
+calculating an index only takes a binary search and a multiplication.
+
+The NowCast is calculated incrementally from hourly averages kept in a ring buffer.
+"""
+import math
+from bisect import bisect_right
+from typing import List, Optional, Tuple
+
+# (concentration low, concentration high, index low, index high)
+Breakpoint = Tuple[float, float, int, int]
+
+# µg/m³, truncated to 0.1
+PM2_5_BREAKPOINTS: List[Breakpoint] = [
+    (0.0, 9.0, 0, 50),
+    (9.1, 35.4, 51, 100),
+    (35.5, 55.4, 101, 150),
+    (55.5, 125.4, 151, 200),
+    (125.5, 225.4, 201, 300),
+    (225.5, 325.4, 301, 500),
+]
+
+# µg/m³, truncated to integer
+PM10_BREAKPOINTS: List[Breakpoint] = [
+    (0, 54, 0, 50),
+    (55, 154, 51, 100),
+    (155, 254, 101, 150),
+    (255, 354, 151, 200),
+    (355, 424, 201, 300),
+    (425, 604, 301, 500),
+]
+
+
+class AqiTable(object):
+    """Breakpoints of one pollutant, precomputed as lower bounds and slopes"""
+
+    __slots__ = ('_lower_bounds', '_segments', '_scale')
+
+    def __init__(self, breakpoints: List[Breakpoint], decimals: int):
+        self._lower_bounds = [c_low for c_low, _, _, _ in breakpoints]
+        self._segments = [
+            (c_low, (i_high - i_low) / (c_high - c_low), i_low)
+            for c_low, c_high, i_low, i_high in breakpoints
+        ]
+        self._scale = 10 ** decimals
+
+    def index(self, concentration: Optional[float]) -> Optional[int]:
+        """
+        Index of a concentration. Concentrations above the highest breakpoint are extrapolated using the
+        highest segment
+        """
+
+        if concentration is None or concentration < 0:
+            return None
+
+        truncated = math.floor(concentration * self._scale) / self._scale
+        c_low, slope, i_low = self._segments[bisect_right(self._lower_bounds, truncated) - 1]
+        return int(i_low + slope * (truncated - c_low) + 0.5)
+
+
+PM2_5 = AqiTable(PM2_5_BREAKPOINTS, 1)
+PM10 = AqiTable(PM10_BREAKPOINTS, 0)
+
+
+def pm2_5_aqi(concentration: Optional[float]) -> Optional[int]:
+    return PM2_5.index(concentration)
+
+
+def pm10_aqi(concentration: Optional[float]) -> Optional[int]:
+    return PM10.index(concentration)
+
+
+# Hours weighted by the NowCast
+NOWCAST_HOURS = 12
+# Minimum weight factor of particulate matter
+NOWCAST_MIN_WEIGHT = 0.5
+
+
+class NowCast(object):
+    """
+    EPA NowCast of one pollutant
+
+    Values are averaged per clock hour. Hourly averages of the last 12 hours are kept in a ring buffer indexed by
+    hour, so hours without values don't need to be shifted out. The NowCast is only recalculated when an hour is
+    complete; adding a value in between only updates the sum of the current hour.
+
+    The NowCast is only available when at least 2 of the 3 most recent complete hours have values.
+    """
+
+    __slots__ = ('decimals', '_averages', '_hours', '_hour', '_sum', '_count', 'value')
+
+    def __init__(self, decimals: int):
+        self.decimals = decimals
+
+        self._averages: List[Optional[float]] = [None] * NOWCAST_HOURS
+        # Hour each slot was written for; slots of earlier hours are stale
+        self._hours: List[Optional[int]] = [None] * NOWCAST_HOURS
+        self._hour: Optional[int] = None
+        self._sum = 0.0
+        self._count = 0
+
+        self.value: Optional[float] = None
+
+    def add(self, timestamp: float, concentration: Optional[float]) -> bool:
+        """
+        Add a concentration measured at the timestamp
+
+        :return: True if the NowCast was recalculated
+        """
+
+        hour = int(timestamp // 3600)
+        changed = False
+        if self._hour is None:
+            self._hour = hour
+        elif hour > self._hour:
+            self._complete_hour()
+            self._hour = hour
+            self.value = self._calculate(hour - 1)
+            changed = True
+        elif hour < self._hour:
+            # Out of order
+            return False
+
+        if concentration is not None:
+            self._sum += concentration
+            self._count += 1
+        return changed
+
+    def _complete_hour(self):
+        if self._count > 0:
+            slot = self._hour % NOWCAST_HOURS
+            self._averages[slot] = self._sum / self._count
+            self._hours[slot] = self._hour
+        self._sum = 0.0
+        self._count = 0
+
+    def _average(self, hour: int) -> Optional[float]:
+        slot = hour % NOWCAST_HOURS
+        if self._hours[slot] != hour:
+            return None
+        return self._averages[slot]
+
+    def _calculate(self, latest_hour: int) -> Optional[float]:
+        averages = [self._average(latest_hour - age) for age in range(NOWCAST_HOURS)]
+        if sum(1 for average in averages[:3] if average is not None) < 2:
+            return None
+
+        present = [average for average in averages if average is not None]
+        c_max = max(present)
+        weight = max(min(present) / c_max, NOWCAST_MIN_WEIGHT) if c_max > 0 else 1.0
+
+        weighted_sum = 0.0
+        weight_sum = 0.0
+        factor = 1.0
+        for average in averages:
+            if average is not None:
+                weighted_sum += factor * average
+                weight_sum += factor
+            factor *= weight
+
+        scale = 10 ** self.decimals
+        return math.floor(weighted_sum / weight_sum * scale) / scale
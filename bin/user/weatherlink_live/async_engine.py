@@ -0,0 +1,492 @@
+# Copyright © 2020-2021 Michael Schantl and contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Driver core running polling and broadcast reception on a single asyncio event loop
+
+The event loop runs in a thread of its own, so broadcasts and polls are serviced while WeeWX is busy (e.g. archiving
+or generating reports). Records are handed over to the driver loop using the same queue as the threaded engine.
+"""
+import asyncio
+import logging
+import threading
+import time
+from socket import socket, AF_INET, SOCK_DGRAM, SOL_SOCKET, SO_BROADCAST, SO_REUSEADDR
+from typing import Optional, Dict, Callable, Awaitable, List
+
+import weewx
+from user.weatherlink_live import capture, json_decoder, metrics
+from user.weatherlink_live.callback import PacketCallback
+from user.weatherlink_live.data_host import PacketQueue
+from user.weatherlink_live.davis_broadcast import BroadcastDispatcher, BroadcastSubscription
+from user.weatherlink_live.mappers import MappingPlan
+from user.weatherlink_live.packets import DavisConditionsPacket, WlHttpConditionsRequestPacket, \
+    WlHttpBroadcastStartRequestPacket, DeviceError
+from user.weatherlink_live.scheduler import RequestStats, CircuitBreaker, AdaptivePolling, backoff_delay, \
+    register_request_metrics, RETRY_MAX_ATTEMPTS, PUSH_REFRESH_INTERVAL, PUSH_DURATION, PUSH_REFRESH_DEADLINE, \
+    TASK_POLL, TASK_PUSH_REFRESH, POLL_INTERVAL_MIN, POLL_INTERVAL_MAX, ATTEMPT_TIMEOUT_MIN, REQUEST_ERRORS
+from weewx import WeeWxIOError
+
+log = logging.getLogger(__name__)
+
+# Timeouts of asyncio aren't an OSError on Python versions before 3.11
+ASYNC_REQUEST_ERRORS = REQUEST_ERRORS + (asyncio.TimeoutError, asyncio.IncompleteReadError)
+
+
+class AsyncHttpClient(object):
+    """Minimal HTTP/1.1 client for the JSON endpoints of the WLL, keeping the connection alive"""
+
+    def __init__(self, host: str, timeout: float, keep_alive: bool = True, port: int = 80):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.keep_alive = keep_alive
+
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._lock: Optional[asyncio.Lock] = None
+
+    async def get_json(self, path: str, timeout: Optional[float] = None) -> dict:
+        # The WLL can't cope with simultaneous requests
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            endpoint = path.split("?", 1)[0]
+            start_time = time.perf_counter()
+            try:
+                return await asyncio.wait_for(self._get_json(path),
+                                              self.timeout if timeout is None else min(self.timeout, timeout))
+            except asyncio.CancelledError:
+                self.close()
+                raise
+            except BaseException:
+                metrics.counter(metrics.HTTP_ERRORS, endpoint=endpoint).inc()
+                self.close()
+                raise
+            finally:
+                metrics.histogram(metrics.HTTP_REQUEST_SECONDS, endpoint=endpoint).observe(
+                    time.perf_counter() - start_time)
+
+    async def _get_json(self, path: str) -> dict:
+        reused = self._writer is not None
+        if not reused:
+            await self._connect()
+
+        try:
+            return await self._request(path)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            if not reused:
+                raise
+
+        # Device closed the idle connection in the meantime
+        log.debug("Re-used HTTP connection was closed. Reconnecting")
+        self.close()
+        await self._connect()
+        return await self._request(path)
+
+    async def _connect(self):
+        log.debug("Opening HTTP connection to %s:%d", self.host, self.port)
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+
+    async def _request(self, path: str) -> dict:
+        request = "GET %s HTTP/1.1\r\nHost: %s\r\nAccept: application/json\r\nConnection: %s\r\n\r\n" % (
+            path, self.host, "keep-alive" if self.keep_alive else "close")
+        self._writer.write(request.encode("ascii"))
+        await self._writer.drain()
+
+        status_line = await self._reader.readline()
+        if not status_line:
+            raise ConnectionError("Connection closed by %s" % self.host)
+
+        try:
+            version, status = status_line.decode("ascii").split(" ", 2)[:2]
+            status = int(status)
+        except ValueError as e:
+            raise WeeWxIOError("Malformed HTTP status line %s" % repr(status_line)) from e
+
+        headers = dict()
+        while True:
+            line = await self._reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            body = await self._read_chunked()
+        elif "content-length" in headers:
+            body = await self._reader.readexactly(int(headers["content-length"]))
+        else:
+            body = await self._reader.read()
+            self.close()
+
+        if not self.keep_alive or version == "HTTP/1.0" or headers.get("connection", "").lower() == "close":
+            self.close()
+
+        if status != 200:
+            raise DeviceError("Device %s returned HTTP status %d" % (self.host, status))
+
+        capture.record_http(self.host, path, body)
+        try:
+            return json_decoder.loads(body)
+        except ValueError as e:
+            raise WeeWxIOError("Error decoding HTTP response JSON") from e
+
+    async def _read_chunked(self) -> bytes:
+        body = bytearray()
+        while True:
+            size_line = await self._reader.readline()
+            size = int(size_line.split(b";", 1)[0].strip(), 16)
+            if size == 0:
+                await self._reader.readline()
+                return bytes(body)
+            body.extend(await self._reader.readexactly(size))
+            await self._reader.readline()
+
+    def close(self):
+        if self._writer is None:
+            return
+        self._writer.close()
+        self._reader = None
+        self._writer = None
+
+
+class _BroadcastProtocol(BroadcastDispatcher, asyncio.DatagramProtocol):
+    """Receive UDP broadcasts from WeatherLink Live devices on a single port"""
+
+    def __init__(self, port: int):
+        super().__init__(port)
+        self.transport: Optional[asyncio.DatagramTransport] = None
+
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr):
+        log.debug("Received %d bytes from %s", len(data), addr)
+        self.dispatch(data, addr)
+
+    def error_received(self, exc: Exception):
+        self.dispatch_error_to_all(exc)
+
+
+class AsyncStation(PacketCallback):
+    """Single device polled and receiving broadcasts within the async engine"""
+
+    def __init__(self,
+                 engine: 'AsyncEngine',
+                 name: str,
+                 host: str,
+                 mapping_plan: MappingPlan,
+                 http_timeout: float = 20,
+                 http_keep_alive: bool = True,
+                 adaptive_polling_interval: Optional[float] = None,
+                 broadcast: bool = True,
+                 device_id: Optional[str] = None):
+        self.name = name
+        self.host = host
+        self.device_id = device_id
+        self.mapping_plan = mapping_plan
+        # AirLinks can only be polled
+        self.broadcast = broadcast
+
+        self.last_broadcast_time: Optional[float] = None
+        self.adaptive_polling = None
+        if adaptive_polling_interval is not None:
+            self.adaptive_polling = AdaptivePolling(name, adaptive_polling_interval, lambda: self.last_broadcast_time)
+
+        self._engine = engine
+        self._http = AsyncHttpClient(host, http_timeout, http_keep_alive)
+
+        self._port = 22222
+        self._subscribed_port = None
+        self._port_changes = metrics.counter(metrics.BROADCAST_PORT_CHANGES, host=host)
+
+        self.request_stats: Dict[str, RequestStats] = {TASK_POLL: RequestStats()}
+        if broadcast:
+            self.request_stats[TASK_PUSH_REFRESH] = RequestStats()
+        self._circuits = dict([
+            (name, CircuitBreaker("%s/%s" % (self.name, name), stats)) for name, stats in self.request_stats.items()
+        ])
+        register_request_metrics(self.name, self.request_stats)
+
+    async def run_polling(self):
+        # Retries of polls must not overlap with the next tick
+        polling_interval = self._engine.polling_interval
+        await self._run_periodically(TASK_POLL, self._poll, polling_interval, polling_interval,
+                                     self._poll_due if self.adaptive_polling is not None else None)
+
+    async def run_push_refresh(self):
+        # A failed push refresh stays due and is tried again at the next poll tick
+        polling_interval = self._engine.polling_interval
+        await self._run_periodically(TASK_PUSH_REFRESH, self._refresh_broadcast, PUSH_REFRESH_INTERVAL,
+                                     PUSH_REFRESH_DEADLINE, retry_interval=polling_interval,
+                                     max_attempt_time=polling_interval)
+
+    async def _run_periodically(self, name: str, request: Callable[[float], Awaitable[None]], interval: float,
+                                deadline: float, due: Optional[Callable[[], bool]] = None,
+                                retry_interval: Optional[float] = None, max_attempt_time: Optional[float] = None):
+        tick_drift = metrics.histogram(metrics.TICK_DRIFT_SECONDS, host=str(self.name), task=name)
+        next_run = time.time()
+        while True:
+            succeeded = True
+            if due is None or due():
+                try:
+                    succeeded = await self._request(name, request, deadline, max_attempt_time)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    log.error("Error caught in request %s of %s. Not rescheduling", name, self.name)
+                    self._engine.on_error(e)
+                    return
+
+            if not succeeded and retry_interval is not None:
+                next_run = time.time() + retry_interval
+            else:
+                next_run += interval
+            await asyncio.sleep(max(0.0, next_run - time.time()))
+            tick_drift.observe(max(0.0, time.time() - next_run))
+
+    async def _request(self, name: str, request: Callable[[float], Awaitable[None]], deadline: float,
+                       max_attempt_time: Optional[float] = None) -> bool:
+        """
+        Execute a request, retried with exponential backoff. Returns whether it succeeded
+
+        Only ASYNC_REQUEST_ERRORS fail an attempt. Other errors are raised.
+
+        The request is passed the timeout of the attempt: the remaining time until the deadline, and no more than
+        max_attempt_time seconds, if given.
+        """
+
+        stats = self.request_stats[name]
+        circuit = self._circuits[name]
+        if circuit.is_open():
+            return False
+
+        stats.requests += 1
+        deadline_time = time.time() + deadline
+
+        attempt = 0
+        while True:
+            attempt += 1
+            stats.attempts += 1
+            if attempt > 1:
+                stats.retries += 1
+
+            start_time = time.time()
+            timeout = deadline_time - start_time
+            if max_attempt_time is not None:
+                timeout = min(timeout, max_attempt_time)
+
+            try:
+                await request(max(ATTEMPT_TIMEOUT_MIN, timeout))
+                stats.add_latency(time.time() - start_time)
+                stats.successes += 1
+                circuit.on_success()
+                return True
+            except ASYNC_REQUEST_ERRORS as e:
+                stats.add_latency(time.time() - start_time)
+                log.error("Request %s of %s failed (attempt %d of %d): %s",
+                          name, self.name, attempt, RETRY_MAX_ATTEMPTS, e)
+
+            delay = backoff_delay(attempt)
+            if attempt >= RETRY_MAX_ATTEMPTS or time.time() + delay >= deadline_time:
+                break
+            await asyncio.sleep(delay)
+
+        stats.failures += 1
+        log.error("Request %s of %s failed after %d attempts", name, self.name, attempt)
+        circuit.on_failure()
+        return False
+
+    def _poll_due(self) -> bool:
+        return self.adaptive_polling.poll_due(self._engine.polling_interval)
+
+    async def _poll(self, timeout: float):
+        json_data = await self._http.get_json("/v1/current_conditions", timeout)
+        packet = WlHttpConditionsRequestPacket.try_create(json_data, self.host)
+        log.debug("Polled current conditions of %s", self.name)
+        self._engine.create_record(self.mapping_plan, packet)
+
+    async def _refresh_broadcast(self, timeout: float):
+        log.debug("Re-requesting UDP broadcast of %s", self.name)
+        json_data = await self._http.get_json("/v1/real_time?duration=%d" % PUSH_DURATION, timeout)
+        packet = WlHttpBroadcastStartRequestPacket.try_create(json_data, self.host)
+        port = packet.broadcast_port
+
+        if self._port != port:
+            log.info("Broadcast port of %s changed from %s to %s", self.name, self._port, port)
+            self._port = port
+            self._port_changes.inc()
+
+        if self._subscribed_port != self._port:
+            self._unsubscribe()
+            await self._engine.subscribe(self._port, self.host, self, self.device_id)
+            self._subscribed_port = self._port
+
+    def _unsubscribe(self):
+        if self._subscribed_port is None:
+            return
+        self._engine.unsubscribe(self._subscribed_port, self)
+        self._subscribed_port = None
+
+    def on_packet_received(self, packet: DavisConditionsPacket):
+        log.debug("Received new broadcast packet of %s", self.name)
+        self.last_broadcast_time = time.monotonic()
+        try:
+            self._engine.create_record(self.mapping_plan, packet)
+        except Exception as e:
+            self._engine.on_error(e)
+
+    def on_packet_receive_error(self, e: BaseException):
+        self._engine.on_error(e)
+
+    def close(self):
+        self._unsubscribe()
+        self._http.close()
+
+
+class AsyncEngine(object):
+    """Poll current conditions and receive broadcasts of all devices on one event loop"""
+
+    def __init__(self,
+                 polling_interval: float,
+                 packets: PacketQueue,
+                 http_timeout: float = 20,
+                 http_keep_alive: bool = True):
+        if polling_interval < POLL_INTERVAL_MIN:
+            raise ValueError(
+                "Polling interval shouldn't be less than %d (got: %d)" % (POLL_INTERVAL_MIN, polling_interval))
+        elif polling_interval > POLL_INTERVAL_MAX:
+            raise ValueError(
+                "Polling interval shouldn't be more than %d (got: %d)" % (POLL_INTERVAL_MAX, polling_interval))
+
+        self.polling_interval = polling_interval
+        self.packets = packets
+        self.http_timeout = http_timeout
+        self.http_keep_alive = http_keep_alive
+
+        self.stations: List[AsyncStation] = []
+
+        self._loop = asyncio.new_event_loop()
+        self._thread: Optional[threading.Thread] = None
+        self._subscribe_lock: Optional[asyncio.Lock] = None
+        self._tasks = []
+        self._protocols: Dict[int, _BroadcastProtocol] = dict()
+
+    def add_station(self, name: str, host: str, mapping_plan: MappingPlan,
+                    adaptive_polling_interval: Optional[float] = None, broadcast: bool = True,
+                    device_id: Optional[str] = None):
+        station = AsyncStation(self, name, host, mapping_plan, self.http_timeout, self.http_keep_alive,
+                               adaptive_polling_interval, broadcast, device_id)
+        self.stations.append(station)
+
+    @property
+    def request_stats(self) -> Dict[str, Dict[str, RequestStats]]:
+        """Retry counts and latencies of all requests by station and task name"""
+        return dict([(station.name, station.request_stats) for station in self.stations])
+
+    def start(self):
+        self._thread = threading.Thread(name='WLL-AsyncEngine', target=self._run_loop)
+        self._thread.daemon = True
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._start(), self._loop).result()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    async def _start(self):
+        # Lock has to be created inside the loop on older Python versions
+        self._subscribe_lock = asyncio.Lock()
+        for station in self.stations:
+            self._tasks.append(self._loop.create_task(station.run_polling()))
+            if station.broadcast:
+                self._tasks.append(self._loop.create_task(station.run_push_refresh()))
+
+    async def subscribe(self, port: int, host: str, callback: PacketCallback, device_id: Optional[str] = None):
+        """Subscribe to broadcasts of a device, sharing one receiving socket per port"""
+
+        async with self._subscribe_lock:
+            protocol = self._protocols.get(port)
+            if protocol is None:
+                log.debug("Starting broadcast reception on port %d", port)
+                sock = socket(AF_INET, SOCK_DGRAM)
+                sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+                sock.setsockopt(SOL_SOCKET, SO_BROADCAST, 1)
+                sock.bind(('', port))
+                sock.setblocking(False)
+
+                _, protocol = await self._loop.create_datagram_endpoint(lambda: _BroadcastProtocol(port), sock=sock)
+                self._protocols[port] = protocol
+
+            protocol.subscribe(BroadcastSubscription(host, callback, device_id))
+
+    def unsubscribe(self, port: int, callback: PacketCallback):
+        protocol = self._protocols.get(port)
+        if protocol is None:
+            return
+
+        protocol.unsubscribe(callback)
+        if protocol.has_subscriptions:
+            return
+
+        log.debug("Stopping broadcast reception on port %d", port)
+        del self._protocols[port]
+        protocol.transport.close()
+
+    def on_error(self, e: BaseException):
+        self.packets.put_error(e)
+
+    def create_record(self, mapping_plan: MappingPlan, packet: DavisConditionsPacket):
+        record = dict()
+
+        mapping_plan.map(packet, record)
+
+        record['dateTime'] = packet.timestamp
+        record['usUnits'] = weewx.US
+
+        # Waiting for space in the queue would stall the event loop, and with it all devices
+        self.packets.append(record, (packet.host, packet.data_source), False)
+
+    def close(self):
+        if self._loop.is_closed():
+            return
+
+        if self._thread is not None:
+            asyncio.run_coroutine_threadsafe(self._stop(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._thread = None
+
+        self._loop.close()
+        log.debug("Closed async engine")
+
+    async def _stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+        for station in self.stations:
+            station.close()
+
+        # Let transports finish closing
+        await asyncio.sleep(0)
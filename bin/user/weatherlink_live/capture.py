@@ -0,0 +1,140 @@
+# Copyright © 2020-2021 Michael Schantl and contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Capture of raw device traffic
+
+Raw HTTP responses and UDP broadcast datagrams are appended to a log file, one record per line:
+
+    <timestamp> <kind> <host> <payload>
+
+The payload is the raw JSON as received from the device. Captures can be fed back using the replay driver.
+"""
+import logging
+import threading
+import time
+from typing import Iterator, NamedTuple, Optional
+
+from user.weatherlink_live.json_decoder import BytesLike
+
+log = logging.getLogger(__name__)
+
+KIND_CONDITIONS = "conditions"
+KIND_REAL_TIME = "real_time"
+KIND_BROADCAST = "broadcast"
+
+_HTTP_PATH_KINDS = {
+    "/v1/current_conditions": KIND_CONDITIONS,
+    "/v1/real_time": KIND_REAL_TIME
+}
+
+
+class CaptureRecord(NamedTuple):
+    timestamp: float
+    kind: str
+    host: str
+    data: bytes
+
+
+class CaptureWriter(object):
+    """Append raw traffic to a capture file. Safe to be used from multiple threads"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+        self._file = open(path, "ab")
+        self._lock = threading.Lock()
+
+    def write(self, kind: str, host: str, data: BytesLike, timestamp: Optional[float] = None):
+        if timestamp is None:
+            timestamp = time.time()
+
+        data = bytes(data)
+        if b"\n" in data or b"\r" in data:
+            # Line breaks are only allowed as whitespace in JSON
+            data = data.replace(b"\r", b" ").replace(b"\n", b" ")
+
+        line = b"%.3f %s %s %s\n" % (timestamp, kind.encode("ascii"), host.encode("utf-8"), data)
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.close()
+            self._file = None
+
+
+_writer: Optional[CaptureWriter] = None
+
+
+def start(path: str):
+    """Start capturing traffic of all devices to a file"""
+
+    global _writer
+    stop()
+    log.info("Capturing traffic to %s", path)
+    _writer = CaptureWriter(path)
+
+
+def stop():
+    global _writer
+    writer = _writer
+    _writer = None
+    if writer is not None:
+        writer.close()
+
+
+def record_http(host: str, path: str, data: BytesLike):
+    writer = _writer
+    if writer is None:
+        return
+
+    kind = _HTTP_PATH_KINDS.get(path.split("?", 1)[0])
+    if kind is None:
+        return
+    writer.write(kind, host, data)
+
+
+def record_broadcast(host: str, data: BytesLike):
+    writer = _writer
+    if writer is None:
+        return
+    writer.write(KIND_BROADCAST, host, data)
+
+
+def read(path: str) -> Iterator[CaptureRecord]:
+    """Read records of a capture file"""
+
+    with open(path, "rb") as f:
+        for line_no, line in enumerate(f, start=1):
+            line = line.rstrip(b"\r\n")
+            if not line:
+                continue
+
+            try:
+                timestamp, kind, host, data = line.split(b" ", 3)
+                yield CaptureRecord(float(timestamp), kind.decode("ascii"), host.decode("utf-8"), data)
+            except ValueError as e:
+                raise ValueError("Invalid record in line %d of capture %s" % (line_no, path)) from e
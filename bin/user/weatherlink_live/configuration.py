@@ -19,13 +19,20 @@
 # SOFTWARE.
 
 import logging
-from typing import List
+from typing import List, Dict, Optional
 
 from user.weatherlink_live.mappers import TMapping, THMapping, WindMapping, RainMapping, SolarMapping, UvMapping, \
     WindChillMapping, ThwMapping, ThswMapping, SoilTempMapping, SoilMoistureMapping, LeafWetnessMapping, \
-    THIndoorMapping, BaroMapping, AbstractMapping, BatteryStatusMapping
+    THIndoorMapping, BaroMapping, AbstractMapping, BatteryStatusMapping, MappingPlan, WindAverageMapping, \
+    RainRateAverageMapping, AirLinkTHMapping, AirLinkPMMapping, AirLinkPMAverageMapping, AirLinkAqiMapping
 from user.weatherlink_live.static.config import KEY_DRIVER_POLLING_INTERVAL, KEY_DRIVER_HOST, KEY_DRIVER_MAPPING, \
-    KEY_MAX_NO_DATA_ITERATIONS
+    KEY_MAX_NO_DATA_ITERATIONS, KEY_HTTP_POOL_SIZE, KEY_HTTP_KEEP_ALIVE, KEY_ENGINE, ENGINE_THREADED, \
+    KEY_JSON_DECODER, JSON_DECODER_AUTO, KEY_CAPTURE_FILE, KEY_REPLAY_FILE, KEY_REPLAY_SPEED, KEY_QUEUE_CAPACITY, \
+    KEY_QUEUE_POLICY, QUEUE_POLICY_DROP_OLDEST, KEY_MERGE_WINDOW, KEY_ADAPTIVE_POLLING, KEY_ADAPTIVE_POLLING_INTERVAL, \
+    KEY_OMIT_UNCHANGED, KEY_METRICS, KEY_METRICS_LOG_INTERVAL, KEY_METRICS_LOOP_INTERVAL, KEY_METRICS_PORT, \
+    KEY_METRICS_ADDRESS, KEY_TRACE_INTERVAL, KEY_TRACE_SAMPLE_RATE, KEY_GUST_WINDOW, \
+    KEY_STATE_FILE, KEY_STATE_SAVE_INTERVAL, KEY_STATE_MAX_AGE, KEY_DRIVER_DEVICE_ID
+from user.weatherlink_live.tracing import PacketTracer
 from user.weatherlink_live.utils import to_list
 from weeutil.weeutil import to_bool, to_float, to_int
 
@@ -44,9 +51,18 @@ MAPPERS = {
     'leaf_wet': LeafWetnessMapping,
     'th_indoor': THIndoorMapping,
     'baro': BaroMapping,
-    'battery': BatteryStatusMapping
+    'battery': BatteryStatusMapping,
+    'wind_avg': WindAverageMapping,
+    'rain_rate_avg': RainRateAverageMapping,
+    'airlink_th': AirLinkTHMapping,
+    'airlink_pm': AirLinkPMMapping,
+    'airlink_pm_avg': AirLinkPMAverageMapping,
+    'airlink_aqi': AirLinkAqiMapping
 }
 
+# Devices only using these mappings are AirLinks, which can't broadcast
+AIRLINK_MAPPINGS = {'airlink_th', 'airlink_pm', 'airlink_pm_avg', 'airlink_aqi'}
+
 log = logging.getLogger(__name__)
 
 
@@ -55,28 +71,106 @@ def create_configuration(config: dict, driver_name: str):
 
     driver_dict = config[driver_name]
 
-    host = driver_dict[KEY_DRIVER_HOST]
+    hosts = _parse_hosts(driver_dict)
     polling_interval = float(driver_dict.get(KEY_DRIVER_POLLING_INTERVAL, 10))
     max_no_data_iterations = to_int(driver_dict.get(KEY_MAX_NO_DATA_ITERATIONS, 5))
-    mapping_list = to_list(driver_dict[KEY_DRIVER_MAPPING])
-    mappings = _parse_mappings(mapping_list)
+    http_pool_size = to_int(driver_dict.get(KEY_HTTP_POOL_SIZE, 1))
+    http_keep_alive = to_bool(driver_dict.get(KEY_HTTP_KEEP_ALIVE, True))
+    engine = driver_dict.get(KEY_ENGINE, ENGINE_THREADED)
+    json_decoder = driver_dict.get(KEY_JSON_DECODER, JSON_DECODER_AUTO)
+    capture_file = driver_dict.get(KEY_CAPTURE_FILE, None)
+    replay_file = driver_dict.get(KEY_REPLAY_FILE, None)
+    replay_speed = to_float(driver_dict.get(KEY_REPLAY_SPEED, 1))
+    queue_capacity = to_int(driver_dict.get(KEY_QUEUE_CAPACITY, 100))
+    queue_policy = driver_dict.get(KEY_QUEUE_POLICY, QUEUE_POLICY_DROP_OLDEST)
+    merge_window = to_float(driver_dict.get(KEY_MERGE_WINDOW, 0))
+    adaptive_polling = to_bool(driver_dict.get(KEY_ADAPTIVE_POLLING, False))
+    adaptive_polling_interval = to_float(driver_dict.get(KEY_ADAPTIVE_POLLING_INTERVAL, 60))
+    omit_unchanged = to_float(driver_dict.get(KEY_OMIT_UNCHANGED, 0))
+    metrics = to_bool(driver_dict.get(KEY_METRICS, False))
+    metrics_log_interval = to_float(driver_dict.get(KEY_METRICS_LOG_INTERVAL, 0))
+    metrics_loop_interval = to_float(driver_dict.get(KEY_METRICS_LOOP_INTERVAL, 0))
+    metrics_port = to_int(driver_dict.get(KEY_METRICS_PORT, 0))
+    metrics_address = driver_dict.get(KEY_METRICS_ADDRESS, "localhost")
+    trace_interval = to_float(driver_dict.get(KEY_TRACE_INTERVAL, 0))
+    trace_sample_rate = to_float(driver_dict.get(KEY_TRACE_SAMPLE_RATE, 1.0))
+    gust_window = to_float(driver_dict.get(KEY_GUST_WINDOW, 0))
+    state_file = driver_dict.get(KEY_STATE_FILE, None)
+    state_save_interval = to_float(driver_dict.get(KEY_STATE_SAVE_INTERVAL, 60))
+    state_max_age = to_float(driver_dict.get(KEY_STATE_MAX_AGE, 900))
 
     log_success = to_bool(config.get('log_success', False))
     log_error = to_bool(config.get('log_failure', True))
     socket_timeout = to_float(config.get('socket_timeout', 20))
 
     config_obj = Configuration(
-        host=host,
-        mappings=mappings,
+        hosts=hosts,
         polling_interval=polling_interval,
         max_no_data_iterations=max_no_data_iterations,
         log_success=log_success,
         log_error=log_error,
-        socket_timeout=socket_timeout
+        socket_timeout=socket_timeout,
+        http_pool_size=http_pool_size,
+        http_keep_alive=http_keep_alive,
+        engine=engine,
+        json_decoder=json_decoder,
+        capture_file=capture_file,
+        replay_file=replay_file,
+        replay_speed=replay_speed,
+        queue_capacity=queue_capacity,
+        queue_policy=queue_policy,
+        merge_window=merge_window,
+        adaptive_polling=adaptive_polling,
+        adaptive_polling_interval=adaptive_polling_interval,
+        omit_unchanged=omit_unchanged,
+        metrics=metrics,
+        metrics_log_interval=metrics_log_interval,
+        metrics_loop_interval=metrics_loop_interval,
+        metrics_port=metrics_port,
+        metrics_address=metrics_address,
+        trace_interval=trace_interval,
+        trace_sample_rate=trace_sample_rate,
+        gust_window=gust_window,
+        state_file=state_file,
+        state_save_interval=state_save_interval,
+        state_max_age=state_max_age
     )
     return config_obj
 
 
+def _parse_hosts(driver_dict: dict) -> List['HostConfiguration']:
+    """
+    Parse configured devices
+
+    A single device is configured using the host and mapping options of the driver section. Multiple devices are
+    configured using one sub-section (with the same options) per device. Both can be combined.
+    """
+
+    hosts = []
+    if KEY_DRIVER_HOST in driver_dict:
+        hosts.append(_parse_host(driver_dict[KEY_DRIVER_HOST], driver_dict))
+
+    for name, host_dict in driver_dict.items():
+        if isinstance(host_dict, dict) and KEY_DRIVER_HOST in host_dict:
+            hosts.append(_parse_host(name, host_dict))
+
+    if len(hosts) < 1:
+        raise KeyError("No host configured. Set option %s or add a sub-section per host" % repr(KEY_DRIVER_HOST))
+
+    names = [host.name for host in hosts]
+    if len(set(names)) != len(names):
+        raise ValueError("Host names must be unique (got: %s)" % repr(names))
+
+    return hosts
+
+
+def _parse_host(name: str, host_dict: dict) -> 'HostConfiguration':
+    host = host_dict[KEY_DRIVER_HOST]
+    mapping_list = to_list(host_dict[KEY_DRIVER_MAPPING])
+    mappings = _parse_mappings(mapping_list)
+    return HostConfiguration(name, host, mappings, host_dict.get(KEY_DRIVER_DEVICE_ID))
+
+
 def _parse_mappings(mappings_list: List[str]) -> List[List[str]]:
     mappings = [
         [mapping_opt.strip() for mapping_opt in mapping_opts.split(':')]
@@ -86,43 +180,121 @@ def _parse_mappings(mappings_list: List[str]) -> List[List[str]]:
     return mappings
 
 
+class HostConfiguration(object):
+    """Configuration of a single WeatherLink Live or AirLink device"""
+
+    def __init__(self, name: str, host: str, mappings: List[List[str]], device_id: Optional[str] = None):
+        self.name = name
+        self.host = host
+        self.mappings = mappings
+        # Device id of broadcasts, if they don't come from the address of the host (e.g. behind NAT)
+        self.device_id = device_id
+
+    @property
+    def is_airlink(self) -> bool:
+        return len(self.mappings) > 0 and all([opts[0] in AIRLINK_MAPPINGS for opts in self.mappings])
+
+    def __repr__(self):
+        return str(self.__dict__)
+
+
 class Configuration(object):
     """Configuration of driver"""
 
     def __init__(self,
-                 host: str,
-                 mappings: List[List[str]],
+                 hosts: List[HostConfiguration],
                  polling_interval: float,
                  max_no_data_iterations: int,
                  log_success: bool,
                  log_error: bool,
-                 socket_timeout: float):
-        self.host = host
-        self.mappings = mappings
+                 socket_timeout: float,
+                 http_pool_size: int = 1,
+                 http_keep_alive: bool = True,
+                 engine: str = ENGINE_THREADED,
+                 json_decoder: str = JSON_DECODER_AUTO,
+                 capture_file: Optional[str] = None,
+                 replay_file: Optional[str] = None,
+                 replay_speed: float = 1,
+                 queue_capacity: int = 100,
+                 queue_policy: str = QUEUE_POLICY_DROP_OLDEST,
+                 merge_window: float = 0,
+                 adaptive_polling: bool = False,
+                 adaptive_polling_interval: float = 60,
+                 omit_unchanged: float = 0,
+                 metrics: bool = False,
+                 metrics_log_interval: float = 0,
+                 metrics_loop_interval: float = 0,
+                 metrics_port: int = 0,
+                 metrics_address: str = "localhost",
+                 trace_interval: float = 0,
+                 trace_sample_rate: float = 1.0,
+                 gust_window: float = 0,
+                 state_file: Optional[str] = None,
+                 state_save_interval: float = 60,
+                 state_max_age: float = 900):
+        self.hosts = hosts
         self.polling_interval = polling_interval
         self.max_no_data_iterations = max_no_data_iterations
 
         self.log_success = log_success
         self.log_error = log_error
         self.socket_timeout = socket_timeout
+        self.http_pool_size = http_pool_size
+        self.http_keep_alive = http_keep_alive
+        self.engine = engine
+        self.json_decoder = json_decoder
+        self.capture_file = capture_file
+        self.replay_file = replay_file
+        self.replay_speed = replay_speed
+        self.queue_capacity = queue_capacity
+        self.queue_policy = queue_policy
+        self.merge_window = merge_window
+        self.adaptive_polling = adaptive_polling
+        self.adaptive_polling_interval = adaptive_polling_interval
+        self.omit_unchanged = omit_unchanged
+        self.metrics = metrics
+        self.metrics_log_interval = metrics_log_interval
+        self.metrics_loop_interval = metrics_loop_interval
+        self.metrics_port = metrics_port
+        self.metrics_address = metrics_address
+        self.trace_interval = trace_interval
+        self.trace_sample_rate = trace_sample_rate
+        self.gust_window = gust_window
+        self.state_file = state_file
+        self.state_save_interval = state_save_interval
+        self.state_max_age = state_max_age
 
     def __repr__(self):
         return str(self.__dict__)
 
-    def create_mappers(self) -> List[AbstractMapping]:
+    def create_host_mappers(self) -> Dict[str, List[AbstractMapping]]:
+        """Create mappers of all hosts by host name. Map targets are only used once across all hosts"""
+
         used_record_keys = []
-        mappers = []
-        for source_opts in self.mappings:
-            mapper = self._create_mapper(source_opts, used_record_keys)
-            mappers.append(mapper)
-            used_record_keys.extend(mapper.targets.values())
-        return mappers
+        host_mappers = dict()
+        for host in self.hosts:
+            mappers = []
+            for source_opts in host.mappings:
+                mapper = self._create_mapper(source_opts, used_record_keys)
+                mappers.append(mapper)
+                used_record_keys.extend(mapper.targets.values())
+            host_mappers[host.name] = mappers
+        return host_mappers
+
+    def create_mappers(self) -> List[AbstractMapping]:
+        return [mapper for mappers in self.create_host_mappers().values() for mapper in mappers]
+
+    def create_mapping_plan(self, mappers: List[AbstractMapping], name: Optional[str] = None) -> MappingPlan:
+        tracer = None
+        if self.trace_interval > 0:
+            tracer = PacketTracer(self.trace_interval, self.trace_sample_rate, name)
+        return MappingPlan(mappers, self.log_success, self.omit_unchanged, name, tracer)
 
     def _create_mapper(self, source_opts: List[str], used_map_targets: List[str]) -> AbstractMapping:
         type = source_opts[0]
         further_opts = source_opts[1:]
 
-        log.debug("Creating mapper %s. Options: %s" % (type, further_opts))
+        log.debug("Creating mapper %s. Options: %s", type, further_opts)
 
         try:
             mapper_init = MAPPERS[type]
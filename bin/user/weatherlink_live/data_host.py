@@ -18,54 +18,216 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import heapq
+import itertools
 import logging
 import threading
-from collections import deque
-from typing import List
+import time
+from typing import Iterable, Optional, Tuple, Hashable
 
 import weewx
 from user.weatherlink_live.callback import PacketCallback
-from user.weatherlink_live.davis_broadcast import WllBroadcastReceiver
-from user.weatherlink_live.davis_http import start_broadcast, request_current
-from user.weatherlink_live.mappers import AbstractMapping
+from user.weatherlink_live import davis_broadcast, metrics
+from user.weatherlink_live.davis_http import start_broadcast, request_current, HttpSession
+from user.weatherlink_live.mappers import MappingPlan
 from user.weatherlink_live.packets import DavisConditionsPacket
+from user.weatherlink_live.static.config import QUEUE_POLICY_DROP_OLDEST, QUEUE_POLICY_COALESCE, QUEUE_POLICY_BLOCK
 
 log = logging.getLogger(__name__)
 
+# Host and packet source a record was created from
+RecordSource = Hashable
+
+
+class PacketQueue(object):
+    """
+    Bounded queue handing records and errors of all hosts over to the driver loop
+
+    Records are queued along with their source (see DataHost.create_record). The consumer is woken up for each
+    record. Records queued at the same time (e.g. polls of several hosts or while
+    the consumer is busy) are taken ordered by their timestamp. Errors are raised to the consumer once all records
+    queued before have been taken.
+
+    When the queue is full (e.g. while WeeWX is busy archiving), the policy decides what happens to new records:
+
+    - drop oldest: the oldest record is dropped
+    - coalesce: the new record is merged into the latest queued record; newer values win, values of sum fields
+      (amounts since the last record, e.g. rain) are added up
+    - block: the producer waits until there is space again. Producers which must not wait (i.e. the listener
+      receiving broadcasts of all devices) drop the oldest record instead
+    """
+
+    def __init__(self, capacity: int = 100, policy: str = QUEUE_POLICY_DROP_OLDEST, sum_fields: Iterable[str] = ()):
+        if capacity < 1:
+            raise ValueError("Queue capacity must not be less than 1 (got: %d)" % capacity)
+        if policy not in (QUEUE_POLICY_DROP_OLDEST, QUEUE_POLICY_COALESCE, QUEUE_POLICY_BLOCK):
+            raise ValueError("Unknown queue policy: %s" % repr(policy))
+
+        self.capacity = capacity
+        self.policy = policy
+        self.sum_fields = frozenset(sum_fields)
+
+        self.dropped_count = 0
+        self.coalesced_count = 0
+        self.blocked_count = 0
+        self.delivered_count = 0
+        self.total_latency = 0.0
+
+        self.error: Optional[BaseException] = None
+
+        # Heap of entries, which are tuples of timestamp, sequence number, record, time of queueing and source.
+        # The sequence number keeps records of the same timestamp in order of queueing
+        self._records = []
+        self._latest = None
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._closed = False
+        self._overflowing = False
+
+        self._latency = metrics.histogram(metrics.QUEUE_SECONDS)
+        metrics.callback(metrics.QUEUE_DEPTH, self.__len__)
+        metrics.callback(metrics.QUEUE_DROPPED, lambda: self.dropped_count, metrics.KIND_COUNTER)
+        metrics.callback(metrics.QUEUE_COALESCED, lambda: self.coalesced_count, metrics.KIND_COUNTER)
+        metrics.callback(metrics.QUEUE_BLOCKED, lambda: self.blocked_count, metrics.KIND_COUNTER)
+
+    def __len__(self):
+        return len(self._records)
+
+    def __bool__(self):
+        return len(self._records) > 0
 
-class DataHost(object):
-    """Base host class for polled as well as broadcasted data"""
+    @property
+    def avg_latency(self) -> Optional[float]:
+        """Average time records spent in the queue"""
+
+        if self.delivered_count < 1:
+            return None
+        return self.total_latency / self.delivered_count
+
+    def append(self, record: dict, source: RecordSource = None, block: bool = True):
+        """
+        Queue a record
+
+        :param block: whether the producer may wait for space when using policy block
+        """
+
+        with self._lock:
+            if self._closed:
+                return
+
+            if len(self._records) >= self.capacity:
+                if not self._overflowing:
+                    log.warning("Packet queue full (capacity: %d, policy: %s)", self.capacity, self.policy)
+                    self._overflowing = True
+
+                if self.policy == QUEUE_POLICY_DROP_OLDEST or (self.policy == QUEUE_POLICY_BLOCK and not block):
+                    self._pop()
+                    self.dropped_count += 1
+                elif self.policy == QUEUE_POLICY_COALESCE:
+                    latest = self._latest if self._latest is not None else max(self._records)
+                    self._coalesce(latest[2], record)
+                    self.coalesced_count += 1
+                    return
+                else:
+                    self.blocked_count += 1
+                    while len(self._records) >= self.capacity and not self._closed:
+                        self._not_full.wait()
+                    if self._closed:
+                        return
+
+            self._latest = (record['dateTime'], next(self._sequence), record, time.monotonic(), source)
+            heapq.heappush(self._records, self._latest)
+            self._not_empty.notify()
+
+    def _pop(self) -> tuple:
+        entry = heapq.heappop(self._records)
+        if entry is self._latest:
+            self._latest = None
+        return entry
+
+    def _coalesce(self, queued: dict, record: dict):
+        for key, value in record.items():
+            if key in self.sum_fields and value is not None and queued.get(key) is not None:
+                queued[key] += value
+            else:
+                queued[key] = value
+
+    def put_error(self, e: BaseException):
+        """Hand an error over to the consumer. Only the first error is kept"""
+
+        with self._lock:
+            if self.error is None:
+                self.error = e
+            self._not_empty.notify()
+
+    def get(self, timeout: float) -> Optional[Tuple[dict, RecordSource]]:
+        """
+        Wait for the next record
+
+        :return: next record and its source or None if no record was queued during timeout or the queue is closed
+        :raise: error handed over by a producer
+        """
+
+        with self._lock:
+            if not self._records and self.error is None and not self._closed:
+                self._not_empty.wait(timeout)
+
+            if not self._records:
+                if self.error is not None:
+                    raise self.error
+                return None
+
+            _, _, record, queued_at, source = self._pop()
+            if not self._records:
+                self._overflowing = False
+            self._not_full.notify()
+
+            latency = time.monotonic() - queued_at
+            self.delivered_count += 1
+            self.total_latency += latency
+            self._latency.observe(latency)
+            return record, source
 
-    def __init__(self, mappers: List[AbstractMapping], data_event: threading.Event):
-        self._mappers = mappers
-        self._data_event = data_event
+    def close(self):
+        """Release waiting producers and consumers. Further records are dropped"""
 
-        self.packets = deque()
-        self.error = None
+        with self._lock:
+            self._closed = True
+            self._not_full.notify_all()
+            self._not_empty.notify_all()
+
+
+def _request_timeout(http_timeout: float, timeout: Optional[float]) -> float:
+    """Socket timeout of a request, limited to the timeout of the scheduled attempt"""
+    if timeout is None:
+        return http_timeout
+    return min(http_timeout, timeout)
 
-    @property
-    def has_error(self):
-        return self.error is not None
 
-    def raise_error(self):
-        if self.has_error:
-            raise self.error
+class DataHost(object):
+    """Base host class for polled as well as broadcasted data"""
+
+    def __init__(self, mapping_plan: MappingPlan, packets: PacketQueue, block: bool = True):
+        self._mapping_plan = mapping_plan
+
+        self.packets = packets
+        # Whether to wait for space in the queue when using policy block
+        self.block = block
 
-    def _create_record(self, packet: DavisConditionsPacket):
+    def create_record(self, packet: DavisConditionsPacket):
         record = dict()
 
-        for mapper in self._mappers:
-            mapper.map(packet, record)
-        self.packets.append(record)
+        self._mapping_plan.map(packet, record)
 
         record['dateTime'] = packet.timestamp
         record['usUnits'] = weewx.US
 
-        self._data_event.set()
+        self.packets.append(record, (packet.host, packet.data_source), self.block)
 
     def notify_error(self, e):
-        self.error = e
-        self._data_event.set()
+        self.packets.put_error(e)
 
 
 class WllPollHost(DataHost):
@@ -73,63 +235,86 @@ class WllPollHost(DataHost):
 
     def __init__(self,
                  host: str,
-                 mappers: List[AbstractMapping],
-                 data_event: threading.Event,
-                 http_timeout: float = 20):
-        super().__init__(mappers, data_event)
+                 mapping_plan: MappingPlan,
+                 packets: PacketQueue,
+                 http_timeout: float = 20,
+                 http_pool_size: int = 1,
+                 http_keep_alive: bool = True):
+        super().__init__(mapping_plan, packets)
         self.host = host
         self.http_timeout = http_timeout
+        self.http_session = HttpSession(http_pool_size, http_keep_alive)
 
-    def poll(self):
-        packet = request_current(self.host, timeout=self.http_timeout)
+    def poll(self, timeout: Optional[float] = None):
+        packet = request_current(self.host, timeout=_request_timeout(self.http_timeout, timeout), session=self.http_session)
         log.debug("Polled current conditions")
 
-        self._create_record(packet)
+        self.create_record(packet)
 
     def close(self):
-        pass
+        self.http_session.close()
 
 
 class WLLBroadcastHost(DataHost, PacketCallback):
-    """Class for triggering UDP broadcasts and receiving them"""
+    """
+    Class for triggering UDP broadcasts and receiving them
+
+    Broadcasts are received by a listener thread shared by all devices, so by default records are never blocked on
+    a full queue. Set block to true if packets are passed in by a thread of its own (e.g. when replaying).
+    """
 
     def __init__(self,
                  host: str,
-                 mappers: List[AbstractMapping],
-                 data_event: threading.Event,
-                 http_timeout: float = 20):
-        super().__init__(mappers, data_event)
+                 mapping_plan: MappingPlan,
+                 packets: PacketQueue,
+                 http_timeout: float = 20,
+                 http_pool_size: int = 1,
+                 http_keep_alive: bool = True,
+                 device_id: Optional[str] = None,
+                 block: bool = False):
+        super().__init__(mapping_plan, packets, block)
         self.host = host
+        self.device_id = device_id
         self.http_timeout = http_timeout
+        self.http_session = HttpSession(http_pool_size, http_keep_alive)
 
-        self._receiver = None
+        self._subscribed_port = None
         self._port = 22222
+        self._port_changes = metrics.counter(metrics.BROADCAST_PORT_CHANGES, host=host)
+
+        self.last_packet_time: Optional[float] = None
 
-    def refresh_broadcast(self, request_duration: float):
+    def refresh_broadcast(self, request_duration: float, timeout: Optional[float] = None):
         log.debug("Re-requesting UDP broadcast")
-        packet = start_broadcast(self.host, request_duration, timeout=self.http_timeout)
+        packet = start_broadcast(self.host, request_duration, timeout=_request_timeout(self.http_timeout, timeout),
+                                 session=self.http_session)
         port = packet.broadcast_port
 
         if self._port != port:
-            log.info("Broadcast port changed from %s to %s" % (self._port, port))
+            log.info("Broadcast port changed from %s to %s", self._port, port)
             self._port = port
+            self._port_changes.inc()
 
-        log.debug("Restarting broadcast reception")
-        self._stop_broadcast_reception()
-        self._start_broadcast_reception()
+        if self._subscribed_port != self._port:
+            log.debug("Restarting broadcast reception")
+            self._stop_broadcast_reception()
+            self._start_broadcast_reception()
 
     def _start_broadcast_reception(self):
-        self._receiver = WllBroadcastReceiver(self.host, self._port, self)
+        davis_broadcast.subscribe(self._port, self.host, self, self.device_id)
+        self._subscribed_port = self._port
 
     def _stop_broadcast_reception(self):
-        if self._receiver is None:
+        if self._subscribed_port is None:
             return
-        self._receiver.close()
+        davis_broadcast.unsubscribe(self._subscribed_port, self)
+        self._subscribed_port = None
 
     def on_packet_received(self, packet: DavisConditionsPacket):
         log.debug("Received new broadcast packet")
+        self.last_packet_time = time.monotonic()
         try:
-            self._create_record(packet)
+            self.create_record(packet)
         except Exception as e:
             self.notify_error(e)
             self.close()
@@ -140,3 +325,4 @@ class WLLBroadcastHost(DataHost, PacketCallback):
 
     def close(self):
         self._stop_broadcast_reception()
+        self.http_session.close()
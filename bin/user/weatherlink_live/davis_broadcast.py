@@ -18,39 +18,168 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import json
 import logging
+import re
 import select
 import threading
-from json import JSONDecodeError
-from socket import socket, AF_INET, SOCK_DGRAM, SOL_SOCKET, SO_BROADCAST, SO_REUSEADDR
+import time
+from socket import socket, AF_INET, SOCK_DGRAM, SOL_SOCKET, SO_BROADCAST, SO_REUSEADDR, gethostbyname
+from typing import Dict, List, Optional
 
+from user.weatherlink_live import capture, json_decoder, metrics
 from user.weatherlink_live.callback import PacketCallback
 from user.weatherlink_live.packets import WlUdpBroadcastPacket
+from user.weatherlink_live.static.packets import KEY_DEVICE_ID
 from weewx import WeeWxIOError
 
 log = logging.getLogger(__name__)
 
+RECEIVE_BUFFER_SIZE = 2048
 
-class WllBroadcastReceiver(object):
-    """Receive UDP broadcasts from WeatherLink Live"""
+_DEVICE_ID_PATTERN = re.compile(rb'"' + KEY_DEVICE_ID.encode("ascii") + rb'"\s*:\s*"([^"\\]*)"')
 
-    def __init__(self, broadcasting_wl_host: str, port: int, callback: PacketCallback):
-        self.broadcasting_wl_host = broadcasting_wl_host
-        self.port = port
+
+class BroadcastSubscription(object):
+    """Interest of a callback in the broadcasts of a single device"""
+
+    def __init__(self, host: str, callback: PacketCallback, device_id: Optional[str] = None):
+        self.host = host
         self.callback = callback
 
+        self.address = gethostbyname(host)
+        self.device_id = device_id
+
+        self.last_receive_time: Optional[float] = None
+        self.receive_gap = metrics.histogram(metrics.UDP_GAP_SECONDS, metrics.GAP_BUCKETS, host=host)
+
+    def __repr__(self):
+        return "%s(host=%s, address=%s, device_id=%s)" % (
+            type(self).__name__, self.host, self.address, self.device_id)
+
+
+class BroadcastDispatcher(object):
+    """
+    Dispatch UDP broadcasts received on a single port to the subscribed devices
+
+    Datagrams are dispatched by the device id contained in them. Device ids are learned from the first datagram
+    sent from the address of each subscribed device, unless the device id was configured. Datagrams from other
+    addresses are only accepted for configured device ids (e.g. when the device is behind NAT).
+
+    The device id is extracted from the raw datagram, so datagrams of devices nobody is interested in are dropped
+    without decoding them. This keeps the decoding work proportional to the count of subscribed devices instead of
+    the count of devices broadcasting on the network.
+    """
+
+    def __init__(self, port: int):
+        self.port = port
+
+        self._subscriptions: List[BroadcastSubscription] = []
+        self._subscriptions_by_device_id: Dict[str, BroadcastSubscription] = dict()
+        self._lock = threading.Lock()
+
+        self._received = metrics.counter(metrics.UDP_RECEIVED, port=str(port))
+        self._decoded = metrics.counter(metrics.UDP_DECODED, port=str(port))
+        self._dropped = metrics.counter(metrics.UDP_DROPPED, port=str(port))
+        self._errors = metrics.counter(metrics.UDP_ERRORS, port=str(port))
+
+    @property
+    def has_subscriptions(self) -> bool:
+        return len(self._subscriptions) > 0
+
+    def subscribe(self, subscription: BroadcastSubscription):
+        log.debug("Subscribing to broadcasts on port %d: %r", self.port, subscription)
+        with self._lock:
+            self._subscriptions.append(subscription)
+            if subscription.device_id is not None:
+                self._subscriptions_by_device_id[subscription.device_id] = subscription
+
+    def unsubscribe(self, callback: PacketCallback):
+        with self._lock:
+            removed = [subscription for subscription in self._subscriptions if subscription.callback is callback]
+            self._subscriptions = [subscription for subscription in self._subscriptions
+                                   if subscription.callback is not callback]
+            for subscription in removed:
+                log.debug("Unsubscribing from broadcasts on port %d: %r", self.port, subscription)
+                self._subscriptions_by_device_id.pop(subscription.device_id, None)
+
+    def _find_subscription(self, data: json_decoder.BytesLike, source_addr) -> Optional[BroadcastSubscription]:
+        match = _DEVICE_ID_PATTERN.search(data)
+        device_id = match.group(1).decode("utf-8", "replace") if match is not None else None
+
+        # Fast path: device already known
+        subscription = self._subscriptions_by_device_id.get(device_id)
+        if subscription is not None:
+            return subscription
+
+        with self._lock:
+            candidates = [subscription for subscription in self._subscriptions
+                          if subscription.device_id is None and subscription.address == source_addr[0]]
+            if not candidates:
+                return None
+
+            subscription = candidates[0]
+            if device_id is None:
+                return subscription
+
+            log.info("Learned device id %s of %s from %s", device_id, subscription.host, source_addr[0])
+            subscription.device_id = device_id
+            self._subscriptions_by_device_id[device_id] = subscription
+            return subscription
+
+    def dispatch(self, data: json_decoder.BytesLike, source_addr):
+        self._received.inc()
+
+        subscription = self._find_subscription(data, source_addr)
+        if subscription is None:
+            self._dropped.inc()
+            log.debug("Ignoring broadcast from %s", source_addr[0])
+            return
+
+        now = time.monotonic()
+        if subscription.last_receive_time is not None:
+            subscription.receive_gap.observe(now - subscription.last_receive_time)
+        subscription.last_receive_time = now
+
+        capture.record_broadcast(subscription.host, data)
+        try:
+            try:
+                json_data = json_decoder.loads(data)
+            except ValueError as e:
+                raise WeeWxIOError("Error decoding broadcast packet JSON from %s: %s" % (source_addr[0], e)) from e
+
+            packet = WlUdpBroadcastPacket.try_create(json_data, subscription.host)
+        except Exception as e:
+            self._errors.inc()
+            subscription.callback.on_packet_receive_error(e)
+            return
+        self._decoded.inc()
+        subscription.callback.on_packet_received(packet)
+
+    def dispatch_error_to_all(self, e: BaseException):
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            subscription.callback.on_packet_receive_error(e)
+
+
+class WllBroadcastReceiver(BroadcastDispatcher):
+    """Receive UDP broadcasts from WeatherLink Live devices on a single port using a thread"""
+
+    def __init__(self, port: int):
+        super().__init__(port)
+
         self.wait_timeout = 5
 
         self.sock = None
+        self.buffer = bytearray(RECEIVE_BUFFER_SIZE)
 
         self.stop_signal = threading.Event()
-        self.thread = threading.Thread(name='WLL-BroadcastReception', target=self._reception)
+        self.thread = threading.Thread(name='WLL-BroadcastReception-%d' % port, target=self._reception)
         self.thread.daemon = True
         self.thread.start()
 
     def _reception(self):
-        log.debug("Starting broadcast reception")
+        log.debug("Starting broadcast reception on port %d", self.port)
         try:
             self.sock = socket(AF_INET, SOCK_DGRAM)
             self.sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
@@ -62,27 +191,24 @@ class WllBroadcastReceiver(object):
                 if not r:
                     continue
 
-                data, source_addr = self.sock.recvfrom(2048)
-                log.debug("Received %d bytes from %s" % (len(data), source_addr))
-                try:
-                    json_data = json.loads(data.decode("utf-8"))
-                except JSONDecodeError as e:
-                    raise WeeWxIOError("Error decoding broadcast packet JSON") from e
-
-                packet = WlUdpBroadcastPacket.try_create(json_data, self.broadcasting_wl_host)
-                self.callback.on_packet_received(packet)
+                # Receive into a re-used buffer. Datagrams are dispatched before the next one is received
+                size, source_addr = self.sock.recvfrom_into(self.buffer)
+                log.debug("Received %d bytes from %s", size, source_addr)
+                with memoryview(self.buffer) as view:
+                    self.dispatch(view[:size], source_addr)
 
         except Exception as e:
-            self.callback.on_packet_receive_error(e)
+            self.dispatch_error_to_all(e)
             raise e
 
     def close(self):
-        log.debug("Stopping broadcast reception")
+        log.debug("Stopping broadcast reception on port %d", self.port)
         self.stop_signal.set()
-        self.thread.join(self.wait_timeout * 3)
+        if threading.current_thread() is not self.thread:
+            self.thread.join(self.wait_timeout * 3)
 
-        if self.thread.is_alive():
-            log.warn("Broadcast reception thread still alive. Force closing socket")
+        if self.thread.is_alive() and threading.current_thread() is not self.thread:
+            log.warning("Broadcast reception thread still alive. Force closing socket")
 
         if self.sock is not None:
             self.sock.close()
@@ -90,3 +216,37 @@ class WllBroadcastReceiver(object):
             log.debug("Closed broadcast receiving socket")
 
         log.debug("Stopped broadcast reception")
+
+
+_receivers: Dict[int, WllBroadcastReceiver] = dict()
+_receivers_lock = threading.Lock()
+
+
+def subscribe(port: int, host: str, callback: PacketCallback,
+              device_id: Optional[str] = None) -> BroadcastSubscription:
+    """Subscribe to broadcasts of a device, sharing one receiving socket per port"""
+
+    subscription = BroadcastSubscription(host, callback, device_id)
+    with _receivers_lock:
+        receiver = _receivers.get(port)
+        if receiver is None or not receiver.thread.is_alive():
+            receiver = WllBroadcastReceiver(port)
+            _receivers[port] = receiver
+        receiver.subscribe(subscription)
+    return subscription
+
+
+def unsubscribe(port: int, callback: PacketCallback):
+    """Unsubscribe from broadcasts. The receiving socket is closed when no subscriptions are left"""
+
+    with _receivers_lock:
+        receiver = _receivers.get(port)
+        if receiver is None:
+            return
+
+        receiver.unsubscribe(callback)
+        if receiver.has_subscriptions:
+            return
+        del _receivers[port]
+
+    receiver.close()
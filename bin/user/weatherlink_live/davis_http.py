@@ -22,48 +22,104 @@ import time
 from typing import Optional
 
 import requests
+from requests.adapters import HTTPAdapter
 
+from user.weatherlink_live import capture, json_decoder, metrics
 from user.weatherlink_live.packets import WlHttpBroadcastStartRequestPacket, WlHttpConditionsRequestPacket
-from weewx import WeeWxIOError
 
 log = logging.getLogger(__name__)
 
 
-def start_broadcast(host: str, duration, timeout: float = 5):
-    error: Optional[Exception] = None
+class HttpSession(object):
+    """Pooled HTTP session to a single device, re-using connections between requests"""
 
-    for i in range(3):
-        try:
-            r = requests.get("http://%s:80/v1/real_time?duration=%d" % (host, duration), timeout=timeout)
-            json = r.json()
-            return WlHttpBroadcastStartRequestPacket.try_create(json, host)
-        except Exception as e:
-            error = e
-            log.error(e)
-            log.error("HTTP broadcast start request failed. Retry #%d follows shortly" % i)
-        time.sleep(2.5)
+    def __init__(self, pool_size: int = 1, keep_alive: bool = True):
+        if pool_size < 1:
+            raise ValueError("HTTP pool size must not be less than 1 (got: %d)" % pool_size)
 
-    if error is not None:
-        raise error
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
 
-    raise WeeWxIOError("HTTP broadcast start request failed without setting an error")
+        self._session: Optional[requests.Session] = None
 
+    def _get_session(self) -> requests.Session:
+        if self._session is None:
+            log.debug("Creating HTTP session (pool size: %d, keep-alive: %s)", self.pool_size, self.keep_alive)
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+            session.mount("http://", adapter)
+            if not self.keep_alive:
+                session.headers['Connection'] = 'close'
+            self._session = session
+        return self._session
 
-def request_current(host: str, timeout: float = 5):
-    error: Optional[Exception] = None
+    def get(self, url: str, timeout: float) -> requests.Response:
+        return self._get_session().get(url, timeout=timeout)
 
-    for i in range(3):
-        try:
-            r = requests.get("http://%s:80/v1/current_conditions" % host, timeout=timeout)
-            json = r.json()
-            return WlHttpConditionsRequestPacket.try_create(json, host)
-        except Exception as e:
-            error = e
-            log.error(e)
-            log.error("HTTP conditions request failed. Retry #%d follows shortly" % i)
-        time.sleep(2.5)
+    def reset(self):
+        """Drop all pooled connections. A new connection is opened with the next request"""
 
-    if error is not None:
-        raise error
+        if self._session is None:
+            return
+        log.debug("Resetting HTTP session")
+        self._session.close()
+        self._session = None
 
-    raise WeeWxIOError("HTTP conditions request failed without setting an error")
+    def close(self):
+        self.reset()
+
+
+def _get(session: Optional[HttpSession], url: str, timeout: float) -> requests.Response:
+    if session is None:
+        return requests.get(url, timeout=timeout)
+    return session.get(url, timeout=timeout)
+
+
+def _reset(session: Optional[HttpSession]):
+    if session is not None:
+        session.reset()
+
+
+def _get_json(session: Optional[HttpSession], host: str, path: str, timeout: float):
+    endpoint = path.split("?", 1)[0]
+    start_time = time.perf_counter()
+    try:
+        r = _get(session, "http://%s:80%s" % (host, path), timeout)
+        capture.record_http(host, path, r.content)
+        json = json_decoder.loads(r.content)
+    except Exception:
+        metrics.counter(metrics.HTTP_ERRORS, endpoint=endpoint).inc()
+        raise
+    finally:
+        metrics.histogram(metrics.HTTP_REQUEST_SECONDS, endpoint=endpoint).observe(time.perf_counter() - start_time)
+    return json
+
+
+def start_broadcast(host: str, duration, timeout: float = 5, session: Optional[HttpSession] = None):
+    """
+    Request UDP broadcasts from the device
+
+    Only a single attempt is made. Retrying is left to the caller (see scheduler).
+    """
+
+    try:
+        json = _get_json(session, host, "/v1/real_time?duration=%d" % duration, timeout)
+        return WlHttpBroadcastStartRequestPacket.try_create(json, host)
+    except Exception:
+        _reset(session)
+        raise
+
+
+def request_current(host: str, timeout: float = 5, session: Optional[HttpSession] = None):
+    """
+    Request current conditions from the device
+
+    Only a single attempt is made. Retrying is left to the caller (see scheduler).
+    """
+
+    try:
+        json = _get_json(session, host, "/v1/current_conditions", timeout)
+        return WlHttpConditionsRequestPacket.try_create(json, host)
+    except Exception:
+        _reset(session)
+        raise
@@ -0,0 +1,131 @@
+# Copyright © 2020-2021 Michael Schantl and contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+OpenMetrics endpoint
+
+Serves the metrics of the driver in the OpenMetrics text format (understood by Prometheus) on /metrics.
+"""
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+
+from user.weatherlink_live.metrics import MetricsRegistry, Labels, KIND_COUNTER, KIND_HISTOGRAM
+
+log = logging.getLogger(__name__)
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+METRICS_PATH = "/metrics"
+
+
+def _format_value(value: float) -> str:
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, int):
+        return str(value)
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_sample(name: str, labels: Labels, value: float) -> str:
+    if not labels:
+        return "%s %s" % (name, _format_value(value))
+    formatted_labels = ",".join(['%s="%s"' % (key, _escape(label_value)) for key, label_value in labels])
+    return "%s{%s} %s" % (name, formatted_labels, _format_value(value))
+
+
+def format_openmetrics(registry: MetricsRegistry) -> str:
+    lines: List[str] = []
+    family = None
+    for name, labels, metric in registry.collect():
+        kind = metric.kind
+        family_name = name[:-len("_total")] if kind == KIND_COUNTER and name.endswith("_total") else name
+        if family_name != family:
+            lines.append("# TYPE %s %s" % (family_name, kind))
+            family = family_name
+
+        if kind == KIND_HISTOGRAM:
+            for bound, count in metric.cumulative_counts():
+                lines.append(_format_sample(name + "_bucket", labels + (("le", _format_value(bound)),), count))
+            lines.append(_format_sample(name + "_count", labels, metric.count))
+            lines.append(_format_sample(name + "_sum", labels, metric.sum))
+            continue
+
+        value = metric.value
+        if value is None:
+            continue
+        sample_name = family_name + "_total" if kind == KIND_COUNTER else name
+        lines.append(_format_sample(sample_name, labels, value))
+
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsExporter(object):
+    """Serve metrics over HTTP using a thread"""
+
+    def __init__(self, registry: MetricsRegistry, address: str, port: int):
+        self.registry = registry
+        self.address = address
+        self.port = port
+
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        registry = self.registry
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != METRICS_PATH:
+                    self.send_error(404)
+                    return
+
+                body = format_openmetrics(registry).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                log.debug("%s - " + format, self.address_string(), *args)
+
+        self._server = ThreadingHTTPServer((self.address, self.port), _Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(name="WLL-MetricsExporter", target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        log.info("Serving metrics on http://%s:%d%s", self.address or "0.0.0.0", self.port, METRICS_PATH)
+
+    def close(self):
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._server = None
+        self._thread = None
+        log.debug("Stopped metrics exporter")
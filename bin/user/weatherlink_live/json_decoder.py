@@ -0,0 +1,100 @@
+# Copyright © 2020-2021 Michael Schantl and contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Pluggable JSON decoder
+
+Uses orjson or ujson if installed, otherwise the json module of the standard library.
+All decoders take the raw bytes (or a memoryview of them) and raise a ValueError (or a subclass of it) on invalid
+input, which includes invalid UTF-8.
+"""
+import json
+from typing import Any, Callable, Tuple, Union
+
+from user.weatherlink_live.static.config import JSON_DECODER_AUTO, JSON_DECODER_ORJSON, JSON_DECODER_UJSON, \
+    JSON_DECODER_JSON
+
+BytesLike = Union[bytes, bytearray, memoryview]
+
+
+def _create_orjson() -> Callable[[BytesLike], Any]:
+    import orjson
+
+    # orjson accepts bytes, bytearray and memoryview directly
+    return orjson.loads
+
+
+def _create_ujson() -> Callable[[BytesLike], Any]:
+    import ujson
+
+    def loads(data: BytesLike) -> Any:
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        return ujson.loads(data)
+
+    return loads
+
+
+def _create_json() -> Callable[[BytesLike], Any]:
+    def loads(data: BytesLike) -> Any:
+        # The json module decodes to str internally anyway. Decoding the buffer directly avoids copying it to bytes
+        # and detecting the encoding first
+        return json.loads(str(data, "utf-8"))
+
+    return loads
+
+
+DECODERS = {
+    JSON_DECODER_ORJSON: _create_orjson,
+    JSON_DECODER_UJSON: _create_ujson,
+    JSON_DECODER_JSON: _create_json
+}
+
+# Order of preference when automatically selecting a decoder
+_AUTO_ORDER = [JSON_DECODER_ORJSON, JSON_DECODER_UJSON, JSON_DECODER_JSON]
+
+
+def create_decoder(name: str = JSON_DECODER_AUTO) -> Tuple[str, Callable[[BytesLike], Any]]:
+    """Create a decoder by name. Returns the name of the selected decoder and its loads function"""
+
+    if name == JSON_DECODER_AUTO:
+        for candidate in _AUTO_ORDER:
+            try:
+                return candidate, DECODERS[candidate]()
+            except ImportError:
+                continue
+
+    try:
+        decoder_init = DECODERS[name]
+    except KeyError as e:
+        raise KeyError("Unknown JSON decoder: %s" % repr(name)) from e
+
+    return name, decoder_init()
+
+
+decoder_name, loads = create_decoder(JSON_DECODER_AUTO)
+
+
+def use_decoder(name: str = JSON_DECODER_AUTO) -> str:
+    """Select the decoder used by loads. Returns the name of the selected decoder"""
+
+    global decoder_name, loads
+    decoder_name, loads = create_decoder(name)
+    return decoder_name
@@ -22,18 +22,43 @@
 Mappings of API to observations
 """
 import logging
-from typing import Dict, List, Optional
+import threading
+import time
+from operator import itemgetter
+from typing import Dict, List, Optional, Tuple, Callable, Any, Set
 
+from user.weatherlink_live import aqi, metrics
 from user.weatherlink_live.packets import NotInPacket, DavisConditionsPacket
+from user.weatherlink_live.rolling import RollingMean, RollingWindow, RollingVectorMean
+from user.weatherlink_live.tracing import PacketTracer
 from user.weatherlink_live.static import PacketSource, targets
 from user.weatherlink_live.static.packets import DataStructureType, KEY_TEMPERATURE, KEY_HUMIDITY, KEY_DEW_POINT, \
-    KEY_HEAT_INDEX, KEY_WET_BULB, KEY_WIND_DIR, KEY_RAIN_AMOUNT_DAILY, KEY_RAIN_SIZE, KEY_RAIN_RATE, \
+    KEY_HEAT_INDEX, KEY_WET_BULB, KEY_WIND_DIR, KEY_RAIN_AMOUNT_DAILY, KEY_RAIN_AMOUNT_YEARLY, KEY_RAIN_SIZE, KEY_RAIN_RATE, \
     KEY_SOLAR_RADIATION, KEY_UV_INDEX, KEY_WIND_CHILL, KEY_THW_INDEX, KEY_THSW_INDEX, KEY_SOIL_MOISTURE, \
     KEY_TEMPERATURE_LEAF_SOIL, KEY_LEAF_WETNESS, KEY_TEMPERATURE_INDOOR, KEY_HUMIDITY_INDOOR, KEY_DEW_POINT_INDOOR, \
-    KEY_HEAT_INDEX_INDOOR, KEY_BARO_ABSOLUTE, KEY_BARO_SEA_LEVEL, KEY_WIND_SPEED, KEY_BATTERY_FLAG
+    KEY_HEAT_INDEX_INDOOR, KEY_BARO_ABSOLUTE, KEY_BARO_SEA_LEVEL, KEY_WIND_SPEED, KEY_BATTERY_FLAG, KEY_TS, \
+    KEY_TRANSMITTER_ID, KEY_DATA_STRUCTURE_TYPE, KEY_LSID, KEY_PM_1_LAST, KEY_PM_2P5_LAST, KEY_PM_10_LAST, KEY_PM_1, \
+    KEY_PM_2P5, KEY_PM_2P5_1_HOUR, KEY_PM_2P5_3_HOURS, KEY_PM_2P5_24_HOURS, KEY_PM_2P5_NOWCAST, KEY_PM_10, \
+    KEY_PM_10_1_HOUR, KEY_PM_10_3_HOURS, KEY_PM_10_24_HOURS, KEY_PM_10_NOWCAST, KEY_PM_10_LEGACY_PREFIX
 
 log = logging.getLogger(__name__)
 
+PlanEntry = Tuple[Optional[DataStructureType], Optional[int], str, str, Optional[Callable[[Any], Any]]]
+"""Single mapping step: (data structure type, tx id, source key, target key, transform)"""
+
+FieldKey = Tuple[Optional[DataStructureType], Optional[int], str]
+"""Key of a single conditions field: (data structure type, tx id, field)"""
+
+_MISSING = object()
+
+# 0: Reserved, 1: 0.01", 2: 0.2 mm, 3:  0.1 mm, 4: 0.001"
+RAIN_BUCKET_SIZES = {
+    1: 0.01,
+    4: 0.001,
+    2: (1 / 25.4) * 0.2,
+    3: (1 / 25.4) * 0.1
+}
+
 
 def _parse_option_boolean(opts: list, check_for: str) -> bool:
     if len(opts) < 1:
@@ -54,27 +79,38 @@ class AbstractMapping(object):
         self.log_error = log_error
 
         self.targets = self.__search_multi_targets(self._map_target_dict, used_map_targets)
-        self._log("Mapping targets: %s" % repr(self.targets))
+        self._log("Mapping targets: %r", self.targets)
 
     def __str__(self):
         return "%s[%s]" % (type(self).__name__, self.mapping_opts)
 
-    def _log(self, message: str, level: int = logging.DEBUG):
-        log.log(level, "%s: %s" % (str(self), message))
+    def _log(self, message: str, *args, level: int = logging.DEBUG):
+        """Log a message formatted using args. Nothing is formatted if the level is disabled"""
+        if not log.isEnabledFor(level):
+            return
+        log.log(level, "%s: " + message, self, *args)
 
     def _log_mapping_success(self, target: str, value: float = None):
         if self.log_success:
-            self._log("Mapped: %s=%s" % (target, repr(value)))
+            self._log("Mapped: %s=%r", target, value)
 
     def _log_mapping_notResponsible(self, message: str):
         """Logged when the mapper doesn't feel responsible for a packet"""
         if self.log_success:  # because this is part of normal operation
-            self._log("Mapping not responsible: %s" % message)
+            self._log("Mapping not responsible: %s", message)
 
     def _log_mapping_notInPacket(self):
         if self.log_success:  # because this is part of normal operation
             self._log("Observation not found in packet")
 
+    def get_state(self) -> Optional[dict]:
+        """State to keep across restarts. None if the mapping is stateless"""
+        return None
+
+    def set_state(self, state: dict):
+        """Restore state returned by get_state()"""
+        pass
+
     def _parse_option_int(self, opts: list, index: int) -> int:
         try:
             return int(opts[index])
@@ -114,14 +150,29 @@ class AbstractMapping(object):
             pass
 
     def _do_mapping(self, packet: DavisConditionsPacket, record: dict):
-        pass
+        entries = self.plan_entries(packet.data_source)
+        if entries is None:
+            return
+
+        for dst, tx, source_key, target_key, transform in entries:
+            value = packet.get_observation(source_key, dst, tx)
+            self._set_record_entry(record, target_key, value if transform is None else transform(value))
+
+    def plan_entries(self, source: PacketSource) -> Optional[List[PlanEntry]]:
+        """
+        Stateless mapping steps of this mapper for packets of the given source
+
+        Mappers returning None (e.g. because they keep state between packets) are not compiled into a
+        MappingPlan and have to implement _do_mapping instead.
+        """
+        return None
 
     @property
     def _map_target_dict(self) -> Dict[str, List[str]]:
         raise NotImplementedError()
 
     def _set_record_entry(self, record: dict, key: str, value: float = None):
-        record.update({key: value})
+        record[key] = value
         self._log_mapping_success(key, value)
 
 
@@ -138,11 +189,10 @@ class TMapping(AbstractMapping):
             't': targets.TEMP
         }
 
-    def _do_mapping(self, packet: DavisConditionsPacket, record: dict):
-        target = self.targets['t']
-
-        self._set_record_entry(record, target,
-                               packet.get_observation(KEY_TEMPERATURE, DataStructureType.ISS, self.tx_id))
+    def plan_entries(self, source: PacketSource) -> Optional[List[PlanEntry]]:
+        return [
+            (DataStructureType.ISS, self.tx_id, KEY_TEMPERATURE, self.targets['t'], None)
+        ]
 
 
 class THMapping(AbstractMapping):
@@ -161,23 +211,14 @@ class THMapping(AbstractMapping):
             'wb': targets.WET_BULB
         }
 
-    def _do_mapping(self, packet: DavisConditionsPacket, record: dict):
-        target_t = self.targets['t']
-        target_h = self.targets['h']
-        target_dp = self.targets['dp']
-        target_hi = self.targets['hi']
-        target_wb = self.targets['wb']
-
-        self._set_record_entry(record, target_t,
-                               packet.get_observation(KEY_TEMPERATURE, DataStructureType.ISS, self.tx_id))
-        self._set_record_entry(record, target_h,
-                               packet.get_observation(KEY_HUMIDITY, DataStructureType.ISS, self.tx_id))
-        self._set_record_entry(record, target_dp,
-                               packet.get_observation(KEY_DEW_POINT, DataStructureType.ISS, self.tx_id))
-        self._set_record_entry(record, target_hi,
-                               packet.get_observation(KEY_HEAT_INDEX, DataStructureType.ISS, self.tx_id))
-        self._set_record_entry(record, target_wb,
-                               packet.get_observation(KEY_WET_BULB, DataStructureType.ISS, self.tx_id))
+    def plan_entries(self, source: PacketSource) -> Optional[List[PlanEntry]]:
+        return [
+            (DataStructureType.ISS, self.tx_id, KEY_TEMPERATURE, self.targets['t'], None),
+            (DataStructureType.ISS, self.tx_id, KEY_HUMIDITY, self.targets['h'], None),
+            (DataStructureType.ISS, self.tx_id, KEY_DEW_POINT, self.targets['dp'], None),
+            (DataStructureType.ISS, self.tx_id, KEY_HEAT_INDEX, self.targets['hi'], None),
+            (DataStructureType.ISS, self.tx_id, KEY_WET_BULB, self.targets['wb'], None)
+        ]
 
 
 class WindMapping(AbstractMapping):
@@ -200,30 +241,60 @@ class WindMapping(AbstractMapping):
             self._log_mapping_notResponsible("Not a broadcast packet")
             return
 
-        target_dir = self.targets['wind_dir']
-        target_speed = self.targets['wind_speed']
+        super()._do_mapping(packet, record)
+
+    def plan_entries(self, source: PacketSource) -> Optional[List[PlanEntry]]:
+        if source != PacketSource.WEATHER_PUSH:
+            return []
 
-        self._set_record_entry(record, target_dir,
-                               packet.get_observation(KEY_WIND_DIR, DataStructureType.ISS, self.tx_id))
-        self._set_record_entry(record, target_speed,
-                               packet.get_observation(KEY_WIND_SPEED, DataStructureType.ISS, self.tx_id))
+        return [
+            (DataStructureType.ISS, self.tx_id, KEY_WIND_DIR, self.targets['wind_dir'], None),
+            (DataStructureType.ISS, self.tx_id, KEY_WIND_SPEED, self.targets['wind_speed'], None)
+        ]
 
 
 class RainMapping(AbstractMapping):
+    """
+    Rain amount since the last packet, calculated from the daily count of spoon trips
+
+    Broadcasts are diffed against the daily count of the previous packet. Counts missed by broadcasts (e.g. while
+    broadcasts were interrupted, or between the last broadcast before and the first one after midnight) are added
+    to the next polled record: the yearly count of each poll is compared with the counts emitted since the poll
+    before. Daily counts of packets not newer than the last packet used are ignored, yearly counts of such polls
+    are still reconciled.
+    """
+
     def __init__(self, mapping_opts: list, used_map_targets: list, log_success: bool = False, log_error: bool = True):
         super().__init__(mapping_opts, used_map_targets, log_success, log_error)
 
-        # 0: Reserved, 1: 0.01", 2: 0.2 mm, 3:  0.1 mm, 4: 0.001"
-        self.rain_bucket_sizes = {
-            1: 0.01,
-            4: 0.001,
-            2: (1 / 25.4) * 0.2,
-            3: (1 / 25.4) * 0.1
-        }
+        self.rain_bucket_sizes = RAIN_BUCKET_SIZES
 
         self.tx_id = self._parse_option_int(mapping_opts, 0)
 
-        self.last_daily_rain_count = None
+        self.last_daily_rain_count: Optional[int] = None
+        self.last_yearly_rain_count: Optional[int] = None
+        # Counts emitted since the yearly count was read
+        self.emitted_rain_count = 0
+        self.last_timestamp: Optional[int] = None
+
+        # Polls and broadcasts may be mapped by different threads
+        self._lock = threading.Lock()
+
+    def get_state(self) -> Optional[dict]:
+        with self._lock:
+            return {
+                'last_daily_rain_count': self.last_daily_rain_count,
+                'last_yearly_rain_count': self.last_yearly_rain_count,
+                'emitted_rain_count': self.emitted_rain_count
+            }
+
+    def set_state(self, state: dict):
+        with self._lock:
+            self.last_daily_rain_count = state.get('last_daily_rain_count')
+            self.last_yearly_rain_count = state.get('last_yearly_rain_count')
+            self.emitted_rain_count = state.get('emitted_rain_count', 0)
+        self._log("Restored last daily rain count: %s, last yearly rain count: %s",
+                  self.last_daily_rain_count, self.last_yearly_rain_count, level=logging.INFO)
 
     @property
     def _map_target_dict(self) -> Dict[str, List[str]]:
@@ -235,11 +306,11 @@ class RainMapping(AbstractMapping):
             'size': targets.RAIN_SIZE,
         }
 
-    def _do_mapping(self, packet: DavisConditionsPacket, record: dict):
-        if packet.data_source != PacketSource.WEATHER_PUSH:
-            self._log_mapping_notResponsible("Not a broadcast packet")
-            return
+    def plan_entries(self, source: PacketSource) -> Optional[List[PlanEntry]]:
+        # Keeps state
+        return None
 
+    def _do_mapping(self, packet: DavisConditionsPacket, record: dict):
         target_amount = self.targets['amount']
         target_rate = self.targets['rate']
         target_count = self.targets['count']
@@ -258,21 +329,86 @@ class RainMapping(AbstractMapping):
             self._log("Daily rain count not in packet. Skipping diff calculation")
             return
 
-        if self.last_daily_rain_count is None:
-            self._log("First daily rain value", logging.INFO)
+        current_yearly_rain_count = None
+        if packet.data_source == PacketSource.WEATHER_POLL:
+            current_yearly_rain_count = packet.get_observation(KEY_RAIN_AMOUNT_YEARLY, DataStructureType.ISS,
+                                                               self.tx_id)
+
+        with self._lock:
+            if self.last_timestamp is None or packet.timestamp > self.last_timestamp:
+                self.last_timestamp = packet.timestamp
+                count_diff = self._diff(current_daily_rain_count, current_yearly_rain_count)
+            elif current_yearly_rain_count is not None and self.last_daily_rain_count is not None and (
+                    packet.timestamp == self.last_timestamp or current_daily_rain_count <= self.last_daily_rain_count):
+                # An older poll with a larger daily count was polled before the daily count was reset
+                self._log("Poll not newer than last packet. Only reconciling yearly count")
+                count_diff = self._reconcile_not_newer(current_yearly_rain_count, current_daily_rain_count)
+            else:
+                self._log("Packet not newer than last packet. Skipping diff calculation")
+                return
+
+        if count_diff is None:
+            return
+        self._set_record_entry(record, target_count, count_diff)
+        self._set_record_entry(record, target_amount, self._multiply(count_diff, rain_bucket_factor))
+
+    def _diff(self, current_daily_rain_count: int, current_yearly_rain_count: Optional[int]) -> Optional[int]:
+        count_diff = self._daily_diff(current_daily_rain_count)
+        if current_yearly_rain_count is not None:
+            missed = self._reconcile(current_yearly_rain_count, count_diff or 0)
+            if missed > 0:
+                count_diff = (count_diff or 0) + missed
+        elif count_diff is not None:
+            self.emitted_rain_count += count_diff
+        return count_diff
+
+    def _reconcile_not_newer(self, current_yearly_rain_count: int, current_daily_rain_count: int) -> Optional[int]:
+        """
+        Reconcile the yearly count of a poll not newer than the last packet (e.g. polled within the same second as
+        the last broadcast). Its daily count isn't diffed: counts it contains beyond the last daily count are
+        emitted by the next packet, and counts emitted already beyond it are in the next yearly count
+        """
+
+        pending = current_daily_rain_count - self.last_daily_rain_count
+        missed = self._reconcile(current_yearly_rain_count, pending)
+        self.emitted_rain_count = -pending
+        return missed if missed > 0 else None
+
+    def _daily_diff(self, current_daily_rain_count: int) -> Optional[int]:
+        last_daily_rain_count = self.last_daily_rain_count
+        self.last_daily_rain_count = current_daily_rain_count
+
+        if last_daily_rain_count is None:
+            self._log("First daily rain value", level=logging.INFO)
+            return None
+
+        if last_daily_rain_count > current_daily_rain_count:
+            self._log("Last daily rain (%d) larger than current (%d). Probably reset",
+                      last_daily_rain_count, current_daily_rain_count, level=logging.INFO)
+            return current_daily_rain_count
 
-        elif self.last_daily_rain_count > current_daily_rain_count:
-            self._log("Last daily rain (%d) larger than current (%d). Probably reset" % (
-                self.last_daily_rain_count, current_daily_rain_count), logging.INFO)
-            self._set_record_entry(record, target_count, current_daily_rain_count)
-            self._set_record_entry(record, target_amount, self._multiply(current_daily_rain_count, rain_bucket_factor))
+        return current_daily_rain_count - last_daily_rain_count
 
-        else:
-            count_diff = current_daily_rain_count - self.last_daily_rain_count
-            self._set_record_entry(record, target_count, count_diff)
-            self._set_record_entry(record, target_amount, self._multiply(count_diff, rain_bucket_factor))
+    def _reconcile(self, current_yearly_rain_count: int, count_diff: int) -> int:
+        """Counts missed since the last poll, which are not included in the count diff of this poll"""
 
-        self.last_daily_rain_count = current_daily_rain_count
+        last_yearly_rain_count = self.last_yearly_rain_count
+        emitted_rain_count = self.emitted_rain_count + count_diff
+        self.last_yearly_rain_count = current_yearly_rain_count
+        self.emitted_rain_count = 0
+
+        if last_yearly_rain_count is None:
+            return 0
+
+        missed = current_yearly_rain_count - last_yearly_rain_count - emitted_rain_count
+        if missed > 0:
+            self._log("Adding %d rain counts missed since last poll", missed, level=logging.INFO)
+            return missed
+        if missed < 0:
+            # E.g. yearly count reset
+            self._log("Counted %d more than the yearly rain count since last poll. Resynchronizing", -missed,
+                      level=logging.INFO)
+        return 0
 
     @staticmethod
     def _multiply(a: Optional[float], b: Optional[float]) -> Optional[float]:
@@ -281,52 +417,145 @@ class RainMapping(AbstractMapping):
         return a * b
 
     def rain_bucket_factor(self, packet) -> Optional[float]:
-        rain_bucket_size = packet.get_observation(KEY_RAIN_SIZE, DataStructureType.ISS, self.tx_id)
-        if rain_bucket_size is None:
-            return None
+        return _rain_bucket_factor(packet, self.tx_id)
 
-        try:
-            return self.rain_bucket_sizes[rain_bucket_size]
-        except KeyError as e:
-            raise KeyError("Unexpected rain bucket size %s" % repr(rain_bucket_size))
 
+def _rain_bucket_factor(packet: DavisConditionsPacket, tx_id: int) -> Optional[float]:
+    rain_bucket_size = packet.get_observation(KEY_RAIN_SIZE, DataStructureType.ISS, tx_id)
+    if rain_bucket_size is None:
+        return None
+
+    try:
+        return RAIN_BUCKET_SIZES[rain_bucket_size]
+    except KeyError as e:
+        raise KeyError("Unexpected rain bucket size %s" % repr(rain_bucket_size))
+
+
+class WindAverageMapping(AbstractMapping):
+    """Rolling mean, minimum and maximum of the wind speed and mean wind direction of broadcasts"""
 
-class SolarMapping(AbstractMapping):
     def __init__(self, mapping_opts: list, used_map_targets: list, log_success: bool = False, log_error: bool = True):
         super().__init__(mapping_opts, used_map_targets, log_success, log_error)
 
         self.tx_id = self._parse_option_int(mapping_opts, 0)
+        self.window = self._parse_option_int(mapping_opts, 1) if len(mapping_opts) > 1 else 600
+
+        self.speed = RollingWindow(self.window)
+        self.direction = RollingVectorMean(self.window)
 
     @property
     def _map_target_dict(self) -> Dict[str, List[str]]:
         return {
-            'solar': targets.SOLAR_RADIATION
+            'speed_avg': targets.WIND_SPEED_AVG,
+            'dir_avg': targets.WIND_DIR_AVG,
+            'speed_min': targets.WIND_SPEED_MIN,
+            'speed_max': targets.WIND_SPEED_MAX
         }
 
+    def plan_entries(self, source: PacketSource) -> Optional[List[PlanEntry]]:
+        # Keeps state, but only for broadcasts
+        if source != PacketSource.WEATHER_PUSH:
+            return []
+        return None
+
     def _do_mapping(self, packet: DavisConditionsPacket, record: dict):
-        target = self.targets['solar']
+        if packet.data_source != PacketSource.WEATHER_PUSH:
+            self._log_mapping_notResponsible("Not a broadcast packet")
+            return
 
-        self._set_record_entry(record, target,
-                               packet.get_observation(KEY_SOLAR_RADIATION, DataStructureType.ISS, self.tx_id))
+        speed = packet.get_observation(KEY_WIND_SPEED, DataStructureType.ISS, self.tx_id)
+        if speed is None:
+            return
+        direction = packet.get_observation(KEY_WIND_DIR, DataStructureType.ISS, self.tx_id)
 
+        timestamp = packet.timestamp
+        self.speed.add(timestamp, speed)
+        self.direction.add(timestamp, speed, direction)
+
+        self._set_record_entry(record, self.targets['speed_avg'], self.speed.mean)
+        self._set_record_entry(record, self.targets['dir_avg'], self.direction.direction)
+        self._set_record_entry(record, self.targets['speed_min'], self.speed.min)
+        self._set_record_entry(record, self.targets['speed_max'], self.speed.max)
+
+
+class RainRateAverageMapping(AbstractMapping):
+    """Mean rain rate of broadcasts over the last 1, 10 and 15 minutes"""
 
-class UvMapping(AbstractMapping):
     def __init__(self, mapping_opts: list, used_map_targets: list, log_success: bool = False, log_error: bool = True):
         super().__init__(mapping_opts, used_map_targets, log_success, log_error)
 
         self.tx_id = self._parse_option_int(mapping_opts, 0)
 
+        self.rates = dict([
+            (target, RollingMean(minutes * 60))
+            for target, minutes in (('rate_1', 1), ('rate_10', 10), ('rate_15', 15))
+        ])
+
     @property
     def _map_target_dict(self) -> Dict[str, List[str]]:
         return {
-            'uv': targets.UV
+            'rate_1': targets.RAIN_RATE_1,
+            'rate_10': targets.RAIN_RATE_10,
+            'rate_15': targets.RAIN_RATE_15
         }
 
+    def plan_entries(self, source: PacketSource) -> Optional[List[PlanEntry]]:
+        # Keeps state, but only for broadcasts
+        if source != PacketSource.WEATHER_PUSH:
+            return []
+        return None
+
     def _do_mapping(self, packet: DavisConditionsPacket, record: dict):
-        target = self.targets['uv']
+        if packet.data_source != PacketSource.WEATHER_PUSH:
+            self._log_mapping_notResponsible("Not a broadcast packet")
+            return
+
+        rain_rate_count = packet.get_observation(KEY_RAIN_RATE, DataStructureType.ISS, self.tx_id)
+        rain_bucket_factor = _rain_bucket_factor(packet, self.tx_id)
+        if rain_rate_count is None or rain_bucket_factor is None:
+            return
+
+        timestamp = packet.timestamp
+        rain_rate = rain_rate_count * rain_bucket_factor
+        for target, rate in self.rates.items():
+            rate.add(timestamp, rain_rate)
+            self._set_record_entry(record, self.targets[target], rate.mean)
+
+
+class SolarMapping(AbstractMapping):
+    def __init__(self, mapping_opts: list, used_map_targets: list, log_success: bool = False, log_error: bool = True):
+        super().__init__(mapping_opts, used_map_targets, log_success, log_error)
+
+        self.tx_id = self._parse_option_int(mapping_opts, 0)
+
+    @property
+    def _map_target_dict(self) -> Dict[str, List[str]]:
+        return {
+            'solar': targets.SOLAR_RADIATION
+        }
+
+    def plan_entries(self, source: PacketSource) -> Optional[List[PlanEntry]]:
+        return [
+            (DataStructureType.ISS, self.tx_id, KEY_SOLAR_RADIATION, self.targets['solar'], None)
+        ]
+
+
+class UvMapping(AbstractMapping):
+    def __init__(self, mapping_opts: list, used_map_targets: list, log_success: bool = False, log_error: bool = True):
+        super().__init__(mapping_opts, used_map_targets, log_success, log_error)
+
+        self.tx_id = self._parse_option_int(mapping_opts, 0)
+
+    @property
+    def _map_target_dict(self) -> Dict[str, List[str]]:
+        return {
+            'uv': targets.UV
+        }
 
-        self._set_record_entry(record, target,
-                               packet.get_observation(KEY_UV_INDEX, DataStructureType.ISS, self.tx_id))
+    def plan_entries(self, source: PacketSource) -> Optional[List[PlanEntry]]:
+        return [
+            (DataStructureType.ISS, self.tx_id, KEY_UV_INDEX, self.targets['uv'], None)
+        ]
 
 
 class WindChillMapping(AbstractMapping):
@@ -341,11 +570,10 @@ class WindChillMapping(AbstractMapping):
             'windchill': targets.WINDCHILL
         }
 
-    def _do_mapping(self, packet: DavisConditionsPacket, record: dict):
-        target = self.targets['windchill']
-
-        self._set_record_entry(record, target,
-                               packet.get_observation(KEY_WIND_CHILL, DataStructureType.ISS, self.tx_id))
+    def plan_entries(self, source: PacketSource) -> Optional[List[PlanEntry]]:
+        return [
+            (DataStructureType.ISS, self.tx_id, KEY_WIND_CHILL, self.targets['windchill'], None)
+        ]
 
 
 class ThwMapping(AbstractMapping):
@@ -366,16 +594,15 @@ class ThwMapping(AbstractMapping):
         }
         return target_dict
 
-    def _do_mapping(self, packet: DavisConditionsPacket, record: dict):
-        target = self.targets['thw']
-
-        self._set_record_entry(record, target,
-                               packet.get_observation(KEY_THW_INDEX, DataStructureType.ISS, self.tx_id))
+    def plan_entries(self, source: PacketSource) -> Optional[List[PlanEntry]]:
+        entries = [
+            (DataStructureType.ISS, self.tx_id, KEY_THW_INDEX, self.targets['thw'], None)
+        ]
 
         if self.is_app_temp:
-            target_app_temp = self.targets['app_temp']
-            self._set_record_entry(record, target_app_temp,
-                                   packet.get_observation(KEY_THW_INDEX, DataStructureType.ISS, self.tx_id))
+            entries.append((DataStructureType.ISS, self.tx_id, KEY_THW_INDEX, self.targets['app_temp'], None))
+
+        return entries
 
 
 class ThswMapping(AbstractMapping):
@@ -396,16 +623,15 @@ class ThswMapping(AbstractMapping):
         }
         return target_dict
 
-    def _do_mapping(self, packet: DavisConditionsPacket, record: dict):
-        target = self.targets['thsw']
-
-        self._set_record_entry(record, target,
-                               packet.get_observation(KEY_THSW_INDEX, DataStructureType.ISS, self.tx_id))
+    def plan_entries(self, source: PacketSource) -> Optional[List[PlanEntry]]:
+        entries = [
+            (DataStructureType.ISS, self.tx_id, KEY_THSW_INDEX, self.targets['thsw'], None)
+        ]
 
         if self.is_app_temp:
-            target_app_temp = self.targets['app_temp']
-            self._set_record_entry(record, target_app_temp,
-                                   packet.get_observation(KEY_THSW_INDEX, DataStructureType.ISS, self.tx_id))
+            entries.append((DataStructureType.ISS, self.tx_id, KEY_THSW_INDEX, self.targets['app_temp'], None))
+
+        return entries
 
 
 class SoilTempMapping(AbstractMapping):
@@ -421,12 +647,10 @@ class SoilTempMapping(AbstractMapping):
             'soil_temp': targets.SOIL_TEMP
         }
 
-    def _do_mapping(self, packet: DavisConditionsPacket, record: dict):
-        target = self.targets['soil_temp']
-
-        self._set_record_entry(record, target,
-                               packet.get_observation(KEY_TEMPERATURE_LEAF_SOIL % self.sensor,
-                                                      DataStructureType.LEAF_SOIL, self.tx_id))
+    def plan_entries(self, source: PacketSource) -> Optional[List[PlanEntry]]:
+        return [
+            (DataStructureType.LEAF_SOIL, self.tx_id, KEY_TEMPERATURE_LEAF_SOIL % self.sensor, self.targets['soil_temp'], None)
+        ]
 
 
 class SoilMoistureMapping(AbstractMapping):
@@ -442,12 +666,10 @@ class SoilMoistureMapping(AbstractMapping):
             'soil_moisture': targets.SOIL_MOISTURE
         }
 
-    def _do_mapping(self, packet: DavisConditionsPacket, record: dict):
-        target = self.targets['soil_moisture']
-
-        self._set_record_entry(record, target,
-                               packet.get_observation(KEY_SOIL_MOISTURE % self.sensor,
-                                                      DataStructureType.LEAF_SOIL, self.tx_id))
+    def plan_entries(self, source: PacketSource) -> Optional[List[PlanEntry]]:
+        return [
+            (DataStructureType.LEAF_SOIL, self.tx_id, KEY_SOIL_MOISTURE % self.sensor, self.targets['soil_moisture'], None)
+        ]
 
 
 class LeafWetnessMapping(AbstractMapping):
@@ -463,12 +685,10 @@ class LeafWetnessMapping(AbstractMapping):
             'leaf_wetness': targets.LEAF_WETNESS
         }
 
-    def _do_mapping(self, packet: DavisConditionsPacket, record: dict):
-        target = self.targets['leaf_wetness']
-
-        self._set_record_entry(record, target,
-                               packet.get_observation(KEY_LEAF_WETNESS % self.sensor,
-                                                      DataStructureType.LEAF_SOIL, self.tx_id))
+    def plan_entries(self, source: PacketSource) -> Optional[List[PlanEntry]]:
+        return [
+            (DataStructureType.LEAF_SOIL, self.tx_id, KEY_LEAF_WETNESS % self.sensor, self.targets['leaf_wetness'], None)
+        ]
 
 
 class THIndoorMapping(AbstractMapping):
@@ -484,20 +704,13 @@ class THIndoorMapping(AbstractMapping):
             'hi': targets.INDOOR_HEAT_INDEX
         }
 
-    def _do_mapping(self, packet: DavisConditionsPacket, record: dict):
-        target_t = self.targets['t']
-        target_h = self.targets['h']
-        target_dp = self.targets['dp']
-        target_hi = self.targets['hi']
-
-        self._set_record_entry(record, target_t,
-                               packet.get_observation(KEY_TEMPERATURE_INDOOR, DataStructureType.WLL_TH))
-        self._set_record_entry(record, target_h,
-                               packet.get_observation(KEY_HUMIDITY_INDOOR, DataStructureType.WLL_TH))
-        self._set_record_entry(record, target_dp,
-                               packet.get_observation(KEY_DEW_POINT_INDOOR, DataStructureType.WLL_TH))
-        self._set_record_entry(record, target_hi,
-                               packet.get_observation(KEY_HEAT_INDEX_INDOOR, DataStructureType.WLL_TH))
+    def plan_entries(self, source: PacketSource) -> Optional[List[PlanEntry]]:
+        return [
+            (DataStructureType.WLL_TH, None, KEY_TEMPERATURE_INDOOR, self.targets['t'], None),
+            (DataStructureType.WLL_TH, None, KEY_HUMIDITY_INDOOR, self.targets['h'], None),
+            (DataStructureType.WLL_TH, None, KEY_DEW_POINT_INDOOR, self.targets['dp'], None),
+            (DataStructureType.WLL_TH, None, KEY_HEAT_INDEX_INDOOR, self.targets['hi'], None)
+        ]
 
 
 class BaroMapping(AbstractMapping):
@@ -511,14 +724,11 @@ class BaroMapping(AbstractMapping):
             'baro_sl': targets.BARO_SEA_LEVEL
         }
 
-    def _do_mapping(self, packet: DavisConditionsPacket, record: dict):
-        target_abs = self.targets['baro_abs']
-        target_sl = self.targets['baro_sl']
-
-        self._set_record_entry(record, target_abs,
-                               packet.get_observation(KEY_BARO_ABSOLUTE, DataStructureType.WLL_BARO))
-        self._set_record_entry(record, target_sl,
-                               packet.get_observation(KEY_BARO_SEA_LEVEL, DataStructureType.WLL_BARO))
+    def plan_entries(self, source: PacketSource) -> Optional[List[PlanEntry]]:
+        return [
+            (DataStructureType.WLL_BARO, None, KEY_BARO_ABSOLUTE, self.targets['baro_abs'], None),
+            (DataStructureType.WLL_BARO, None, KEY_BARO_SEA_LEVEL, self.targets['baro_sl'], None)
+        ]
 
 
 class BatteryStatusMapping(AbstractMapping):
@@ -539,11 +749,421 @@ class BatteryStatusMapping(AbstractMapping):
             'battery': targets.BATTERY_STATUS
         }
 
-    def _do_mapping(self, packet: DavisConditionsPacket, record: dict):
-        battery_num = self.targets['battery']
+    def plan_entries(self, source: PacketSource) -> Optional[List[PlanEntry]]:
+        return [
+            (None, self.tx_id, KEY_BATTERY_FLAG, target, None)
+            for target
+            in [self.targets['battery']] + self.further_targets
+        ]
+
+
+def _airlink_entries(source_key: str, target_key: str, transform: Optional[Callable[[Any], Any]] = None) \
+        -> List[PlanEntry]:
+    """Mapping steps for both AirLink data structure types. PM10 fields of the legacy type are named differently"""
+
+    legacy_key = source_key
+    if source_key.startswith(KEY_PM_10):
+        legacy_key = KEY_PM_10_LEGACY_PREFIX + source_key[len(KEY_PM_10):]
+    return [
+        (DataStructureType.AIRLINK, None, source_key, target_key, transform),
+        (DataStructureType.AIRLINK_LEGACY, None, legacy_key, target_key, transform)
+    ]
+
+
+class AirLinkTHMapping(AbstractMapping):
+    def __init__(self, mapping_opts: list, used_map_targets: list, log_success: bool = False, log_error: bool = True):
+        super().__init__(mapping_opts, used_map_targets, log_success, log_error)
 
-        self._set_record_entry(record, battery_num,
-                               packet.get_observation(KEY_BATTERY_FLAG, tx=self.tx_id))
-        for target in self.further_targets:
-            self._set_record_entry(record, target,
-                                   packet.get_observation(KEY_BATTERY_FLAG, tx=self.tx_id))
+    @property
+    def _map_target_dict(self) -> Dict[str, List[str]]:
+        return {
+            't': targets.TEMP,
+            'h': targets.HUM,
+            'dp': targets.DEW_POINT,
+            'hi': targets.HEAT_INDEX,
+            'wb': targets.WET_BULB
+        }
+
+    def plan_entries(self, source: PacketSource) -> Optional[List[PlanEntry]]:
+        return _airlink_entries(KEY_TEMPERATURE, self.targets['t']) \
+               + _airlink_entries(KEY_HUMIDITY, self.targets['h']) \
+               + _airlink_entries(KEY_DEW_POINT, self.targets['dp']) \
+               + _airlink_entries(KEY_HEAT_INDEX, self.targets['hi']) \
+               + _airlink_entries(KEY_WET_BULB, self.targets['wb'])
+
+
+class AirLinkPMMapping(AbstractMapping):
+    def __init__(self, mapping_opts: list, used_map_targets: list, log_success: bool = False, log_error: bool = True):
+        super().__init__(mapping_opts, used_map_targets, log_success, log_error)
+
+    @property
+    def _map_target_dict(self) -> Dict[str, List[str]]:
+        return {
+            'pm1': targets.PM1,
+            'pm2p5': targets.PM2p5,
+            'pm10': targets.PM10,
+            'pm1_last': targets.PM1_LAST,
+            'pm2p5_last': targets.PM2p5_LAST,
+            'pm10_last': targets.PM10_LAST
+        }
+
+    def plan_entries(self, source: PacketSource) -> Optional[List[PlanEntry]]:
+        return _airlink_entries(KEY_PM_1, self.targets['pm1']) \
+               + _airlink_entries(KEY_PM_2P5, self.targets['pm2p5']) \
+               + _airlink_entries(KEY_PM_10, self.targets['pm10']) \
+               + _airlink_entries(KEY_PM_1_LAST, self.targets['pm1_last']) \
+               + _airlink_entries(KEY_PM_2P5_LAST, self.targets['pm2p5_last']) \
+               + _airlink_entries(KEY_PM_10_LAST, self.targets['pm10_last'])
+
+
+class AirLinkPMAverageMapping(AbstractMapping):
+    def __init__(self, mapping_opts: list, used_map_targets: list, log_success: bool = False, log_error: bool = True):
+        super().__init__(mapping_opts, used_map_targets, log_success, log_error)
+
+    @property
+    def _map_target_dict(self) -> Dict[str, List[str]]:
+        return {
+            'pm2p5_1h': targets.PM2p5_1_HOUR,
+            'pm2p5_3h': targets.PM2p5_3_HOURS,
+            'pm2p5_24h': targets.PM2p5_24_HOURS,
+            'pm2p5_nowcast': targets.PM2p5_NOWCAST,
+            'pm10_1h': targets.PM10_1_HOUR,
+            'pm10_3h': targets.PM10_3_HOURS,
+            'pm10_24h': targets.PM10_24_HOURS,
+            'pm10_nowcast': targets.PM10_NOWCAST
+        }
+
+    def plan_entries(self, source: PacketSource) -> Optional[List[PlanEntry]]:
+        return _airlink_entries(KEY_PM_2P5_1_HOUR, self.targets['pm2p5_1h']) \
+               + _airlink_entries(KEY_PM_2P5_3_HOURS, self.targets['pm2p5_3h']) \
+               + _airlink_entries(KEY_PM_2P5_24_HOURS, self.targets['pm2p5_24h']) \
+               + _airlink_entries(KEY_PM_2P5_NOWCAST, self.targets['pm2p5_nowcast']) \
+               + _airlink_entries(KEY_PM_10_1_HOUR, self.targets['pm10_1h']) \
+               + _airlink_entries(KEY_PM_10_3_HOURS, self.targets['pm10_3h']) \
+               + _airlink_entries(KEY_PM_10_24_HOURS, self.targets['pm10_24h']) \
+               + _airlink_entries(KEY_PM_10_NOWCAST, self.targets['pm10_nowcast'])
+
+
+class AirLinkAqiMapping(AbstractMapping):
+    """US EPA AQI of the NowCast (default) or 24 hour average concentrations reported by the AirLink"""
+
+    def __init__(self, mapping_opts: list, used_map_targets: list, log_success: bool = False, log_error: bool = True):
+        super().__init__(mapping_opts, used_map_targets, log_success, log_error)
+
+        self.use_24_hours = _parse_option_boolean(mapping_opts, '24h')
+
+    @property
+    def _map_target_dict(self) -> Dict[str, List[str]]:
+        return {
+            'pm2p5': targets.PM2p5_AQI,
+            'pm10': targets.PM10_AQI
+        }
+
+    def plan_entries(self, source: PacketSource) -> Optional[List[PlanEntry]]:
+        key_pm2p5 = KEY_PM_2P5_24_HOURS if self.use_24_hours else KEY_PM_2P5_NOWCAST
+        key_pm10 = KEY_PM_10_24_HOURS if self.use_24_hours else KEY_PM_10_NOWCAST
+        return _airlink_entries(key_pm2p5, self.targets['pm2p5'], aqi.pm2_5_aqi) \
+               + _airlink_entries(key_pm10, self.targets['pm10'], aqi.pm10_aqi)
+
+
+class FieldState(object):
+    """Last value of a conditions field"""
+
+    __slots__ = ('value', 'ts', 'emitted_ts')
+
+    def __init__(self, value: Any, ts: int):
+        self.value = value
+        self.ts = ts
+        self.emitted_ts: Optional[int] = None
+
+    def __repr__(self):
+        return "%s(value=%s, ts=%s, emitted_ts=%s)" % (type(self).__name__, repr(self.value), self.ts, self.emitted_ts)
+
+
+class PlanGroup(object):
+    """Mapping steps of a single conditions record, identified by data structure type and tx id"""
+
+    __slots__ = ('dst', 'tx', 'steps', 'keys', '_getter')
+
+    def __init__(self, dst: Optional[DataStructureType], tx: Optional[int], steps: List[tuple]):
+        self.dst = dst
+        self.tx = tx
+        self.steps = steps
+        self.keys = tuple(dict.fromkeys([source_key for source_key, _, _ in steps]))
+        self._getter = itemgetter(*self.keys) if len(self.keys) > 1 else None
+
+    def values(self, conditions: dict) -> tuple:
+        """Raw values of all keys of this group; missing values are replaced by a marker"""
+
+        if self._getter is not None:
+            try:
+                return self._getter(conditions)
+            except KeyError:
+                # Some keys aren't sent by this source at all
+                self._getter = None
+        return tuple([conditions.get(key, _MISSING) for key in self.keys])
+
+    def __repr__(self):
+        return "%s(dst=%s, tx=%s, steps=%s)" % (type(self).__name__, repr(self.dst), repr(self.tx), repr(self.steps))
+
+
+class _BlockState(object):
+    """Last raw and mapped values of a conditions record"""
+
+    __slots__ = ('sensor_ts', 'values', 'mapped', 'fields')
+
+    def __init__(self, fields: List[FieldState]):
+        self.sensor_ts = None
+        self.values: Optional[tuple] = None
+        self.mapped: dict = dict()
+        self.fields = fields
+
+
+class FreshnessCache(object):
+    """
+    Last values of the conditions fields mapped from packets of a single source
+
+    Values are kept by data structure type, tx id and field together with the timestamp they last changed at. The
+    timestamp of the sensor is used if a conditions record has one, the timestamp of the packet otherwise.
+
+    Unchanged fields are left out of records unless they haven't been emitted for omit_unchanged seconds. Conditions
+    records which didn't change since the previous packet aren't mapped again; the values mapped before are re-used.
+
+    Not thread-safe: each source is only mapped from a single thread.
+    """
+
+    def __init__(self, omit_unchanged: float):
+        self.omit_unchanged = omit_unchanged
+
+        self.fields: Dict[FieldKey, FieldState] = dict()
+        self._blocks: Dict[PlanGroup, _BlockState] = dict()
+
+        self.skipped_count = 0
+        self.omitted_count = 0
+
+    def get(self, dst: Optional[DataStructureType], tx: Optional[int], field: str) -> Optional[FieldState]:
+        return self.fields.get((dst, tx, field))
+
+    def map(self, group: PlanGroup, conditions: dict, timestamp: int, record: dict):
+        """Map a single conditions record using the steps of its group"""
+
+        block = self._blocks.get(group)
+        if block is None:
+            block = _BlockState([self.fields.setdefault((group.dst, group.tx, key), FieldState(_MISSING, timestamp))
+                                 for key in group.keys])
+            self._blocks[group] = block
+
+        changed_keys = ()
+        sensor_ts = conditions.get(KEY_TS)
+        if sensor_ts is None or sensor_ts != block.sensor_ts:
+            values = group.values(conditions)
+            if values != block.values:
+                changed_keys = self._update(group, block, values, sensor_ts if sensor_ts is not None else timestamp)
+            block.sensor_ts = sensor_ts
+
+        if not changed_keys:
+            self.skipped_count += 1
+
+        emitted = set()
+        for key, state in zip(group.keys, block.fields):
+            if state.value is _MISSING:
+                continue
+            if key in changed_keys or state.emitted_ts is None or timestamp - state.emitted_ts >= self.omit_unchanged:
+                state.emitted_ts = timestamp
+                emitted.add(key)
+            else:
+                self.omitted_count += 1
+
+        if emitted:
+            mapped = block.mapped
+            for source_key, target_key, _ in group.steps:
+                if source_key in emitted and target_key in mapped:
+                    record[target_key] = mapped[target_key]
+
+    @staticmethod
+    def _update(group: PlanGroup, block: _BlockState, values: tuple, ts: int) -> List[str]:
+        changed_keys = []
+        for key, state, value in zip(group.keys, block.fields, values):
+            if state.value != value:
+                state.value = value
+                state.ts = ts
+                changed_keys.append(key)
+
+        mapped = dict()
+        values_by_key = dict(zip(group.keys, values))
+        for source_key, target_key, transform in group.steps:
+            value = values_by_key[source_key]
+            if value is _MISSING:
+                continue
+            mapped[target_key] = value if transform is None else transform(value)
+
+        block.values = values
+        block.mapped = mapped
+        return changed_keys
+
+
+class _PlanMetrics(object):
+    """Metrics of a mapping plan. Only created while metrics are enabled"""
+
+    # Keys present in conditions records of transmitters even if they weren't received
+    _META_KEYS = {KEY_LSID, KEY_DATA_STRUCTURE_TYPE, KEY_TRANSMITTER_ID}
+
+    def __init__(self, plan: 'MappingPlan', name: Optional[str]):
+        self.host = str(name)
+
+        self.timers = dict()
+        self.packets = dict()
+        self.errors = metrics.counter(metrics.MAPPING_ERRORS, host=self.host)
+        self.last_seen: Dict[int, int] = dict()
+
+        for source in PacketSource:
+            labels = dict(host=self.host, source=source.name.lower())
+            self.packets[source] = metrics.counter(metrics.PACKETS, **labels)
+            self.timers[source] = metrics.histogram(metrics.MAPPING_SECONDS, mapper="compiled", **labels)
+            for mapper in plan.hooks[source]:
+                self.timers[mapper] = metrics.histogram(metrics.MAPPING_SECONDS, mapper=str(mapper), **labels)
+
+            cache = plan.caches[source]
+            if cache is not None:
+                metrics.callback(metrics.FIELDS_OMITTED, lambda cache=cache: cache.omitted_count, metrics.KIND_COUNTER,
+                                 **labels)
+
+    def on_packet(self, packet: DavisConditionsPacket):
+        self.packets[packet.data_source].inc()
+
+        for conditions in packet.find_conditions():
+            tx = conditions.get(KEY_TRANSMITTER_ID)
+            if tx is None:
+                continue
+            if not any([value is not None for key, value in conditions.items() if key not in self._META_KEYS]):
+                continue
+
+            if tx not in self.last_seen:
+                metrics.callback(metrics.TRANSMITTER_LAST_SEEN, lambda tx=tx: self.last_seen[tx], host=self.host,
+                                 txid=str(tx))
+            self.last_seen[tx] = packet.timestamp
+
+
+class MappingPlan(object):
+    """
+    Mapping steps of all mappers compiled into one flat plan per packet source
+
+    Stateless mappers are flattened into PlanEntry tuples, grouped by data structure type and tx id, so that
+    each conditions record is looked up only once per packet. Mappers which can't be compiled (i.e. keep state
+    between packets) are retained as hooks and called after the compiled entries.
+
+    When omit_unchanged is set, compiled entries are mapped through a freshness cache per packet source (see
+    FreshnessCache).
+
+    When metrics are enabled, the time spent mapping is measured for the compiled entries and each hook.
+
+    When a tracer is given, some packets are logged together with their records (see PacketTracer).
+    """
+
+    def __init__(self, mappers: List[AbstractMapping], log_success: bool = False, omit_unchanged: float = 0,
+                 name: Optional[str] = None, tracer: Optional[PacketTracer] = None):
+        self.log_success = log_success
+        self.name = name
+        self._tracer = tracer
+
+        self.entries = dict()
+        self.hooks = dict()
+        self.caches = dict()
+        self._groups = dict()
+        self._metrics: Optional[_PlanMetrics] = None
+
+        for source in PacketSource:
+            entries = []
+            hooks = []
+            for mapper in mappers:
+                mapper_entries = mapper.plan_entries(source)
+                if mapper_entries is None:
+                    hooks.append(mapper)
+                else:
+                    entries.extend(mapper_entries)
+
+            self.entries[source] = entries
+            self.hooks[source] = hooks
+            self._groups[source] = self._group_entries(entries)
+            self.caches[source] = FreshnessCache(omit_unchanged) if omit_unchanged > 0 else None
+
+        if metrics.is_enabled():
+            self._metrics = _PlanMetrics(self, name)
+
+    def data_structure_types(self, source: PacketSource) -> Set[Optional[DataStructureType]]:
+        """
+        Data structure types mapped from packets of the given source by compiled entries. None stands for entries
+        matching conditions of any data structure type (e.g. battery flags)
+        """
+        return set([dst for dst, _, _, _, _ in self.entries[source]])
+
+    def __repr__(self):
+        hooks = dict([(source, [str(mapper) for mapper in mappers]) for source, mappers in self.hooks.items()])
+        return "%s(entries=%s, hooks=%s)" % (type(self).__name__, repr(self.entries), repr(hooks))
+
+    @staticmethod
+    def _group_entries(entries: List[PlanEntry]) -> List[PlanGroup]:
+        groups = dict()
+        for dst, tx, source_key, target_key, transform in entries:
+            groups.setdefault((dst, tx), []).append((source_key, target_key, transform))
+        return [PlanGroup(dst, tx, steps) for (dst, tx), steps in groups.items()]
+
+    def map(self, packet: DavisConditionsPacket, record: dict):
+        data_source = packet.data_source
+        tracer = self._tracer
+        if tracer is not None and tracer.is_due():
+            start_time = time.perf_counter()
+            self._map(packet, data_source, record)
+            tracer.trace(packet, record, time.perf_counter() - start_time)
+            return
+
+        self._map(packet, data_source, record)
+
+    def _map(self, packet: DavisConditionsPacket, data_source: PacketSource, record: dict):
+        if self._metrics is None:
+            self._map_compiled(packet, data_source, record)
+            for mapper in self.hooks[data_source]:
+                mapper.map(packet, record)
+            return
+
+        plan_metrics = self._metrics
+        plan_metrics.on_packet(packet)
+        try:
+            start_time = time.perf_counter()
+            self._map_compiled(packet, data_source, record)
+            end_time = time.perf_counter()
+            plan_metrics.timers[data_source].observe(end_time - start_time)
+            for mapper in self.hooks[data_source]:
+                start_time = end_time
+                mapper.map(packet, record)
+                end_time = time.perf_counter()
+                plan_metrics.timers[mapper].observe(end_time - start_time)
+        except Exception:
+            plan_metrics.errors.inc()
+            raise
+
+    def _map_compiled(self, packet: DavisConditionsPacket, data_source: PacketSource, record: dict):
+        timestamp = packet.timestamp
+        cache = self.caches[data_source]
+
+        for group in self._groups[data_source]:
+            conditions = packet.find_conditions(group.dst, group.tx)
+            if len(conditions) > 1:
+                raise ValueError("Combination of dst %s and tx id %s did not result in an unique sensor" % (
+                    str(group.dst), str(group.tx)))
+            if len(conditions) < 1:
+                continue
+
+            conditions = conditions[0]
+            if cache is not None:
+                cache.map(group, conditions, timestamp, record)
+                continue
+
+            for source_key, target_key, transform in group.steps:
+                if source_key not in conditions:
+                    continue
+                value = conditions[source_key]
+                record[target_key] = value if transform is None else transform(value)
+
+        if self.log_success:
+            log.debug("Mapped %d compiled entries", len(self.entries[data_source]))
@@ -0,0 +1,119 @@
+# Copyright © 2020-2021 Michael Schantl and contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Merging of records arriving close to each other into a single LOOP packet
+"""
+import logging
+import time
+from typing import Dict, Iterable, Optional, Hashable, Set
+
+log = logging.getLogger(__name__)
+
+
+class RecordMerger(object):
+    """
+    Merge records of different sources arriving within a window into one record
+
+    Sources are e.g. polls and broadcasts of a device, or different devices. The window starts with the first record
+    of a group. A second record of a source already in the group isn't merged: the group is flushed and the record
+    starts a new group. For each field, the value of the record with the latest
+    timestamp wins, except for sum fields (amounts since the last record, e.g. rain), whose values are added up.
+    Timestamps of merged records never decrease.
+    """
+
+    def __init__(self, window: float, sum_fields: Iterable[str] = ()):
+        if window <= 0:
+            raise ValueError("Merge window must be greater than 0 (got: %s)" % window)
+
+        self.window = window
+        self.sum_fields = frozenset(sum_fields)
+
+        self.merged_count = 0
+
+        self._record: Optional[dict] = None
+        self._field_timestamps: Dict[str, float] = dict()
+        self._sources: Set[Hashable] = set()
+        self._deadline = 0.0
+        self._last_timestamp = None
+
+    @property
+    def has_pending(self) -> bool:
+        return self._record is not None
+
+    def add(self, record: dict, source: Hashable = None) -> Optional[dict]:
+        """
+        Add a record to the pending group
+
+        :return: pending record flushed because a record of the same source was already merged into it
+        """
+
+        timestamp = record['dateTime']
+
+        flushed = None
+        if self._record is not None and source in self._sources:
+            flushed = self.flush()
+
+        if self._record is None:
+            self._record = dict(record)
+            self._field_timestamps = dict.fromkeys(record, timestamp)
+            self._sources = {source}
+            self._deadline = time.monotonic() + self.window
+            return flushed
+
+        self.merged_count += 1
+        self._sources.add(source)
+        for key, value in record.items():
+            if key in self.sum_fields and value is not None and self._record.get(key) is not None:
+                self._record[key] += value
+            elif timestamp >= self._field_timestamps.get(key, timestamp):
+                self._record[key] = value
+                self._field_timestamps[key] = timestamp
+        return None
+
+    def timeout(self, default: float) -> float:
+        """Time to wait for further records before the pending record is due"""
+
+        if self._record is None:
+            return default
+        return max(0.0, min(default, self._deadline - time.monotonic()))
+
+    def pop_ready(self) -> Optional[dict]:
+        """Pending record, if its window has passed"""
+
+        if self._record is None or time.monotonic() < self._deadline:
+            return None
+        return self.flush()
+
+    def flush(self) -> Optional[dict]:
+        """Pending record, regardless of its window"""
+
+        record = self._record
+        if record is None:
+            return None
+
+        self._record = None
+        self._field_timestamps = dict()
+        self._sources = set()
+
+        if self._last_timestamp is not None and record['dateTime'] < self._last_timestamp:
+            record['dateTime'] = self._last_timestamp
+        self._last_timestamp = record['dateTime']
+        return record
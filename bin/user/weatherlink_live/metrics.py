@@ -0,0 +1,284 @@
+# Copyright © 2020-2021 Michael Schantl and contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Metrics of the driver pipeline
+
+Metrics are disabled by default. While disabled, counter() and histogram() return shared instances doing nothing,
+so instrumented code only pays for a method call. Components fetch their metrics when they are created, so enable()
+has to be called before the driver is started.
+
+Counters are updated without locking. Increments racing between threads may rarely get lost.
+"""
+import logging
+import re
+import threading
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+log = logging.getLogger(__name__)
+
+KIND_COUNTER = "counter"
+KIND_GAUGE = "gauge"
+KIND_HISTOGRAM = "histogram"
+
+# Upper bounds of histogram buckets in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+GAP_BUCKETS = (1.0, 2.5, 3.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+HTTP_REQUEST_SECONDS = "wll_http_request_seconds"
+HTTP_ERRORS = "wll_http_errors_total"
+UDP_RECEIVED = "wll_udp_datagrams_received_total"
+UDP_DECODED = "wll_udp_datagrams_decoded_total"
+UDP_DROPPED = "wll_udp_datagrams_dropped_total"
+UDP_ERRORS = "wll_udp_decode_errors_total"
+UDP_GAP_SECONDS = "wll_udp_receive_gap_seconds"
+BROADCAST_PORT_CHANGES = "wll_broadcast_port_changes_total"
+PACKETS = "wll_packets_total"
+MAPPING_SECONDS = "wll_mapping_seconds"
+MAPPING_ERRORS = "wll_mapping_errors_total"
+TRANSMITTER_LAST_SEEN = "wll_transmitter_last_seen_timestamp_seconds"
+QUEUE_DEPTH = "wll_queue_depth"
+QUEUE_SECONDS = "wll_queue_seconds"
+QUEUE_DROPPED = "wll_queue_dropped_total"
+QUEUE_COALESCED = "wll_queue_coalesced_total"
+QUEUE_BLOCKED = "wll_queue_blocked_total"
+TICK_DRIFT_SECONDS = "wll_scheduler_tick_drift_seconds"
+REQUESTS = "wll_requests_total"
+REQUEST_RETRIES = "wll_request_retries_total"
+REQUEST_FAILURES = "wll_request_failures_total"
+REQUESTS_SKIPPED = "wll_requests_skipped_total"
+POLLS_SKIPPED = "wll_adaptive_polls_skipped_total"
+RECORDS_MERGED = "wll_records_merged_total"
+FIELDS_OMITTED = "wll_fields_omitted_total"
+SCHEDULER_FAILED = "wll_scheduler_failed"
+NO_DATA_ITERATIONS = "wll_no_data_iterations"
+DRIVER_ERRORS = "wll_driver_errors_total"
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Counter(object):
+    kind = KIND_COUNTER
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+
+class Histogram(object):
+    """Count, sum and maximum of observed values together with cumulative counts per bucket"""
+
+    kind = KIND_HISTOGRAM
+
+    __slots__ = ('bounds', 'bucket_counts', 'count', 'sum', 'max')
+
+    def __init__(self, bounds: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.bounds = bounds
+        # Last bucket counts values larger than all bounds
+        self.bucket_counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max: Optional[float] = None
+
+    def observe(self, value: float):
+        self.bucket_counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    @property
+    def avg(self) -> Optional[float]:
+        if self.count < 1:
+            return None
+        return self.sum / self.count
+
+    def cumulative_counts(self) -> List[Tuple[float, int]]:
+        """Counts of values less than or equal to each bound, ending with infinity"""
+
+        cumulative = []
+        total = 0
+        for bound, count in zip(self.bounds + (float("inf"),), self.bucket_counts):
+            total += count
+            cumulative.append((bound, total))
+        return cumulative
+
+
+class CallbackMetric(object):
+    """Counter or gauge whose value is read from existing state when collected"""
+
+    __slots__ = ('kind', '_function')
+
+    def __init__(self, kind: str, function: Callable[[], float]):
+        self.kind = kind
+        self._function = function
+
+    @property
+    def value(self) -> Optional[float]:
+        return self._function()
+
+
+class _NullCounter(object):
+    __slots__ = ()
+
+    def inc(self, amount: float = 1):
+        pass
+
+
+class _NullHistogram(object):
+    __slots__ = ()
+
+    def observe(self, value: float):
+        pass
+
+
+NULL_COUNTER = _NullCounter()
+NULL_HISTOGRAM = _NullHistogram()
+
+Metric = Union[Counter, Histogram, CallbackMetric]
+
+
+class MetricsRegistry(object):
+    """Metrics by name and labels"""
+
+    def __init__(self):
+        self._metrics: Dict[Tuple[str, Labels], Metric] = dict()
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, **labels: str) -> Counter:
+        return self._get_or_create(name, labels, Counter)
+
+    def histogram(self, name: str, bounds: Tuple[float, ...] = LATENCY_BUCKETS, **labels: str) -> Histogram:
+        return self._get_or_create(name, labels, lambda: Histogram(bounds))
+
+    def callback(self, name: str, function: Callable[[], float], kind: str = KIND_GAUGE, **labels: str):
+        """Register a metric read using the function. A metric registered before using the same labels is replaced"""
+
+        with self._lock:
+            self._metrics[(name, _labels(labels))] = CallbackMetric(kind, function)
+
+    def _get_or_create(self, name: str, labels: dict, factory: Callable[[], Metric]):
+        key = (name, _labels(labels))
+        with self._lock:
+            metric = self._metrics.get(key)
+            if metric is None:
+                metric = factory()
+                self._metrics[key] = metric
+        return metric
+
+    def collect(self) -> List[Tuple[str, Labels, Metric]]:
+        """All metrics ordered by name and labels"""
+
+        with self._lock:
+            items = sorted(self._metrics.items(), key=lambda item: item[0])
+        return [(name, labels, metric) for (name, labels), metric in items]
+
+    def snapshot(self) -> Dict[str, float]:
+        """
+        Current values of all metrics by name and labels, e.g. wll_queue_depth or
+        wll_http_request_seconds_count{endpoint="/v1/current_conditions"}
+
+        Histograms are reported by their count, sum, average and maximum. Metrics without value are left out.
+        """
+
+        snapshot = dict()
+        for name, labels, metric in self.collect():
+            if metric.kind == KIND_HISTOGRAM:
+                values = [("_count", metric.count), ("_sum", metric.sum), ("_avg", metric.avg), ("_max", metric.max)]
+            else:
+                values = [("", metric.value)]
+
+            for suffix, value in values:
+                if value is not None:
+                    snapshot[format_key(name + suffix, labels)] = value
+        return snapshot
+
+
+def _labels(labels: dict) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def format_key(name: str, labels: Labels) -> str:
+    if not labels:
+        return name
+    return "%s{%s}" % (name, ",".join(['%s="%s"' % (key, value) for key, value in labels]))
+
+
+_NON_FIELD_CHARACTERS = re.compile(r"[^A-Za-z0-9]+")
+
+
+def field_name(key: str) -> str:
+    """Convert a snapshot key to a name usable as observation in LOOP packets"""
+
+    return _NON_FIELD_CHARACTERS.sub("_", key).strip("_")
+
+
+_registry: Optional[MetricsRegistry] = None
+
+
+def enable() -> MetricsRegistry:
+    global _registry
+    if _registry is None:
+        log.info("Collecting metrics")
+        _registry = MetricsRegistry()
+    return _registry
+
+
+def disable():
+    global _registry
+    _registry = None
+
+
+def is_enabled() -> bool:
+    return _registry is not None
+
+
+def get_registry() -> Optional[MetricsRegistry]:
+    return _registry
+
+
+def counter(name: str, **labels: str):
+    if _registry is None:
+        return NULL_COUNTER
+    return _registry.counter(name, **labels)
+
+
+def histogram(name: str, bounds: Tuple[float, ...] = LATENCY_BUCKETS, **labels: str):
+    if _registry is None:
+        return NULL_HISTOGRAM
+    return _registry.histogram(name, bounds, **labels)
+
+
+def callback(name: str, function: Callable[[], float], kind: str = KIND_GAUGE, **labels: str):
+    if _registry is None:
+        return
+    _registry.callback(name, function, kind, **labels)
+
+
+def snapshot() -> Dict[str, float]:
+    if _registry is None:
+        return dict()
+    return _registry.snapshot()
@@ -22,11 +22,11 @@
 Packets as returned by the API
 """
 import logging
-from typing import Optional, Any, List
+from typing import Optional, Any, List, Dict, Tuple
 
 import weewx
 from user.weatherlink_live.static import PacketSource
-from user.weatherlink_live.static.packets import DataStructureType
+from user.weatherlink_live.static.packets import DataStructureType, KEY_DATA_STRUCTURE_TYPE, KEY_TRANSMITTER_ID
 
 log = logging.getLogger(__name__)
 
@@ -38,6 +38,11 @@ class NotInPacket(Exception):
     pass
 
 
+class DeviceError(weewx.WeeWxIOError):
+    """Raised when a device responded with an error"""
+    pass
+
+
 class DavisPacket(object):
     """A packet as returned by WeatherLinkLive/AirLink APIs"""
 
@@ -54,7 +59,7 @@ class DavisPacket(object):
 
     def raise_error(self):
         if self.has_error:
-            raise weewx.WeeWxIOError(
+            raise DeviceError(
                 "Device %s returned error %d: %s" % (self.host, self.error_code, self.error_message)
             )
 
@@ -62,6 +67,11 @@ class DavisPacket(object):
 class DavisConditionsPacket(DavisPacket):
     """Interface for packets holding actual data"""
 
+    def __init__(self, packet: dict, host: str):
+        super().__init__(packet, host)
+
+        self._index = None
+
     @property
     def timestamp(self) -> int:
         """Return timestamp of packet"""
@@ -77,6 +87,39 @@ class DavisConditionsPacket(DavisPacket):
         """Returns source of data"""
         raise NotImplementedError("Abstract type")
 
+    @property
+    def _conditions_index(self) -> Dict[Tuple[Optional[int], Optional[int]], List[dict]]:
+        """
+        Index of conditions records by data structure type and tx id
+
+        Built once on first access. `None` as part of a key acts as wildcard, the same way it does when passed
+        to get_observation. The order of the records is retained.
+        """
+
+        if self._index is not None:
+            return self._index
+
+        index = dict()
+        for conditions in self._conditions:
+            dst = conditions.get(KEY_DATA_STRUCTURE_TYPE)
+            tx = conditions.get(KEY_TRANSMITTER_ID)
+            for key in {(dst, tx), (dst, None), (None, tx), (None, None)}:
+                index.setdefault(key, []).append(conditions)
+
+        self._index = index
+        return index
+
+    def find_conditions(self, dst: DataStructureType = None, tx: int = None) -> List[dict]:
+        """
+        Find all conditions records matching the data structure type and tx id
+
+        :param dst: data structure type for filtering; None matches any type
+        :param tx: transmitter (tx) id for filtering; None matches any id
+        :return: list of matching conditions records (must not be modified)
+        """
+
+        return self._conditions_index.get((dst, tx), [])
+
     def get_observation(self, observation: str, dst: DataStructureType = None, tx: int = None,
                         enforce_unique: bool = True) -> Optional[Any]:
         """
@@ -92,11 +135,7 @@ class DavisConditionsPacket(DavisPacket):
         :raise NotInPacket: signals that the observation wasn't found
         """
 
-        filtered = self._conditions
-        if dst is not None:
-            filtered = [conditions for conditions in filtered if conditions.get('data_structure_type') == dst]
-        if tx is not None:
-            filtered = [conditions for conditions in filtered if conditions.get('txid') == tx]
+        filtered = self.find_conditions(dst, tx)
 
         if enforce_unique and len(filtered) > 1:
             raise ValueError(
@@ -0,0 +1,273 @@
+# Copyright © 2020-2021 Michael Schantl and contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Replay driver feeding captured traffic back through the driver
+
+Set the driver to ``user.weatherlink_live.replay`` and option ``replay_file`` to a file written using option
+``capture_file``. Polled conditions and broadcasts are fed through the same hosts and mappings as live traffic.
+
+Can also be run standalone to measure throughput, the time spent in each stage and the latency of handing records
+over to the driver loop:
+
+    PYTHONPATH=bin python -m user.weatherlink_live.replay --speed 0 capture.log
+"""
+import argparse
+import logging
+import threading
+import time
+from time import perf_counter
+from typing import Dict, List, Optional
+
+import weewx
+from user.weatherlink_live import DRIVER_NAME, WeatherlinkLiveDriver, capture, json_decoder
+from user.weatherlink_live.capture import CaptureRecord, KIND_CONDITIONS, KIND_BROADCAST
+from user.weatherlink_live.data_host import DataHost, WllPollHost, WLLBroadcastHost, PacketQueue
+from user.weatherlink_live.packets import WlHttpConditionsRequestPacket, WlUdpBroadcastPacket
+from user.weatherlink_live.static.config import KEY_REPLAY_FILE, QUEUE_POLICY_BLOCK
+
+log = logging.getLogger(__name__)
+
+STAGE_DECODE = "decode"
+STAGE_PACKET = "packet"
+STAGE_MAPPING = "mapping"
+STAGE_SERVICES = "services"
+
+DEFAULT_MAPPING = "th:1, th_indoor, baro, rain:1, wind:1, thw:1:appTemp, windchill:1, battery:1:outTemp:rain:wind"
+
+
+def loader(config_dict, engine):
+    return ReplayDriver(config_dict, engine)
+
+
+class ReplayStats(object):
+    """Count of replayed packets and time spent in each stage"""
+
+    def __init__(self):
+        self.packets = 0
+        self.durations: Dict[str, float] = dict()
+        self.counts: Dict[str, int] = dict()
+
+    def add(self, stage: str, duration: float):
+        self.durations[stage] = self.durations.get(stage, 0.0) + duration
+        self.counts[stage] = self.counts.get(stage, 0) + 1
+
+    def avg_duration(self, stage: str) -> Optional[float]:
+        count = self.counts.get(stage, 0)
+        if count < 1:
+            return None
+        return self.durations[stage] / count
+
+    def __repr__(self):
+        return str(self.__dict__)
+
+
+class ReplayDriver(WeatherlinkLiveDriver):
+    """
+    Driver replaying a capture instead of connecting to the devices
+
+    Replay speed is set using option ``replay_speed``: 1 replays in real time, N replays N times faster
+    and 0 replays as fast as possible. The engine is stopped when the end of the capture is reached.
+    """
+
+    def __init__(self, conf_dict, engine):
+        super().__init__(conf_dict, engine)
+
+        self.stats = ReplayStats()
+        self.replay_finished = False
+        self.replay_thread: Optional[threading.Thread] = None
+        self._stop_signal = threading.Event()
+
+    def start(self):
+        if self.is_running:
+            return
+
+        replay_file = self.configuration.replay_file
+        if not replay_file:
+            raise ValueError("No capture to replay. Set option %s" % repr(KEY_REPLAY_FILE))
+
+        decoder = json_decoder.use_decoder(self.configuration.json_decoder)
+        log.info("Using JSON decoder: %s", decoder)
+
+        self.is_running = True
+        # Replaying as fast as possible would overflow the queue, so throttle the replay instead of losing records
+        queue_policy = self.configuration.queue_policy if self.configuration.replay_speed > 0 else QUEUE_POLICY_BLOCK
+        self.packets = PacketQueue(self.configuration.queue_capacity * len(self.configuration.hosts), queue_policy,
+                                   self.rain_fields)
+        for host in self.configuration.hosts:
+            mapping_plan = self.mapping_plans[host.name]
+            self.poll_hosts.append(WllPollHost(host.host, mapping_plan, self.packets))
+            # The replay thread can wait for space in the queue, unlike the shared broadcast listener
+            self.push_hosts.append(WLLBroadcastHost(host.host, mapping_plan, self.packets, block=True))
+
+        log.info("Replaying %s (speed: %s)", replay_file, self.configuration.replay_speed)
+        self.replay_thread = threading.Thread(name='WLL-Replay', target=self._replay, args=(replay_file,))
+        self.replay_thread.daemon = True
+        self.replay_thread.start()
+
+    def _replay(self, path: str):
+        speed = self.configuration.replay_speed
+        first_timestamp = None
+        start_time = None
+
+        try:
+            for record in capture.read(path):
+                if self._stop_signal.is_set():
+                    return
+
+                if speed > 0:
+                    if first_timestamp is None:
+                        first_timestamp = record.timestamp
+                        start_time = time.time()
+
+                    delay = start_time + (record.timestamp - first_timestamp) / speed - time.time()
+                    if delay > 0 and self._stop_signal.wait(delay):
+                        return
+
+                self._feed(record)
+        except Exception as e:
+            self.packets.put_error(e)
+        finally:
+            log.info("Finished replay of %s", path)
+            self.replay_finished = True
+            # Wake up the driver loop
+            self.packets.put_error(weewx.StopNow("Replay finished"))
+
+    def _feed(self, record: CaptureRecord):
+        if record.kind == KIND_CONDITIONS:
+            host = self._find_host(self.poll_hosts, record.host)
+            packet_type = WlHttpConditionsRequestPacket
+        elif record.kind == KIND_BROADCAST:
+            host = self._find_host(self.push_hosts, record.host)
+            packet_type = WlUdpBroadcastPacket
+        else:
+            # Broadcast requests aren't replayed
+            return
+
+        if host is None:
+            log.debug("Skipping %s record of unknown host %s", record.kind, record.host)
+            return
+
+        start = perf_counter()
+        json_data = json_decoder.loads(record.data)
+        decoded = perf_counter()
+        packet = packet_type.try_create(json_data, host.host)
+        created = perf_counter()
+        if isinstance(host, WLLBroadcastHost):
+            host.on_packet_received(packet)
+        else:
+            host.create_record(packet)
+        mapped = perf_counter()
+
+        self.stats.packets += 1
+        self.stats.add(STAGE_DECODE, decoded - start)
+        self.stats.add(STAGE_PACKET, created - decoded)
+        self.stats.add(STAGE_MAPPING, mapped - created)
+
+    @staticmethod
+    def _find_host(hosts: List[DataHost], name: str) -> Optional[DataHost]:
+        for host in hosts:
+            if host.host == name:
+                return host
+
+        # Allow replaying a capture of a different host name if there's only one
+        if len(hosts) == 1:
+            return hosts[0]
+        return None
+
+    def closePort(self):
+        self._stop_signal.set()
+        if self.replay_thread is not None and threading.current_thread() is not self.replay_thread:
+            self.replay_thread.join()
+        self.replay_thread = None
+
+        super().closePort()
+
+
+class _ServiceEngine(object):
+    """Minimal engine for running the services of the driver outside of WeeWX"""
+
+    def __init__(self):
+        self.callbacks = dict()
+
+    def bind(self, event_type, callback):
+        self.callbacks.setdefault(event_type, []).append(callback)
+
+    def dispatch_event(self, event):
+        for callback in self.callbacks.get(event.event_type, []):
+            callback(event)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured WeatherLink Live traffic and measure throughput")
+    parser.add_argument("capture_file", help="File written using option capture_file")
+    parser.add_argument("--speed", type=float, default=0,
+                        help="Replay speed. 1 for real time, 0 for maximum speed (default: 0)")
+    parser.add_argument("--host", help="Host to replay (default: first host of the capture)")
+    parser.add_argument("--mapping", default=DEFAULT_MAPPING, help="Mapping (default: %s)" % DEFAULT_MAPPING)
+    args = parser.parse_args()
+
+    host = args.host
+    if host is None:
+        first_record = next(capture.read(args.capture_file), None)
+        if first_record is None:
+            parser.error("Capture %s is empty" % args.capture_file)
+        host = first_record.host
+
+    conf_dict = {
+        DRIVER_NAME: {
+            'host': host,
+            'mapping': [mapping.strip() for mapping in args.mapping.split(",")],
+            'replay_file': args.capture_file,
+            'replay_speed': args.speed
+        }
+    }
+
+    engine = _ServiceEngine()
+    driver = ReplayDriver(conf_dict, engine)
+    engine.dispatch_event(weewx.Event(weewx.STARTUP))
+
+    start = perf_counter()
+    try:
+        for packet in driver.genLoopPackets():
+            service_start = perf_counter()
+            engine.dispatch_event(weewx.Event(weewx.NEW_LOOP_PACKET, packet=packet))
+            driver.stats.add(STAGE_SERVICES, perf_counter() - service_start)
+    except weewx.StopNow:
+        pass
+    finally:
+        driver.closePort()
+    elapsed = perf_counter() - start
+
+    stats = driver.stats
+    print("Replayed %d packets of %s in %.3f s (%.0f packets/s)" % (
+        stats.packets, host, elapsed, stats.packets / elapsed if elapsed > 0 else 0))
+    for stage in (STAGE_DECODE, STAGE_PACKET, STAGE_MAPPING, STAGE_SERVICES):
+        avg_duration = stats.avg_duration(stage)
+        if avg_duration is not None:
+            print("  %-10s %8.1f us/packet" % (stage, avg_duration * 1e6))
+
+    # Time from creating a record until the driver loop took it
+    if driver.packets is not None and driver.packets.avg_latency is not None:
+        print("  %-10s %8.1f us/packet" % ("queue", driver.packets.avg_latency * 1e6))
+
+
+if __name__ == '__main__':
+    main()
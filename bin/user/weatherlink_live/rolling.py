@@ -0,0 +1,170 @@
+# Copyright © 2020-2021 Michael Schantl and contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Rolling statistics over the samples of the last window seconds
+
+All statistics are updated incrementally: sums are kept as running sums, minimum and maximum using monotonic queues.
+Adding a sample takes constant amortized time, independent of the count of samples in the window.
+"""
+import math
+from collections import deque
+from typing import Optional
+
+
+class RollingMean(object):
+    """Mean of the values of the last window seconds"""
+
+    __slots__ = ('window', '_samples', '_sum')
+
+    def __init__(self, window: float):
+        if window <= 0:
+            raise ValueError("Window must be larger than 0 (got: %f)" % window)
+
+        self.window = window
+
+        # Pairs of timestamp and value
+        self._samples = deque()
+        self._sum = 0.0
+
+    def __len__(self):
+        return len(self._samples)
+
+    def add(self, timestamp: float, value: float):
+        samples = self._samples
+        samples.append((timestamp, value))
+        self._sum += value
+
+        expired = timestamp - self.window
+        while samples[0][0] <= expired:
+            self._sum -= samples.popleft()[1]
+        if len(samples) == 1:
+            # Don't let rounding errors of the running sum accumulate
+            self._sum = value
+
+    @property
+    def mean(self) -> Optional[float]:
+        if not self._samples:
+            return None
+        return self._sum / len(self._samples)
+
+
+class RollingWindow(RollingMean):
+    """Mean, minimum and maximum of the values of the last window seconds"""
+
+    __slots__ = ('_max', '_min')
+
+    def __init__(self, window: float):
+        super().__init__(window)
+
+        # Candidates for maximum and minimum with decreasing/increasing values
+        self._max = deque()
+        self._min = deque()
+
+    def add(self, timestamp: float, value: float):
+        super().add(timestamp, value)
+
+        expired = timestamp - self.window
+
+        maxima = self._max
+        while maxima and maxima[-1][1] <= value:
+            maxima.pop()
+        maxima.append((timestamp, value))
+        while maxima[0][0] <= expired:
+            maxima.popleft()
+
+        minima = self._min
+        while minima and minima[-1][1] >= value:
+            minima.pop()
+        minima.append((timestamp, value))
+        while minima[0][0] <= expired:
+            minima.popleft()
+
+    @property
+    def max(self) -> Optional[float]:
+        if not self._max:
+            return None
+        return self._max[0][1]
+
+    @property
+    def min(self) -> Optional[float]:
+        if not self._min:
+            return None
+        return self._min[0][1]
+
+
+class RollingVectorMean(object):
+    """
+    Vector mean of the wind of the last window seconds
+
+    Each sample is split into its north and east components weighted by speed, so calm periods don't influence the
+    mean direction and directions around north are averaged correctly (circular mean).
+    """
+
+    __slots__ = ('window', '_samples', '_east', '_north', '_moving')
+
+    def __init__(self, window: float):
+        if window <= 0:
+            raise ValueError("Window must be larger than 0 (got: %f)" % window)
+
+        self.window = window
+
+        # Tuples of timestamp, east and north component
+        self._samples = deque()
+        self._east = 0.0
+        self._north = 0.0
+        # Count of samples with wind
+        self._moving = 0
+
+    def __len__(self):
+        return len(self._samples)
+
+    def add(self, timestamp: float, speed: float, direction: Optional[float]):
+        if direction is None or speed == 0:
+            east = north = 0.0
+        else:
+            radians = math.radians(direction)
+            east = speed * math.sin(radians)
+            north = speed * math.cos(radians)
+            self._moving += 1
+
+        self._samples.append((timestamp, east, north))
+        self._east += east
+        self._north += north
+
+        expired = timestamp - self.window
+        samples = self._samples
+        while samples[0][0] <= expired:
+            _, east, north = samples.popleft()
+            self._east -= east
+            self._north -= north
+            if east != 0 or north != 0:
+                self._moving -= 1
+        if len(samples) == 1:
+            _, self._east, self._north = samples[0]
+
+    @property
+    def direction(self) -> Optional[float]:
+        """Mean direction in degrees or None if there was no wind"""
+
+        if self._moving < 1:
+            return None
+        return math.degrees(math.atan2(self._east, self._north)) % 360.0
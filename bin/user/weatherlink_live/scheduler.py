@@ -19,18 +19,44 @@
 # SOFTWARE.
 
 import logging
+import random
 import sched
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from math import floor
-from typing import Optional, Callable
+from typing import Optional, Callable, Dict, Set, List
+
+from user.weatherlink_live import metrics
+from user.weatherlink_live.packets import DeviceError
+from user.weatherlink_live.static.packets import DataStructureType
 
 POLL_INTERVAL_MIN = 10.0
 POLL_INTERVAL_MAX = 300.0
 PUSH_REFRESH_INTERVAL = 1200.0  # Refresh broadcast every 20 minutes
 PUSH_DURATION = PUSH_REFRESH_INTERVAL + 300.0  # Request broadcast for interval + 5 minutes
 
+RETRY_MAX_ATTEMPTS = 3
+RETRY_BASE_DELAY = 2.5  # Delay before first retry; doubled for every further retry
+RETRY_MAX_DELAY = 30.0
+ATTEMPT_TIMEOUT_MIN = 1.0
+PUSH_REFRESH_DEADLINE = 120.0  # Give up retrying push refresh after 2 minutes
+CIRCUIT_FAILURE_THRESHOLD = 3  # Open circuit after 3 failed requests in a row
+CIRCUIT_RESET_TIMEOUT = 60.0  # Try again 1 minute after opening circuit
+
+BROADCAST_TIMEOUT = 10.0  # Broadcasts are considered stopped after 4 missed broadcasts
+
+# Data structure types which aren't broadcast, but change slowly enough for adaptive polling
+SLOW_DATA_STRUCTURE_TYPES = {DataStructureType.WLL_BARO, DataStructureType.WLL_TH, DataStructureType.LEAF_SOIL}
+
+# Errors failing an attempt of a request: connection errors, timeouts (incl. requests' exceptions) and errors returned
+# by the device. Others (e.g. while mapping) aren't retried, but raised to the driver
+REQUEST_ERRORS = (OSError, DeviceError)
+
+TASK_POLL = "poll"
+TASK_PUSH_REFRESH = "push_refresh"
+
 log = logging.getLogger(__name__)
 
 
@@ -40,11 +66,288 @@ def _format_iso(ts: Optional[float]) -> Optional[str]:
     return datetime.utcfromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S Z')
 
 
+class RequestStats(object):
+    """Counters and latencies of a scheduled request"""
+
+    def __init__(self):
+        self.requests = 0
+        self.attempts = 0
+        self.retries = 0
+        self.successes = 0
+        self.failures = 0
+        self.skipped = 0
+        self.circuit_open = False
+
+        self.last_latency = None
+        self.max_latency = None
+        self.total_latency = 0.0
+
+    def __repr__(self):
+        return str(self.__dict__)
+
+    @property
+    def avg_latency(self) -> Optional[float]:
+        if self.attempts < 1:
+            return None
+        return self.total_latency / self.attempts
+
+    def add_latency(self, latency: float):
+        self.last_latency = latency
+        self.total_latency += latency
+        if self.max_latency is None or latency > self.max_latency:
+            self.max_latency = latency
+
+
+def register_request_metrics(name: Optional[str], request_stats: Dict[str, RequestStats]):
+    """Expose the counters of requests by task name as metrics"""
+
+    for task, stats in request_stats.items():
+        labels = dict(host=str(name), task=task)
+        metrics.callback(metrics.REQUESTS, lambda stats=stats: stats.requests, metrics.KIND_COUNTER, **labels)
+        metrics.callback(metrics.REQUEST_RETRIES, lambda stats=stats: stats.retries, metrics.KIND_COUNTER, **labels)
+        metrics.callback(metrics.REQUEST_FAILURES, lambda stats=stats: stats.failures, metrics.KIND_COUNTER, **labels)
+        metrics.callback(metrics.REQUESTS_SKIPPED, lambda stats=stats: stats.skipped, metrics.KIND_COUNTER, **labels)
+
+
+def backoff_delay(attempt: int, base_delay: float = RETRY_BASE_DELAY, max_delay: float = RETRY_MAX_DELAY) -> float:
+    """Exponential backoff delay after the given (1-based) attempt, with jitter of up to half the delay"""
+
+    delay = min(max_delay, base_delay * (2 ** (attempt - 1)))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class CircuitBreaker(object):
+    """Skip requests for some time after several failed requests in a row"""
+
+    def __init__(self, name: str, stats: RequestStats,
+                 failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+                 reset_timeout: float = CIRCUIT_RESET_TIMEOUT):
+        self.name = name
+        self.stats = stats
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self._consecutive_failures = 0
+        self._open_until = None
+
+    def is_open(self) -> bool:
+        if self._open_until is None or time.time() >= self._open_until:
+            return False
+
+        log.debug("Circuit of request %s open until %s. Skipping", self.name, _format_iso(self._open_until))
+        self.stats.skipped += 1
+        return True
+
+    def on_success(self):
+        if self._open_until is not None:
+            log.info("Request %s succeeded again. Closing circuit", self.name)
+        self._consecutive_failures = 0
+        self._open_until = None
+        self.stats.circuit_open = False
+
+    def on_failure(self):
+        self._consecutive_failures += 1
+        if self._consecutive_failures < self.failure_threshold:
+            return
+
+        self._open_until = time.time() + self.reset_timeout
+        self.stats.circuit_open = True
+        log.error("Request %s failed %d times in a row. Skipping until %s",
+                  self.name, self._consecutive_failures, _format_iso(self._open_until))
+
+
+class AdaptivePolling(object):
+    """
+    Poll slower while broadcasts are received
+
+    Broadcasts only carry wind and rain. When all observations mapped from polls are of data structure types changing
+    slowly (see SLOW_DATA_STRUCTURE_TYPES), polls are only due every slow_interval seconds while broadcasts are
+    received. When broadcasts stop, every tick polls again.
+    """
+
+    def __init__(self, name: str, slow_interval: float, last_broadcast_time: Callable[[], Optional[float]],
+                 broadcast_timeout: float = BROADCAST_TIMEOUT):
+        self.name = name
+        self.slow_interval = slow_interval
+        self.broadcast_timeout = broadcast_timeout
+        self._last_broadcast_time = last_broadcast_time
+
+        self.skipped_count = 0
+        self._last_poll_time: Optional[float] = None
+        self._slow = False
+
+        metrics.callback(metrics.POLLS_SKIPPED, lambda: self.skipped_count, metrics.KIND_COUNTER, host=str(name))
+
+    @staticmethod
+    def is_applicable(data_structure_types: Set[Optional[DataStructureType]]) -> bool:
+        # Entries of any data structure type (None, e.g. battery flags) are only up to date when polled
+        return data_structure_types <= SLOW_DATA_STRUCTURE_TYPES
+
+    def is_broadcast_healthy(self) -> bool:
+        last_broadcast_time = self._last_broadcast_time()
+        return last_broadcast_time is not None and time.monotonic() - last_broadcast_time < self.broadcast_timeout
+
+    def poll_due(self, tick_interval: float) -> bool:
+        """Whether to poll at the current tick"""
+
+        now = time.monotonic()
+        slow = self.is_broadcast_healthy()
+        if slow != self._slow:
+            if slow:
+                log.info("Receiving broadcasts of %s. Polling every %d seconds", self.name, self.slow_interval)
+            else:
+                log.info("No broadcasts of %s. Polling every %d seconds", self.name, tick_interval)
+            self._slow = slow
+
+        # Allow some jitter of ticks
+        due_time = self.slow_interval - tick_interval / 2
+        if not slow or self._last_poll_time is None or now - self._last_poll_time >= due_time:
+            self._last_poll_time = now
+            return True
+
+        self.skipped_count += 1
+        return False
+
+
+class ScheduledRequest(object):
+    """
+    Request executed by the scheduler, retried with exponential backoff
+
+    Retries are scheduled as separate events, so the scheduler thread is never blocked waiting for them.
+    A request is given up once all attempts failed or the deadline passed. After several failed requests
+    in a row the circuit opens and further requests are skipped until the reset timeout passed.
+    The optional success callback is called once an attempt of a request succeeded.
+
+    Only REQUEST_ERRORS fail an attempt. Other errors are raised to the caller, or passed to the error callback when
+    raised by a retry.
+
+    The callback is passed the timeout of the attempt as keyword argument timeout. An attempt never takes longer
+    than the remaining time until the deadline or max_attempt_time seconds, if given.
+    """
+
+    def __init__(self, name: str, scheduler: sched.scheduler, callback: Callable, deadline: float,
+                 on_success: Optional[Callable[[], None]] = None,
+                 on_error: Optional[Callable[[BaseException], None]] = None,
+                 max_attempt_time: Optional[float] = None,
+                 max_attempts: int = RETRY_MAX_ATTEMPTS,
+                 base_delay: float = RETRY_BASE_DELAY,
+                 max_delay: float = RETRY_MAX_DELAY,
+                 failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+                 reset_timeout: float = CIRCUIT_RESET_TIMEOUT):
+        self.name = name
+        self._scheduler = scheduler
+        self._callback = callback
+        self._success_callback = on_success
+        self._error_callback = on_error
+
+        self.deadline = deadline
+        self.max_attempt_time = max_attempt_time
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.stats = RequestStats()
+        self._circuit = CircuitBreaker(name, self.stats, failure_threshold, reset_timeout)
+
+        self._args = ()
+        self._attempt = 0
+        self._deadline_time = 0.0
+        self._retry_event = None
+
+    @property
+    def is_pending(self) -> bool:
+        """Whether a retry of the current request is scheduled"""
+        return self._retry_event is not None
+
+    def start(self, *args):
+        """Start a new request, superseding a retry of the previous one"""
+
+        self.cancel()
+
+        if self._circuit.is_open():
+            return
+
+        self.stats.requests += 1
+        self._args = args
+        self._attempt = 0
+        self._deadline_time = time.time() + self.deadline
+        self._do_attempt()
+
+    def _do_attempt(self):
+        self._retry_event = None
+        self._attempt += 1
+        self.stats.attempts += 1
+        if self._attempt > 1:
+            self.stats.retries += 1
+
+        start_time = time.time()
+        timeout = self._deadline_time - start_time
+        if self.max_attempt_time is not None:
+            timeout = min(timeout, self.max_attempt_time)
+
+        try:
+            self._callback(*self._args, timeout=max(ATTEMPT_TIMEOUT_MIN, timeout))
+        except REQUEST_ERRORS as e:
+            self.stats.add_latency(time.time() - start_time)
+            log.error("Request %s failed (attempt %d of %d): %s", self.name, self._attempt, self.max_attempts, e)
+            self._on_attempt_failed()
+            return
+
+        self.stats.add_latency(time.time() - start_time)
+        self._on_success()
+
+    def _on_attempt_failed(self):
+        delay = backoff_delay(self._attempt, self.base_delay, self.max_delay)
+        if self._attempt < self.max_attempts and time.time() + delay < self._deadline_time:
+            log.debug("Retrying request %s in %.1f seconds", self.name, delay)
+            self._retry_event = self._scheduler.enter(delay, 1, self._do_retry)
+            return
+
+        self.stats.failures += 1
+        log.error("Request %s failed after %d attempts", self.name, self._attempt)
+        self._circuit.on_failure()
+
+    def _do_retry(self):
+        try:
+            self._do_attempt()
+        except BaseException as e:
+            if self._error_callback is None:
+                raise
+            log.error("Error caught in retry of request %s. Not retrying", self.name)
+            self._error_callback(e)
+
+    def _on_success(self):
+        self.stats.successes += 1
+        self._circuit.on_success()
+        if self._success_callback is not None:
+            self._success_callback()
+
+    def cancel(self):
+        if self._retry_event is None:
+            return
+
+        try:
+            self._scheduler.cancel(self._retry_event)
+        except ValueError:
+            pass  # already executed
+        self._retry_event = None
+
+
 class Scheduler(object):
-    """Centrally schedule HTTP requests to avoid overloading server"""
+    """
+    Centrally schedule HTTP requests to avoid overloading server
 
-    def __init__(self, polling_interval: float, poll_callback: Callable[[], None],
-                 push_refresh_callback: Callable[[float], None], data_event: threading.Event):
+    Devices which can only be polled (AirLink) can be polled by the scheduler of another device using extra_polls.
+    Their polls run concurrently with the poll of the scheduler's own device on each tick. Without a push refresh
+    callback, the scheduler only polls. Callbacks are passed the timeout of their HTTP request as keyword argument
+    timeout: no attempt of a request takes longer than a polling interval, so a slow device can't stall the ticks.
+    """
+
+    def __init__(self, polling_interval: float, poll_callback: Callable[..., None],
+                 push_refresh_callback: Optional[Callable[..., None]],
+                 error_callback: Callable[[BaseException], None],
+                 name: Optional[str] = None, adaptive_polling: Optional[AdaptivePolling] = None,
+                 extra_polls: Optional[Dict[str, Callable[..., None]]] = None):
 
         self.polling_interval = polling_interval
         if polling_interval < POLL_INTERVAL_MIN:
@@ -54,23 +357,49 @@ class Scheduler(object):
             raise ValueError(
                 "Polling interval shouldn't be more than %d )got: %d)" % (POLL_INTERVAL_MAX, polling_interval))
 
-        self._poll_callback = poll_callback
-        self._push_refresh_callback = push_refresh_callback
-        self.data_event = data_event
+        self.error_callback = error_callback
+        self.adaptive_polling = adaptive_polling
 
         self.error = None
 
         self._push_refresh_tick_count = floor(PUSH_REFRESH_INTERVAL / self.polling_interval)
         self._push_refresh_ticks = self._push_refresh_tick_count
-        log.debug("Push refresh will happen every %d scheduler ticks" % self._push_refresh_tick_count)
+        log.debug("Push refresh will happen every %d scheduler ticks", self._push_refresh_tick_count)
 
         self._tick_task_id = None
+        self._next_tick_time: Optional[float] = None
+        self._tick_drift = metrics.histogram(metrics.TICK_DRIFT_SECONDS, host=str(name), task=TASK_POLL)
 
         self._scheduler = sched.scheduler(timefunc=time.time, delayfunc=time.sleep)
 
+        # Retries of polls must not overlap with the next tick
+        request_prefix = "%s/" % name if name is not None else ""
+        self._poll_request = ScheduledRequest(request_prefix + TASK_POLL, self._scheduler, poll_callback,
+                                              self.polling_interval, on_error=self._notify_error)
+        self._push_refresh_request = None
+        if push_refresh_callback is not None:
+            self._push_refresh_request = ScheduledRequest(request_prefix + TASK_PUSH_REFRESH, self._scheduler,
+                                                          push_refresh_callback, PUSH_REFRESH_DEADLINE,
+                                                          on_success=self._on_push_refresh_success,
+                                                          on_error=self._notify_error,
+                                                          max_attempt_time=self.polling_interval)
+        register_request_metrics(name, self.request_stats)
+
+        self._extra_poll_requests: List[ScheduledRequest] = []
+        self._executor = None
+        if extra_polls:
+            for extra_name, extra_callback in extra_polls.items():
+                request = ScheduledRequest("%s/%s" % (extra_name, TASK_POLL), self._scheduler, extra_callback,
+                                           self.polling_interval, on_error=self._notify_error)
+                register_request_metrics(extra_name, {TASK_POLL: request.stats})
+                self._extra_poll_requests.append(request)
+            self._executor = ThreadPoolExecutor(max_workers=len(self._extra_poll_requests) + 1,
+                                                thread_name_prefix="WLL-HTTP-Poll")
+        metrics.callback(metrics.SCHEDULER_FAILED, lambda: int(self.has_error), host=str(name))
+
         self._run = True
         self._scheduler_thread = threading.Thread(target=self._run_scheduler)
-        self._scheduler_thread.setName("WLL-HTTP-Scheduler")
+        self._scheduler_thread.setName("WLL-HTTP-Scheduler" if name is None else "WLL-HTTP-Scheduler-%s" % name)
         self._scheduler_thread.setDaemon(True)
         self._scheduler_thread.start()
 
@@ -85,9 +414,17 @@ class Scheduler(object):
             return
         raise self.error
 
+    @property
+    def request_stats(self) -> Dict[str, RequestStats]:
+        """Retry counts and latencies of all requests of the own device by task name"""
+        stats = {TASK_POLL: self._poll_request.stats}
+        if self._push_refresh_request is not None:
+            stats[TASK_PUSH_REFRESH] = self._push_refresh_request.stats
+        return stats
+
     def _notify_error(self, e: BaseException):
         self.error = e
-        self.data_event.set()
+        self.error_callback(e)
 
     def _run_scheduler(self):
         while self._run:
@@ -95,6 +432,10 @@ class Scheduler(object):
 
     def _scheduler_tick(self):
         log.debug("Scheduler tick")
+        now = time.time()
+        if self._next_tick_time is not None:
+            self._tick_drift.observe(max(0.0, now - self._next_tick_time))
+        next_tick_abs_time = now + self.polling_interval
 
         try:
             self._do_tick()
@@ -103,22 +444,46 @@ class Scheduler(object):
             self._notify_error(e)
             return
 
-        next_tick_abs_time = time.time() + self.polling_interval
-        log.debug("Next scheduler tick at %s" % _format_iso(next_tick_abs_time))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Next scheduler tick at %s", _format_iso(next_tick_abs_time))
         self._tick_task_id = self._scheduler.enterabs(next_tick_abs_time, 0, self._scheduler_tick)
+        self._next_tick_time = next_tick_abs_time
 
     def _do_tick(self):
-        log.debug("Notifying poll callback")
-        self._poll_callback()
+        polls = []
+        if self.adaptive_polling is None or self.adaptive_polling.poll_due(self.polling_interval):
+            log.debug("Notifying poll callback")
+            polls.append(self._poll_request)
+        else:
+            log.debug("Skipping poll while receiving broadcasts")
+        polls.extend(self._extra_poll_requests)
+        self._start_polls(polls)
 
-        if self._push_refresh_ticks >= self._push_refresh_tick_count:
+        if self._push_refresh_request is None:
+            return
+
+        # The push refresh stays due until it succeeded
+        if self._push_refresh_ticks >= self._push_refresh_tick_count and not self._push_refresh_request.is_pending:
             log.debug("Notifying push refresh callback")
-            self._push_refresh_callback(PUSH_DURATION)
-            self._push_refresh_ticks = 0
+            self._push_refresh_request.start(PUSH_DURATION)
 
         self._push_refresh_ticks += 1
-        log.debug(
-            "%d scheduler ticks until next push refresh" % (self._push_refresh_tick_count - self._push_refresh_ticks))
+        log.debug("%d scheduler ticks until next push refresh",
+                  max(0, self._push_refresh_tick_count - self._push_refresh_ticks))
+
+    def _on_push_refresh_success(self):
+        self._push_refresh_ticks = 0
+
+    def _start_polls(self, requests: List[ScheduledRequest]):
+        """Start polls. Polls of several devices run concurrently; the tick ends once all of them are done"""
+
+        if len(requests) < 2:
+            for request in requests:
+                request.start()
+            return
+
+        for future in [self._executor.submit(request.start) for request in requests]:
+            future.result()
 
     def cancel(self):
         log.debug("Cancelling scheduler")
@@ -128,8 +493,16 @@ class Scheduler(object):
             log.debug("Cancelling tick task")
             self._scheduler.cancel(self._tick_task_id)
 
+        self._poll_request.cancel()
+        if self._push_refresh_request is not None:
+            self._push_refresh_request.cancel()
+        for request in self._extra_poll_requests:
+            request.cancel()
+
         if not self._scheduler.empty():
             raise ValueError("Scheduler did not cancel all task")
 
         self._scheduler_thread.join(30)
+        if self._executor is not None:
+            self._executor.shutdown()
         log.info("All tasks cancelled")
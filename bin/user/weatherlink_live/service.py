@@ -19,29 +19,122 @@
 # SOFTWARE.
 
 import logging
-from typing import List, Dict
+import time
+from collections import deque
+from typing import List, Dict, Optional
 
+import weedb
 import weewx
-from user.weatherlink_live.mappers import AbstractMapping, WindMapping
+from user.weatherlink_live import aqi
+from user.weatherlink_live.mappers import AbstractMapping, WindMapping, AirLinkPMMapping
+from weeutil.weeutil import to_int
 from weewx.engine import StdService
 
 log = logging.getLogger(__name__)
 
 
+class GustState(object):
+    """
+    Max gust of one wind mapping
+
+    Without a window, the max gust is kept until reset. With a window, it is the max wind speed of the LOOP packets
+    of the last window seconds. Samples are kept ordered by time with decreasing speed, so older samples which can't
+    become the max again are dropped right away (monotonic queue). This updates the max in constant amortized time.
+    """
+
+    __slots__ = ('wind_speed_key', 'wind_dir_key', 'gust_speed_key', 'gust_dir_key', 'window', 'speed', 'dir',
+                 'written', 'samples')
+
+    def __init__(self, targets: Dict[str, str], window: float = 0):
+        self.wind_speed_key = targets['wind_speed']
+        self.wind_dir_key = targets['wind_dir']
+        self.gust_speed_key = targets['gust_speed']
+        self.gust_dir_key = targets['gust_dir']
+        self.window = window
+
+        self.speed: Optional[float] = None
+        self.dir: Optional[float] = None
+        # Gust last written to a packet
+        self.written = None
+        # Tuples of timestamp, speed and direction
+        self.samples = deque() if window > 0 else None
+
+    def clear(self):
+        self.speed = None
+        self.dir = None
+        self.written = None
+        if self.samples is not None:
+            self.samples.clear()
+
+    def add(self, timestamp: float, speed: float, direction: Optional[float]):
+        samples = self.samples
+        if samples is None:
+            if self.speed is None or speed >= self.speed:
+                self.speed = speed
+                self.dir = direction
+            return
+
+        while samples and samples[-1][1] <= speed:
+            samples.pop()
+        samples.append((timestamp, speed, direction))
+
+        expired = timestamp - self.window
+        while samples[0][0] <= expired:
+            samples.popleft()
+        _, self.speed, self.dir = samples[0]
+
+    def get_state(self) -> dict:
+        return {
+            'speed': self.speed,
+            'dir': self.dir,
+            'samples': list(self.samples) if self.samples is not None else None
+        }
+
+    def set_state(self, state: dict):
+        self.clear()
+        self.speed = state.get('speed')
+        self.dir = state.get('dir')
+        if self.samples is not None and state.get('samples'):
+            self.samples.extend(tuple(sample) for sample in state['samples'])
+
+    def mark_unwritten(self):
+        """Write the gust to the next record, even if it didn't change"""
+        self.written = None
+
+    def write_changed(self, record: dict) -> bool:
+        """Write the gust to the record if it changed since it was last written"""
+
+        gust = (self.speed, self.dir)
+        if gust == self.written:
+            return False
+
+        record[self.gust_speed_key] = self.speed
+        record[self.gust_dir_key] = self.dir
+        self.written = gust
+        return True
+
+
 class WllWindGustService(StdService):
-    """Service for calculating ARCHIVE records from LOOP wind measurements"""
+    """
+    Service for calculating ARCHIVE records from LOOP wind measurements
+
+    Gusts are only written to LOOP packets when they change. The max of each archive period is still contained in
+    its LOOP packets.
+    """
 
     def __init__(self, engine, config_dict, mappers: List[AbstractMapping], log_success: bool = False,
-                 log_failure: bool = True):
+                 log_failure: bool = True, gust_window: float = 0):
         super().__init__(engine, config_dict)
 
         self.mappers = mappers
         self.log_success = log_success
         self.log_failure = log_failure
+        self.gust_window = gust_window
+        self.archive_interval = to_int(config_dict.get('StdArchive', {}).get('archive_interval', 300))
 
-        self.map_targets = self._extract_map_sources()
-        self._log_success("Found %d wind mappings" % len(self.map_targets))
-        if len(self.map_targets) < 1:
+        self.states = [GustState(targets, gust_window) for targets in self._extract_map_sources()]
+        self._log_success("Found %d wind mappings", len(self.states))
+        if len(self.states) < 1:
             self._log_failure("No wind mappings available. Aborting service.")
             return
 
@@ -51,22 +144,42 @@ class WllWindGustService(StdService):
         self.bind(weewx.NEW_LOOP_PACKET, self.new_loop_packet)
         self.bind(weewx.END_ARCHIVE_PERIOD, self.end_archive_period)
 
-    def _log_success(self, message: str, level: int = logging.DEBUG):
-        if not self.log_success:
+    def _log_success(self, message: str, *args, level: int = logging.DEBUG):
+        if not self.log_success or not log.isEnabledFor(level):
+            return
+        log.log(level, "%s: " + message, type(self).__name__, *args)
+
+    def _log_failure(self, message: str, *args, level: int = logging.ERROR):
+        if not self.log_failure or not log.isEnabledFor(level):
             return
-        log.log(level, "%s: %s" % (type(self).__name__, message))
+        log.log(level, "%s: " + message, type(self).__name__, *args)
 
-    def _log_failure(self, message: str, level: int = logging.ERROR):
-        if not self.log_failure:
+    def get_state(self) -> dict:
+        """Max gusts by gust target"""
+        return dict([(state.gust_speed_key, state.get_state()) for state in self.states])
+
+    def set_state(self, gusts: dict, timestamp: float):
+        """
+        Restore max gusts saved at the timestamp. Without a rolling window, gusts of an archive period which ended
+        since are dropped
+        """
+
+        if self.gust_window <= 0 and timestamp // self.archive_interval != time.time() // self.archive_interval:
+            self._log_success("Archive period of saved gusts ended. Not restoring")
             return
-        log.log(level, "%s: %s" % (type(self).__name__, message))
+
+        for state in self.states:
+            if state.gust_speed_key in gusts:
+                state.set_state(gusts[state.gust_speed_key])
+                self._log_success("Restored max gust %s:%s", state.speed, state.dir)
 
     def _extract_map_sources(self) -> List[Dict[str, str]]:
         return [mapper.targets for mapper in self.mappers if isinstance(mapper, WindMapping)]
 
     def _clear(self):
         self._log_success("Clearing max gust values")
-        self.max_loop_gust = dict()
+        for state in self.states:
+            state.clear()
 
     def startup(self, event):
         self._log_success("Service startup")
@@ -75,35 +188,115 @@ class WllWindGustService(StdService):
     def new_loop_packet(self, event):
         record = event.packet
 
-        for wind_mapping in self.map_targets:
-            k_wind_dir = wind_mapping['wind_dir']
-            k_wind_speed = wind_mapping['wind_speed']
-            k_gust_dir = wind_mapping['gust_dir']
-            k_gust_speed = wind_mapping['gust_speed']
-
-            if k_wind_dir not in record or k_wind_speed not in record:
-                self._log_success("Wind observations %s:%s not in record" % (k_wind_speed, k_wind_dir))  # not an error
-                continue
-
-            current_speed = record[k_wind_speed]
-            current_dir = record[k_wind_dir]
-
-            max_gust_speed = self.max_loop_gust.get(k_gust_speed, 0.0)
-            max_gust_dir = self.max_loop_gust.get(k_gust_dir, None)
-
+        for state in self.states:
+            current_speed = record.get(state.wind_speed_key)
             if current_speed is None:
-                self._log_failure("Current wind speed is set but N/A. Skipping calculation", logging.INFO)
+                if state.wind_speed_key not in record or state.wind_dir_key not in record:
+                    self._log_success("Wind observations %s:%s not in record",
+                                      state.wind_speed_key, state.wind_dir_key)  # not an error
+                else:
+                    self._log_failure("Current wind speed is set but N/A. Skipping calculation", level=logging.INFO)
+                continue
+            if state.wind_dir_key not in record:
+                self._log_success("Wind observations %s:%s not in record",
+                                  state.wind_speed_key, state.wind_dir_key)  # not an error
                 continue
 
-            if max_gust_dir is None or current_speed >= max_gust_speed:
-                self._log_success("New wind vector %.02f:%s larger than %.02f:%s" % (
-                    current_speed, current_dir, max_gust_speed, max_gust_dir))
-                self.max_loop_gust[k_gust_speed] = current_speed
-                self.max_loop_gust[k_gust_dir] = current_dir
-
-            self._log_success("Updating record with dict: %s" % repr(self.max_loop_gust))
-            record.update(self.max_loop_gust)
+            state.add(record['dateTime'], current_speed, record[state.wind_dir_key])
+            if state.write_changed(record):
+                self._log_success("New max gust %.02f:%s", state.speed, state.dir)
 
     def end_archive_period(self, event):
         self._log_success("End of archive period")
+        if self.gust_window > 0:
+            # Rolling gusts span archive periods. A gust carried over must still be in a LOOP packet of the new period
+            for state in self.states:
+                state.mark_unwritten()
+            return
         self._clear()
+
+
+class WllNowCastService(StdService):
+    """
+    Service for calculating the EPA NowCast and AQI of particulate matter measured by an AirLink
+
+    The NowCasts are updated incrementally with each LOOP packet (see aqi.NowCast) and written to all LOOP packets
+    once available. On startup, the hourly averages are restored from the archive.
+    """
+
+    def __init__(self, engine, config_dict, mappers: List[AbstractMapping], log_success: bool = False,
+                 log_failure: bool = True):
+        super().__init__(engine, config_dict)
+
+        self.mappers = mappers
+        self.log_success = log_success
+        self.log_failure = log_failure
+        self.data_binding = config_dict.get('StdArchive', {}).get('data_binding', 'wx_binding')
+
+        pm_mappers = [mapper for mapper in self.mappers if isinstance(mapper, AirLinkPMMapping)]
+        if len(pm_mappers) < 1:
+            self._log_success("No PM mappings available. Not calculating NowCast")
+            return
+        if len(pm_mappers) > 1:
+            self._log_failure("Found %d PM mappings. Only using the first one", len(pm_mappers),
+                              level=logging.WARNING)
+
+        self.pm2_5_key = pm_mappers[0].targets['pm2p5']
+        self.pm10_key = pm_mappers[0].targets['pm10']
+        self.pm2_5 = aqi.NowCast(1)
+        self.pm10 = aqi.NowCast(0)
+        self.aqi: Optional[int] = None
+
+        self.bind(weewx.STARTUP, self.startup)
+        self.bind(weewx.NEW_LOOP_PACKET, self.new_loop_packet)
+
+    def _log_success(self, message: str, *args, level: int = logging.DEBUG):
+        if not self.log_success or not log.isEnabledFor(level):
+            return
+        log.log(level, "%s: " + message, type(self).__name__, *args)
+
+    def _log_failure(self, message: str, *args, level: int = logging.ERROR):
+        if not self.log_failure or not log.isEnabledFor(level):
+            return
+        log.log(level, "%s: " + message, type(self).__name__, *args)
+
+    def startup(self, event):
+        self._log_success("Service startup")
+        start = time.time() - aqi.NOWCAST_HOURS * 3600
+        try:
+            dbmanager = self.engine.db_binder.get_manager(self.data_binding, initialize=True)
+            count = 0
+            for record in dbmanager.genBatchRecords(start - start % 3600):
+                # Archive records are stamped with the end of their interval
+                timestamp = record['dateTime'] - (record.get('interval') or 1) * 60
+                self._add(timestamp, record.get(self.pm2_5_key), record.get(self.pm10_key))
+                count += 1
+        except (weedb.DatabaseError, weewx.UnknownBinding, weewx.UnknownDatabase, weewx.UnknownDatabaseType) as e:
+            self._log_failure("Could not restore hourly averages from archive: %s", e, level=logging.WARNING)
+            return
+        self._log_success("Restored hourly averages from %d archive records. NowCast PM2.5: %s, PM10: %s",
+                          count, self.pm2_5.value, self.pm10.value, level=logging.INFO)
+
+    def _add(self, timestamp: float, pm2_5: Optional[float], pm10: Optional[float]):
+        changed = self.pm2_5.add(timestamp, pm2_5)
+        changed = self.pm10.add(timestamp, pm10) or changed
+        if not changed:
+            return
+
+        indexes = [index for index in (aqi.pm2_5_aqi(self.pm2_5.value), aqi.pm10_aqi(self.pm10.value))
+                   if index is not None]
+        self.aqi = max(indexes) if indexes else None
+        self._log_success("New NowCast PM2.5: %s, PM10: %s, AQI: %s", self.pm2_5.value, self.pm10.value, self.aqi)
+
+    def new_loop_packet(self, event):
+        record = event.packet
+
+        if self.pm2_5_key in record or self.pm10_key in record:
+            self._add(record['dateTime'], record.get(self.pm2_5_key), record.get(self.pm10_key))
+
+        if self.pm2_5.value is not None:
+            record['nowcast_pm2_5'] = self.pm2_5.value
+        if self.pm10.value is not None:
+            record['nowcast_pm10'] = self.pm10.value
+        if self.aqi is not None:
+            record['aqi'] = self.aqi
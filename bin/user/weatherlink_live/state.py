@@ -0,0 +1,97 @@
+# Copyright © 2020-2021 Michael Schantl and contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Snapshot of driver state
+
+State of stateful mappers and services (e.g. the last daily rain count) is written to a JSON file, so it survives
+restarts of the driver. The file is replaced atomically, so a crash while writing leaves the previous snapshot.
+Snapshots older than the maximum age are ignored when loading.
+"""
+import json
+import logging
+import os
+import tempfile
+import time
+from typing import Optional
+
+log = logging.getLogger(__name__)
+
+STATE_VERSION = 1
+
+
+class StateStore(object):
+    """Load and save state snapshots"""
+
+    def __init__(self, path: str, max_age: float):
+        self.path = path
+        self.max_age = max_age
+
+    def load(self) -> Optional[dict]:
+        """
+        Load the last snapshot
+
+        :return: saved state including the time it was saved at ('time'), or None if there is no usable snapshot
+        """
+
+        try:
+            with open(self.path, "rb") as file:
+                snapshot = json.loads(file.read())
+        except FileNotFoundError:
+            log.info("No state snapshot found at %s", self.path)
+            return None
+        except (OSError, ValueError) as e:
+            log.warning("Could not read state snapshot %s: %s", self.path, e)
+            return None
+
+        if not isinstance(snapshot, dict) or snapshot.get("version") != STATE_VERSION:
+            log.warning("Ignoring state snapshot %s of unknown version", self.path)
+            return None
+
+        age = time.time() - snapshot.get("time", 0)
+        if age > self.max_age or age < 0:
+            log.info("Ignoring state snapshot saved %.0f seconds ago (max age: %.0f)", age, self.max_age)
+            return None
+
+        log.debug("Loaded state snapshot saved %.0f seconds ago", age)
+        return snapshot
+
+    def save(self, state: dict):
+        """Replace the snapshot. Errors are logged, but not raised"""
+
+        snapshot = dict(state, version=STATE_VERSION, time=time.time())
+        directory = os.path.dirname(os.path.abspath(self.path))
+        try:
+            fd, temp_path = tempfile.mkstemp(prefix=".wll-state-", dir=directory)
+            try:
+                with os.fdopen(fd, "w") as file:
+                    json.dump(snapshot, file, separators=(",", ":"))
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(temp_path, self.path)
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+        except OSError as e:
+            log.warning("Could not save state snapshot %s: %s", self.path, e)
+            return
+
+        log.debug("Saved state snapshot")
@@ -21,4 +21,41 @@
 KEY_DRIVER_POLLING_INTERVAL = 'polling_interval'
 KEY_DRIVER_HOST = "host"
 KEY_DRIVER_MAPPING = 'mapping'
+KEY_DRIVER_DEVICE_ID = "device_id"
 KEY_MAX_NO_DATA_ITERATIONS = "max_no_data_iterations"
+KEY_HTTP_POOL_SIZE = "http_pool_size"
+KEY_HTTP_KEEP_ALIVE = "http_keep_alive"
+KEY_ENGINE = "engine"
+KEY_JSON_DECODER = "json_decoder"
+KEY_CAPTURE_FILE = "capture_file"
+KEY_QUEUE_CAPACITY = "queue_capacity"
+KEY_QUEUE_POLICY = "queue_policy"
+KEY_MERGE_WINDOW = "merge_window"
+KEY_ADAPTIVE_POLLING = "adaptive_polling"
+KEY_ADAPTIVE_POLLING_INTERVAL = "adaptive_polling_interval"
+KEY_OMIT_UNCHANGED = "omit_unchanged"
+KEY_METRICS = "metrics"
+KEY_METRICS_LOG_INTERVAL = "metrics_log_interval"
+KEY_METRICS_LOOP_INTERVAL = "metrics_loop_interval"
+KEY_METRICS_PORT = "metrics_port"
+KEY_METRICS_ADDRESS = "metrics_address"
+KEY_TRACE_INTERVAL = "trace_interval"
+KEY_TRACE_SAMPLE_RATE = "trace_sample_rate"
+KEY_GUST_WINDOW = "gust_window"
+KEY_STATE_FILE = "state_file"
+KEY_STATE_SAVE_INTERVAL = "state_save_interval"
+KEY_STATE_MAX_AGE = "state_max_age"
+KEY_REPLAY_FILE = "replay_file"
+KEY_REPLAY_SPEED = "replay_speed"
+
+ENGINE_THREADED = "threaded"
+ENGINE_ASYNCIO = "asyncio"
+
+JSON_DECODER_AUTO = "auto"
+JSON_DECODER_ORJSON = "orjson"
+JSON_DECODER_UJSON = "ujson"
+JSON_DECODER_JSON = "json"
+
+QUEUE_POLICY_DROP_OLDEST = "drop_oldest"
+QUEUE_POLICY_COALESCE = "coalesce"
+QUEUE_POLICY_BLOCK = "block"
@@ -26,6 +26,9 @@ class DataStructureType(IntEnum):
     LEAF_SOIL = 2
     WLL_BARO = 3
     WLL_TH = 4
+    # Early AirLink firmware named PM10 fields pm_10p0*
+    AIRLINK_LEGACY = 5
+    AIRLINK = 6
 
 
 KEY_DEVICE_ID = "did"
@@ -34,6 +37,7 @@ KEY_TS = "ts"
 KEY_CONDITIONS = "conditions"
 KEY_DATA_STRUCTURE_TYPE = "data_structure_type"
 KEY_TRANSMITTER_ID = "txid"
+KEY_LSID = "lsid"
 KEY_BATTERY_FLAG = "trans_battery_flag"
 
 KEY_TEMPERATURE = "temp"
@@ -49,6 +53,7 @@ KEY_WIND_DIR = "wind_dir_last"
 KEY_RAIN_SIZE = "rain_size"
 KEY_RAIN_RATE = "rain_rate_last"
 KEY_RAIN_AMOUNT_DAILY = "rainfall_daily"
+KEY_RAIN_AMOUNT_YEARLY = "rainfall_year"
 KEY_SOLAR_RADIATION = "solar_rad"
 KEY_UV_INDEX = "uv_index"
 
@@ -63,3 +68,19 @@ KEY_HEAT_INDEX_INDOOR = "heat_index_in"
 
 KEY_BARO_ABSOLUTE = "bar_absolute"
 KEY_BARO_SEA_LEVEL = "bar_sea_level"
+
+KEY_PM_1_LAST = "pm_1_last"
+KEY_PM_2P5_LAST = "pm_2p5_last"
+KEY_PM_10_LAST = "pm_10_last"
+KEY_PM_1 = "pm_1"
+KEY_PM_2P5 = "pm_2p5"
+KEY_PM_2P5_1_HOUR = "pm_2p5_last_1_hour"
+KEY_PM_2P5_3_HOURS = "pm_2p5_last_3_hours"
+KEY_PM_2P5_24_HOURS = "pm_2p5_last_24_hours"
+KEY_PM_2P5_NOWCAST = "pm_2p5_nowcast"
+KEY_PM_10 = "pm_10"
+KEY_PM_10_1_HOUR = "pm_10_last_1_hour"
+KEY_PM_10_3_HOURS = "pm_10_last_3_hours"
+KEY_PM_10_24_HOURS = "pm_10_last_24_hours"
+KEY_PM_10_NOWCAST = "pm_10_nowcast"
+KEY_PM_10_LEGACY_PREFIX = "pm_10p0"
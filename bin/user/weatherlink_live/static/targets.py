@@ -77,6 +77,12 @@ WIND_GUST_DIR = ["windGustDir"]
 WIND_SPEED = ["windSpeed"]
 WIND_DIR = ["windDir"]
 
+# WIND AVERAGE
+WIND_SPEED_AVG = ["windSpeedAvg"]
+WIND_DIR_AVG = ["windDirAvg"]
+WIND_SPEED_MIN = ["windSpeedMin"]
+WIND_SPEED_MAX = ["windSpeedMax"]
+
 # RAIN
 RAIN_AMOUNT = ["rain"]
 RAIN_RATE = ["rainRate"]
@@ -84,6 +90,11 @@ RAIN_COUNT = ["rainCount"]
 RAIN_COUNT_RATE = ["rainCountRate"]
 RAIN_SIZE = ["rainSize"]
 
+# RAIN RATE AVERAGE
+RAIN_RATE_1 = ["rainRate1"]
+RAIN_RATE_10 = ["rainRate10"]
+RAIN_RATE_15 = ["rainRate15"]
+
 # SOLAR
 SOLAR_RADIATION = ["radiation"]
 
@@ -136,6 +147,21 @@ BARO_SEA_LEVEL = ["altimeter"]  # the WLL doesn't use temperature to calculate s
 PM1 = ["pm1_0"]
 PM2p5 = ["pm2_5"]
 PM10 = ["pm10_0"]
+PM1_LAST = ["pm1_0_last"]
+PM2p5_LAST = ["pm2_5_last"]
+PM10_LAST = ["pm10_0_last"]
+PM2p5_1_HOUR = ["pm2_5_1hour"]
+PM2p5_3_HOURS = ["pm2_5_3hour"]
+PM2p5_24_HOURS = ["pm2_5_24hour"]
+PM2p5_NOWCAST = ["pm2_5_nowcast"]
+PM10_1_HOUR = ["pm10_0_1hour"]
+PM10_3_HOURS = ["pm10_0_3hour"]
+PM10_24_HOURS = ["pm10_0_24hour"]
+PM10_NOWCAST = ["pm10_0_nowcast"]
+
+# AIRLINK AQI
+PM2p5_AQI = ["pm2_5_aqi"]
+PM10_AQI = ["pm10_0_aqi"]
 
 # Battery status
 BATTERY_STATUS = ['batteryStatus1',
@@ -0,0 +1,72 @@
+# Copyright © 2020-2021 Michael Schantl and contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Packet tracing for debugging
+
+Logs packets together with the record mapped from them. To keep the log readable at broadcast rates, tracing is
+rate limited to one packet per interval and can be sampled, so that traced packets aren't always the first one
+after the interval passed.
+
+Traces are logged at level INFO using the logger of this module, so they can be routed separately.
+"""
+import logging
+import random
+import time
+from typing import Optional
+
+from user.weatherlink_live.packets import DavisConditionsPacket
+
+log = logging.getLogger(__name__)
+
+
+class PacketTracer(object):
+    """Rate limited and sampled logging of packets and their records"""
+
+    def __init__(self, interval: float, sample_rate: float = 1.0, name: Optional[str] = None):
+        if interval <= 0:
+            raise ValueError("Trace interval must be larger than 0 (got: %f)" % interval)
+        if not 0 < sample_rate <= 1:
+            raise ValueError("Trace sample rate must be larger than 0 and not larger than 1 (got: %f)" % sample_rate)
+
+        self.interval = interval
+        self.sample_rate = sample_rate
+        self.name = name
+
+        self.traced_count = 0
+        self._next_time = 0.0
+
+    def is_due(self) -> bool:
+        """Check if the next packet should be traced. Only call trace() if this is true"""
+
+        if time.monotonic() < self._next_time:
+            return False
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def trace(self, packet: DavisConditionsPacket, record: dict, duration: float):
+        self._next_time = time.monotonic() + self.interval
+        self.traced_count += 1
+
+        if not log.isEnabledFor(logging.INFO):
+            return
+        log.info("Trace of %s packet of %s at %d (mapped in %.1f us): conditions=%r record=%r",
+                 packet.data_source.name, self.name or packet.host, packet.timestamp, duration * 1e6,
+                 packet._conditions, record)
@@ -40,15 +40,26 @@ class WeatherLinkLiveInstaller(ExtensionInstaller):
             files=[
                 ('bin/user/weatherlink_live', [
                     'bin/user/weatherlink_live/__init__.py',
+                    'bin/user/weatherlink_live/aqi.py',
+                    'bin/user/weatherlink_live/async_engine.py',
+                    'bin/user/weatherlink_live/capture.py',
                     'bin/user/weatherlink_live/callback.py',
                     'bin/user/weatherlink_live/configuration.py',
                     'bin/user/weatherlink_live/data_host.py',
                     'bin/user/weatherlink_live/davis_broadcast.py',
                     'bin/user/weatherlink_live/davis_http.py',
+                    'bin/user/weatherlink_live/exporter.py',
+                    'bin/user/weatherlink_live/json_decoder.py',
                     'bin/user/weatherlink_live/mappers.py',
+                    'bin/user/weatherlink_live/merger.py',
+                    'bin/user/weatherlink_live/metrics.py',
                     'bin/user/weatherlink_live/packets.py',
+                    'bin/user/weatherlink_live/replay.py',
+                    'bin/user/weatherlink_live/rolling.py',
                     'bin/user/weatherlink_live/scheduler.py',
                     'bin/user/weatherlink_live/service.py',
+                    'bin/user/weatherlink_live/state.py',
+                    'bin/user/weatherlink_live/tracing.py',
                     'bin/user/weatherlink_live/utils.py',
                 ]),
                 ('bin/user/weatherlink_live/static', [
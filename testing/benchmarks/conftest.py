@@ -0,0 +1,156 @@
+# Copyright © 2020-2021 Michael Schantl and contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Benchmarks of the driver, run using pytest-benchmark:
+
+    python3 -m pytest testing/benchmarks
+
+Packets are taken from a Vantage Pro2 Plus with indoor and barometer sensors, mapped using the default mapping.
+"""
+import importlib.util
+import json
+import os
+import sys
+
+import pytest
+
+# The driver is installed into WeeWX's bin directory, so it is imported as package user.weatherlink_live
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, "bin"))
+
+if importlib.util.find_spec("pytest_benchmark") is None:
+    # Skip the benchmarks instead of failing test runs without pytest-benchmark
+    collect_ignore_glob = ["test_*.py"]
+
+DRIVER_NAME = "WeatherLinkLive"
+HOST = "weatherlink"
+MAPPING = "th:1, th_indoor, baro, rain:1, wind:1, thw:1:appTemp, windchill:1, battery:1:outTemp:rain:wind"
+
+CONDITIONS = {"data": {"did": "001D0A700002", "ts": 1646165700, "conditions": [
+    {"lsid": 1, "data_structure_type": 1, "txid": 1, "temp": 56.4, "hum": 93, "dew_point": 54.4, "wet_bulb": 55.2,
+     "heat_index": 56.7, "wind_chill": 56.4, "thw_index": 56.7, "thsw_index": None, "wind_speed_last": 1.0,
+     "wind_dir_last": 180, "wind_speed_avg_last_1_min": 1.2, "wind_dir_scalar_avg_last_1_min": 178,
+     "wind_speed_avg_last_2_min": 1.1, "wind_dir_scalar_avg_last_2_min": 181, "wind_speed_hi_last_2_min": 3.0,
+     "wind_dir_at_hi_speed_last_2_min": 190, "wind_speed_avg_last_10_min": 1.0, "wind_dir_scalar_avg_last_10_min": 176,
+     "wind_speed_hi_last_10_min": 5.0, "wind_dir_at_hi_speed_last_10_min": 247, "rain_size": 1, "rain_rate_last": 0,
+     "rain_rate_hi": 0, "rainfall_last_15_min": 0, "rain_rate_hi_last_15_min": 0, "rainfall_last_60_min": 2,
+     "rainfall_last_24_hr": 4, "rain_storm": 4, "rain_storm_start_at": 1646162220, "solar_rad": 10, "uv_index": 0.1,
+     "rx_state": 0, "trans_battery_flag": 0, "rainfall_daily": 4, "rainfall_monthly": 4, "rainfall_year": 1039,
+     "rain_storm_last": None, "rain_storm_last_start_at": None, "rain_storm_last_end_at": None},
+    {"lsid": 3, "data_structure_type": 4, "temp_in": 66.9, "hum_in": 46.6, "dew_point_in": 45.8,
+     "heat_index_in": 65.2},
+    {"lsid": 2, "data_structure_type": 3, "bar_sea_level": 30.36, "bar_trend": 0.062, "bar_absolute": 30.253}]},
+    "error": None}
+
+BROADCAST = {"did": "001D0A700002", "ts": 1646168724, "conditions": [
+    {"lsid": 1, "data_structure_type": 1, "txid": 1, "wind_speed_last": 1.43, "wind_dir_last": 183, "rain_size": 1,
+     "rain_rate_last": 0, "rain_15_min": 0, "rain_60_min": 2, "rain_24_hr": 4, "rain_storm": 4,
+     "rain_storm_start_at": 1646162220, "rainfall_daily": 4, "rainfall_monthly": 4, "rainfall_year": 1039,
+     "wind_speed_hi_last_10_min": 5.00, "wind_dir_at_hi_speed_last_10_min": 247}]}
+
+
+def _driver_config(**options) -> dict:
+    driver_dict = {'host': HOST, 'mapping': [mapping.strip() for mapping in MAPPING.split(",")]}
+    driver_dict.update(options)
+    return {DRIVER_NAME: driver_dict}
+
+
+class ServiceEngine(object):
+    """Minimal engine for running the services of the driver outside of WeeWX"""
+
+    def __init__(self):
+        self.callbacks = dict()
+
+    def bind(self, event_type, callback):
+        self.callbacks.setdefault(event_type, []).append(callback)
+
+
+@pytest.fixture
+def driver_config():
+    """Create the configuration dict of the driver, using the default mapping"""
+    return _driver_config
+
+
+@pytest.fixture
+def service_engine() -> ServiceEngine:
+    return ServiceEngine()
+
+
+@pytest.fixture
+def conditions_data() -> bytes:
+    return json.dumps(CONDITIONS).encode("utf-8")
+
+
+@pytest.fixture
+def broadcast_data() -> bytes:
+    return json.dumps(BROADCAST).encode("utf-8")
+
+
+@pytest.fixture
+def configuration():
+    from user.weatherlink_live.configuration import create_configuration
+
+    return create_configuration(_driver_config(), DRIVER_NAME)
+
+
+@pytest.fixture
+def mappers(configuration):
+    return configuration.create_mappers()
+
+
+@pytest.fixture
+def mapping_plan(configuration, mappers):
+    return configuration.create_mapping_plan(mappers, HOST)
+
+
+@pytest.fixture
+def wind_service(service_engine, mappers):
+    from user.weatherlink_live.service import WllWindGustService
+
+    return WllWindGustService(service_engine, {}, mappers)
+
+
+@pytest.fixture
+def broadcast_packets():
+    """Create a new broadcast packet for every call, each one newer than the one before"""
+
+    from user.weatherlink_live.packets import WlUdpBroadcastPacket
+
+    timestamps = iter(range(BROADCAST['ts'], BROADCAST['ts'] + 10 ** 9))
+
+    def create():
+        return WlUdpBroadcastPacket(dict(BROADCAST, ts=next(timestamps)), HOST)
+
+    return create
+
+
+@pytest.fixture
+def conditions_packets():
+    """Create a new conditions packet for every call, each one newer than the one before"""
+
+    from user.weatherlink_live.packets import WlHttpConditionsRequestPacket
+
+    timestamps = iter(range(CONDITIONS['data']['ts'], CONDITIONS['data']['ts'] + 10 ** 9))
+
+    def create():
+        return WlHttpConditionsRequestPacket(dict(CONDITIONS, data=dict(CONDITIONS['data'], ts=next(timestamps))), HOST)
+
+    return create
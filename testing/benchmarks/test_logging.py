@@ -0,0 +1,76 @@
+# Copyright © 2020-2021 Michael Schantl and contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Cost of logging on the hot path: mapping a packet and running the wind service with logging disabled and enabled
+"""
+import io
+import logging
+
+import pytest
+
+import weewx
+from conftest import DRIVER_NAME, HOST
+
+
+@pytest.fixture(params=["disabled", "filtered", "enabled"])
+def log_level(request):
+    """
+    Log debug messages of the driver to an in-memory stream
+
+    - disabled: option log_success is off
+    - filtered: option log_success is on, but debug messages are filtered by level, so they are never formatted
+    - enabled: option log_success is on and debug messages are formatted like WeeWX does
+    """
+
+    logger = logging.getLogger("user.weatherlink_live")
+    stream = io.StringIO()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter("%(asctime)s weewx[%(process)d] %(levelname)s %(name)s: %(message)s"))
+    previous = logger.level, logger.propagate
+    logger.addHandler(handler)
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG if request.param == "enabled" else logging.INFO)
+    yield request.param
+    logger.removeHandler(handler)
+    logger.setLevel(previous[0])
+    logger.propagate = previous[1]
+    if request.param == "enabled":
+        assert stream.getvalue(), "Nothing was logged"
+
+
+def test_logging(benchmark, log_level, driver_config, service_engine, broadcast_packets):
+    from user.weatherlink_live.configuration import create_configuration
+    from user.weatherlink_live.service import WllWindGustService
+
+    # Mappers and services only log their results if told so
+    log_success = log_level != "disabled"
+    configuration = create_configuration(dict(driver_config(), log_success=log_success), DRIVER_NAME)
+    mappers = configuration.create_mappers()
+    mapping_plan = configuration.create_mapping_plan(mappers, HOST)
+    wind_service = WllWindGustService(service_engine, {}, mappers, log_success=log_success)
+
+    def run(packet):
+        record = {'dateTime': packet.timestamp, 'usUnits': weewx.US}
+        mapping_plan.map(packet, record)
+        wind_service.new_loop_packet(weewx.Event(weewx.NEW_LOOP_PACKET, packet=record))
+
+    benchmark.pedantic(run, setup=lambda: ((broadcast_packets(),), {}), rounds=5000)
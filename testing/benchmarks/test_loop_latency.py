@@ -0,0 +1,60 @@
+# Copyright © 2020-2021 Michael Schantl and contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Latency of handing records over from the threads of the hosts to the driver loop
+"""
+import threading
+import time
+
+import pytest
+
+from user.weatherlink_live.data_host import PacketQueue
+
+RECORDS = 500
+
+
+@pytest.mark.parametrize("interval", [0, 0.001])
+def test_loop_latency(benchmark, interval):
+    """
+    Time from queueing a record in a producer thread until the driver loop got it
+
+    With an interval of 0 records are queued as fast as possible, otherwise the driver loop is waiting for each one.
+    """
+
+    def run():
+        queue = PacketQueue(RECORDS)
+
+        def produce():
+            for i in range(RECORDS):
+                queue.append({'dateTime': i})
+                if interval:
+                    time.sleep(interval)
+
+        producer = threading.Thread(target=produce)
+        producer.start()
+        for _ in range(RECORDS):
+            assert queue.get(5) is not None
+        producer.join()
+        return queue
+
+    queue = benchmark.pedantic(run, rounds=5)
+    benchmark.extra_info['avg_latency_us'] = round(queue.avg_latency * 1e6, 1)
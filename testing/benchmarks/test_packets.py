@@ -0,0 +1,65 @@
+# Copyright © 2020-2021 Michael Schantl and contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Lookup of conditions records using the index of a packet, compared to scanning the conditions of the packet
+"""
+import pytest
+
+from user.weatherlink_live.static import PacketSource
+from user.weatherlink_live.static.packets import KEY_DATA_STRUCTURE_TYPE, KEY_TRANSMITTER_ID
+
+
+def _scan(packet, dst, tx) -> list:
+    """Find conditions records by scanning all of them, as done before packets were indexed"""
+
+    return [conditions for conditions in packet.conditions
+            if (dst is None or conditions.get(KEY_DATA_STRUCTURE_TYPE) == dst)
+            and (tx is None or conditions.get(KEY_TRANSMITTER_ID) == tx)]
+
+
+def _lookups(mapping_plan) -> list:
+    """Combinations of dst and tx id looked up when mapping a polled packet"""
+
+    return [(dst, tx) for dst, tx, _, _, _ in mapping_plan.entries[PacketSource.WEATHER_POLL]]
+
+
+@pytest.mark.parametrize("find", ["index", "scan"])
+def test_find_conditions(benchmark, mapping_plan, conditions_packets, find):
+    lookups = _lookups(mapping_plan)
+
+    if find == "index":
+        def find_all(packet):
+            return [packet.find_conditions(dst, tx) for dst, tx in lookups]
+    else:
+        def find_all(packet):
+            return [_scan(packet, dst, tx) for dst, tx in lookups]
+
+    # Each round looks up the conditions of a new packet, including building its index
+    found = benchmark.pedantic(find_all, setup=lambda: ((conditions_packets(),), {}), rounds=5000)
+    benchmark.extra_info['lookups'] = len(lookups)
+    assert all(found)
+
+
+def test_find_conditions_equal_to_scan(mapping_plan, conditions_packets):
+    packet = conditions_packets()
+    for dst, tx in _lookups(mapping_plan) + [(None, None), (None, 1), (1, None), (2, 1)]:
+        assert packet.find_conditions(dst, tx) == _scan(packet, dst, tx)
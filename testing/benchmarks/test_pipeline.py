@@ -0,0 +1,194 @@
+# Copyright © 2020-2021 Michael Schantl and contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Throughput and latency of each stage a packet passes: decoding, packet construction, mapping and the wind service
+"""
+import json
+
+import pytest
+
+import weewx
+from user.weatherlink_live import json_decoder, replay
+from user.weatherlink_live.capture import CaptureWriter, KIND_BROADCAST, KIND_CONDITIONS
+from user.weatherlink_live.davis_broadcast import BroadcastDispatcher, BroadcastSubscription, RECEIVE_BUFFER_SIZE
+from user.weatherlink_live.packets import WlUdpBroadcastPacket, WlHttpConditionsRequestPacket
+from user.weatherlink_live.static.config import JSON_DECODER_JSON, JSON_DECODER_ORJSON, JSON_DECODER_UJSON
+
+HOST = "weatherlink"
+
+
+def _packets_per_second(benchmark):
+    # No stats are collected when running using --benchmark-disable
+    if benchmark.stats:
+        benchmark.extra_info['packets_per_second'] = round(1 / benchmark.stats.stats.mean)
+
+
+def _received(data: bytes) -> memoryview:
+    """Datagram as received into the re-used buffer of the broadcast receiver"""
+
+    buffer = bytearray(RECEIVE_BUFFER_SIZE)
+    buffer[:len(data)] = data
+    return memoryview(buffer)[:len(data)]
+
+
+@pytest.mark.parametrize("decoder", [JSON_DECODER_JSON, JSON_DECODER_ORJSON, JSON_DECODER_UJSON])
+def test_decode_broadcast(benchmark, broadcast_data, decoder):
+    pytest.importorskip(decoder)
+    _, loads = json_decoder.create_decoder(decoder)
+
+    assert benchmark(loads, _received(broadcast_data))['did'] == "001D0A700002"
+
+
+def test_decode_broadcast_via_str(benchmark, broadcast_data):
+    """Decoding a copy of the datagram to str first, as done before the pluggable decoders"""
+
+    received = _received(broadcast_data)
+    assert benchmark(lambda: json.loads(bytes(received).decode("utf-8")))['did'] == "001D0A700002"
+
+
+def test_decode_conditions(benchmark, conditions_data):
+    assert benchmark(json_decoder.loads, conditions_data)['data']['did'] == "001D0A700002"
+
+
+def test_packet_broadcast(benchmark, broadcast_data):
+    json_data = json.loads(broadcast_data)
+    benchmark(WlUdpBroadcastPacket.try_create, json_data, HOST)
+
+
+def test_packet_conditions(benchmark, conditions_data):
+    json_data = json.loads(conditions_data)
+    benchmark(WlHttpConditionsRequestPacket.try_create, json_data, HOST)
+
+
+@pytest.mark.parametrize("source", ["broadcast", "conditions"])
+def test_mapping(benchmark, mapping_plan, broadcast_packets, conditions_packets, source):
+    create_packet = broadcast_packets if source == "broadcast" else conditions_packets
+
+    # Packets index their conditions on first use, so each round maps a new packet
+    record = benchmark.pedantic(_map, setup=lambda: ((mapping_plan, create_packet()), {}), rounds=2000)
+    _packets_per_second(benchmark)
+    assert record
+
+
+@pytest.mark.parametrize("source", ["broadcast", "conditions"])
+def test_mapping_per_mapper(benchmark, mappers, broadcast_packets, conditions_packets, source):
+    """Calling each mapper on its own, as done before mappers were compiled into a mapping plan"""
+
+    create_packet = broadcast_packets if source == "broadcast" else conditions_packets
+
+    def map_each(packet):
+        record = dict()
+        for mapper in mappers:
+            mapper.map(packet, record)
+        return record
+
+    record = benchmark.pedantic(map_each, setup=lambda: ((create_packet(),), {}), rounds=2000)
+    assert record
+
+
+def test_wind_service(benchmark, mapping_plan, wind_service, broadcast_packets):
+    records = [_map(mapping_plan, broadcast_packets()) for _ in range(1000)]
+    events = iter([weewx.Event(weewx.NEW_LOOP_PACKET, packet=record) for record in records * 10])
+
+    benchmark.pedantic(lambda: wind_service.new_loop_packet(next(events)), rounds=len(records) * 10)
+    _packets_per_second(benchmark)
+
+
+def test_broadcast_pipeline(benchmark, broadcast_data, mapping_plan, wind_service):
+    """All stages of a received broadcast, from dispatching the datagram to the wind service"""
+
+    class Callback(object):
+        def on_packet_received(self, packet):
+            record = _map(mapping_plan, packet)
+            wind_service.new_loop_packet(weewx.Event(weewx.NEW_LOOP_PACKET, packet=record))
+
+        def on_packet_receive_error(self, e):
+            raise e
+
+    dispatcher = BroadcastDispatcher(22222)
+    dispatcher.subscribe(BroadcastSubscription("127.0.0.1", Callback()))
+
+    broadcast = json.loads(broadcast_data)
+    datagrams = iter([_received(json.dumps(dict(broadcast, ts=broadcast['ts'] + i)).encode("utf-8"))
+                      for i in range(20000)])
+    benchmark.pedantic(lambda: dispatcher.dispatch(next(datagrams), ("127.0.0.1", 22222)), rounds=20000)
+    _packets_per_second(benchmark)
+
+
+@pytest.fixture
+def restore_decoder():
+    decoder = json_decoder.decoder_name
+    yield
+    json_decoder.use_decoder(decoder)
+
+
+@pytest.mark.parametrize("decoder", [JSON_DECODER_JSON, JSON_DECODER_ORJSON, JSON_DECODER_UJSON])
+def test_replay(benchmark, tmp_path, driver_config, service_engine, broadcast_data, conditions_data, restore_decoder,
+                decoder):
+    """Replaying a capture of an hour through the driver loop, reporting packets/s and the time spent per stage"""
+
+    pytest.importorskip(decoder)
+
+    broadcast = json.loads(broadcast_data)
+    conditions = json.loads(conditions_data)
+    path = str(tmp_path / "capture.log")
+    writer = CaptureWriter(path)
+    for i in range(0, 3600, 3):
+        timestamp = broadcast['ts'] + i
+        writer.write(KIND_BROADCAST, HOST, json.dumps(dict(broadcast, ts=timestamp)).encode("utf-8"), timestamp)
+        if i % 60 == 0:
+            data = json.dumps(dict(conditions, data=dict(conditions['data'], ts=timestamp)))
+            writer.write(KIND_CONDITIONS, HOST, data.encode("utf-8"), timestamp)
+    writer.close()
+
+    def run():
+        driver = replay.ReplayDriver(driver_config(replay_file=path, replay_speed=0, json_decoder=decoder),
+                                     service_engine)
+        try:
+            for _ in driver.genLoopPackets():
+                pass
+        except weewx.StopNow:
+            pass
+        finally:
+            driver.closePort()
+        return driver
+
+    driver = benchmark.pedantic(run, rounds=5)
+
+    stats = driver.stats
+    assert stats.packets == 1260
+    assert json_decoder.decoder_name == decoder
+    if not benchmark.stats:
+        return
+    benchmark.extra_info['packets'] = stats.packets
+    benchmark.extra_info['packets_per_second'] = round(stats.packets / benchmark.stats.stats.mean)
+    for stage in (replay.STAGE_DECODE, replay.STAGE_PACKET, replay.STAGE_MAPPING):
+        benchmark.extra_info['%s_us' % stage] = round(stats.avg_duration(stage) * 1e6, 1)
+    benchmark.extra_info['queue_us'] = round(driver.packets.avg_latency * 1e6, 1)
+
+
+def _map(mapping_plan, packet) -> dict:
+    record = dict()
+    mapping_plan.map(packet, record)
+    record['dateTime'] = packet.timestamp
+    record['usUnits'] = weewx.US
+    return record
@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+# Copyright © 2020-2021 Michael Schantl and contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Stand-in for a WeatherLink Live for load and soak testing of the driver
+
+Serves /v1/current_conditions and /v1/real_time and sends UDP broadcasts while they have been requested.
+Only depends on the Python standard library.
+
+Example (10 broadcasts per second, two ISS transmitters, some faults):
+
+    sudo wll-simulator.py --bind 127.0.0.2 --broadcast-address 127.0.0.1 --rate 10 \\
+        --sensors iss:1,iss:2,leaf_soil:3,baro,th --error-rate 0.05 --malformed-rate 0.01
+
+Then set host = 127.0.0.2 in the driver configuration. The HTTP port must be 80 (the default), since the driver
+always connects to that port.
+"""
+import argparse
+import json
+import logging
+import random
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+log = logging.getLogger("wll-simulator")
+
+DATA_STRUCTURE_TYPES = {
+    'iss': 1,
+    'leaf_soil': 2,
+    'baro': 3,
+    'th': 4
+}
+
+
+class Sensor(object):
+    """Sensor producing slowly changing values"""
+
+    def __init__(self, lsid: int, data_structure_type: int, txid: Optional[int]):
+        self.lsid = lsid
+        self.data_structure_type = data_structure_type
+        self.txid = txid
+
+        self.random = random.Random(lsid)
+        self.values: Dict[str, float] = dict()
+
+    def _walk(self, key: str, initial: float, step: float, minimum: float, maximum: float) -> float:
+        value = self.values.get(key, initial) + self.random.uniform(-step, step)
+        value = min(max(value, minimum), maximum)
+        self.values[key] = value
+        return value
+
+    def conditions(self, ts: int) -> dict:
+        record = {"lsid": self.lsid, "data_structure_type": self.data_structure_type}
+        if self.txid is not None:
+            record["txid"] = self.txid
+        record.update(self._observations(ts))
+        return record
+
+    def broadcast_conditions(self, ts: int) -> Optional[dict]:
+        """Conditions included in broadcasts. Only ISS sensors are broadcast"""
+        return None
+
+    def _observations(self, ts: int) -> dict:
+        raise NotImplementedError("Abstract type")
+
+
+class IssSensor(Sensor):
+    def __init__(self, lsid: int, txid: int):
+        super().__init__(lsid, DATA_STRUCTURE_TYPES['iss'], txid)
+        self.rain_count = 0
+
+    def _wind_rain(self) -> dict:
+        wind_speed = self._walk("wind_speed", 3, 1, 0, 60)
+        wind_dir = int(self._walk("wind_dir", 180, 20, 1, 360))
+        rain_rate = int(self._walk("rain_rate", 0, 2, 0, 40))
+        if rain_rate > 0 and self.random.random() < 0.3:
+            self.rain_count += 1
+
+        return {
+            "wind_speed_last": round(wind_speed, 2),
+            "wind_dir_last": wind_dir,
+            "rain_size": 1,
+            "rain_rate_last": rain_rate,
+            "rainfall_daily": self.rain_count,
+            "rainfall_monthly": self.rain_count,
+            "rainfall_year": self.rain_count,
+            "trans_battery_flag": 0
+        }
+
+    def _observations(self, ts: int) -> dict:
+        temp = self._walk("temp", 60, 0.2, -20, 110)
+        hum = self._walk("hum", 60, 0.5, 5, 100)
+        observations = {
+            "temp": round(temp, 1),
+            "hum": round(hum, 1),
+            "dew_point": round(temp - (100 - hum) / 2.8, 1),
+            "wet_bulb": round(temp - (100 - hum) / 6, 1),
+            "heat_index": round(temp, 1),
+            "wind_chill": round(temp, 1),
+            "thw_index": round(temp, 1),
+            "thsw_index": round(temp + 2, 1),
+            "solar_rad": int(self._walk("solar_rad", 300, 20, 0, 1200)),
+            "uv_index": round(self._walk("uv_index", 2, 0.1, 0, 12), 1)
+        }
+        observations.update(self._wind_rain())
+        return observations
+
+    def broadcast_conditions(self, ts: int) -> Optional[dict]:
+        record = {"lsid": self.lsid, "data_structure_type": self.data_structure_type, "txid": self.txid}
+        record.update(self._wind_rain())
+        return record
+
+
+class LeafSoilSensor(Sensor):
+    def __init__(self, lsid: int, txid: int):
+        super().__init__(lsid, DATA_STRUCTURE_TYPES['leaf_soil'], txid)
+
+    def _observations(self, ts: int) -> dict:
+        observations = {"trans_battery_flag": 0}
+        for i in range(1, 5):
+            observations["temp_%d" % i] = round(self._walk("temp_%d" % i, 55, 0.1, 20, 90), 1)
+            observations["moist_soil_%d" % i] = int(self._walk("moist_soil_%d" % i, 30, 1, 0, 200))
+        for i in range(1, 3):
+            observations["wet_leaf_%d" % i] = int(self._walk("wet_leaf_%d" % i, 3, 0.5, 0, 15))
+        return observations
+
+
+class BaroSensor(Sensor):
+    def __init__(self, lsid: int):
+        super().__init__(lsid, DATA_STRUCTURE_TYPES['baro'], None)
+
+    def _observations(self, ts: int) -> dict:
+        bar_sea_level = self._walk("bar_sea_level", 30, 0.005, 28, 31.5)
+        return {
+            "bar_sea_level": round(bar_sea_level, 3),
+            "bar_trend": 0.0,
+            "bar_absolute": round(bar_sea_level - 0.1, 3)
+        }
+
+
+class IndoorSensor(Sensor):
+    def __init__(self, lsid: int):
+        super().__init__(lsid, DATA_STRUCTURE_TYPES['th'], None)
+
+    def _observations(self, ts: int) -> dict:
+        temp = self._walk("temp_in", 70, 0.1, 50, 90)
+        hum = self._walk("hum_in", 45, 0.2, 10, 90)
+        return {
+            "temp_in": round(temp, 1),
+            "hum_in": round(hum, 1),
+            "dew_point_in": round(temp - (100 - hum) / 2.8, 1),
+            "heat_index_in": round(temp, 1)
+        }
+
+
+def create_sensors(spec: str) -> List[Sensor]:
+    """Create sensors from a comma separated list like 'iss:1,leaf_soil:2,baro,th'"""
+
+    sensors = []
+    for lsid, entry in enumerate([entry.strip() for entry in spec.split(",") if entry.strip()], start=1):
+        name, _, txid = entry.partition(":")
+        if name == 'iss':
+            sensors.append(IssSensor(lsid, int(txid or 1)))
+        elif name == 'leaf_soil':
+            sensors.append(LeafSoilSensor(lsid, int(txid or 1)))
+        elif name == 'baro':
+            sensors.append(BaroSensor(lsid))
+        elif name == 'th':
+            sensors.append(IndoorSensor(lsid))
+        else:
+            raise ValueError("Unknown sensor type: %s (known: %s)" % (repr(name), ", ".join(DATA_STRUCTURE_TYPES)))
+    return sensors
+
+
+class Faults(object):
+    """Fault injection settings"""
+
+    def __init__(self, latency: float = 0, timeout_rate: float = 0, timeout_delay: float = 30,
+                 malformed_rate: float = 0, error_rate: float = 0, port_change_interval: int = 0):
+        self.latency = latency
+        self.timeout_rate = timeout_rate
+        self.timeout_delay = timeout_delay
+        self.malformed_rate = malformed_rate
+        self.error_rate = error_rate
+        self.port_change_interval = port_change_interval
+
+        self.random = random.Random()
+
+    def happens(self, rate: float) -> bool:
+        return rate > 0 and self.random.random() < rate
+
+
+class Stats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters: Dict[str, int] = dict()
+
+    def inc(self, name: str):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def snapshot(self) -> Dict[str, int]:
+        with self.lock:
+            return dict(self.counters)
+
+
+class Simulator(object):
+    """Simulated device: sensor state, broadcast state and fault injection"""
+
+    def __init__(self, did: str, sensors: List[Sensor], faults: Faults, source_address: str, broadcast_address: str,
+                 broadcast_port: int, rate: float):
+        self.did = did
+        self.sensors = sensors
+        self.faults = faults
+        self.source_address = source_address
+        self.broadcast_address = broadcast_address
+        self.base_broadcast_port = broadcast_port
+        self.broadcast_port = broadcast_port
+        self.rate = rate
+        self.stats = Stats()
+
+        self.lock = threading.Lock()
+        self.broadcast_until = 0.0
+        self.real_time_requests = 0
+
+        self.stop_signal = threading.Event()
+
+    def current_conditions(self) -> dict:
+        ts = int(time.time())
+        with self.lock:
+            conditions = [sensor.conditions(ts) for sensor in self.sensors]
+        return {"data": {"did": self.did, "ts": ts, "conditions": conditions}, "error": None}
+
+    def real_time(self, duration: int) -> dict:
+        with self.lock:
+            self.real_time_requests += 1
+            interval = self.faults.port_change_interval
+            if interval > 0 and self.real_time_requests % interval == 0:
+                offset = (self.real_time_requests // interval) % 2
+                self.broadcast_port = self.base_broadcast_port + offset
+                log.info("Changed broadcast port to %d" % self.broadcast_port)
+                self.stats.inc("port_changes")
+
+            self.broadcast_until = time.time() + duration
+            port = self.broadcast_port
+        return {"data": {"broadcast_port": port, "duration": duration}, "error": None}
+
+    def broadcast_packet(self) -> dict:
+        ts = int(time.time())
+        with self.lock:
+            conditions = [sensor.broadcast_conditions(ts) for sensor in self.sensors]
+        return {"did": self.did, "ts": ts, "conditions": [c for c in conditions if c is not None]}
+
+    def encode(self, payload: dict) -> bytes:
+        data = json.dumps(payload).encode("utf-8")
+        if self.faults.happens(self.faults.malformed_rate):
+            self.stats.inc("malformed")
+            return data[:len(data) // 2]
+        return data
+
+    def run_broadcasts(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        # The driver tells devices apart by the source address of their first broadcast
+        sock.bind((self.source_address, 0))
+
+        interval = 1 / self.rate
+        next_time = time.monotonic()
+        try:
+            while not self.stop_signal.is_set():
+                if time.time() < self.broadcast_until:
+                    data = self.encode(self.broadcast_packet())
+                    sock.sendto(data, (self.broadcast_address, self.broadcast_port))
+                    self.stats.inc("broadcasts")
+
+                # Keep the rate independent of the time needed to send
+                next_time += interval
+                delay = next_time - time.monotonic()
+                if delay < 0:
+                    next_time = time.monotonic()
+                    self.stats.inc("broadcasts_late")
+                    continue
+                self.stop_signal.wait(delay)
+        finally:
+            sock.close()
+
+
+def create_handler(simulator: Simulator):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            faults = simulator.faults
+            simulator.stats.inc("requests")
+
+            if faults.latency > 0:
+                time.sleep(faults.latency)
+
+            if faults.happens(faults.timeout_rate):
+                simulator.stats.inc("timeouts")
+                time.sleep(faults.timeout_delay)
+                self.close_connection = True
+                return
+
+            path, _, query = self.path.partition("?")
+            if path == "/v1/current_conditions":
+                payload = simulator.current_conditions()
+            elif path == "/v1/real_time":
+                params = dict(param.partition("=")[::2] for param in query.split("&") if param)
+                try:
+                    duration = int(params.get("duration", 1200))
+                except ValueError:
+                    self._send(400, {"data": None, "error": {"code": 400, "message": "Invalid duration"}})
+                    return
+                payload = simulator.real_time(duration)
+            else:
+                self._send(404, {"data": None, "error": {"code": 404, "message": "Not found"}})
+                return
+
+            if faults.happens(faults.error_rate):
+                simulator.stats.inc("errors")
+                payload = {"data": None, "error": {"code": 409, "message": "Simulated error"}}
+            self._send(200, payload)
+
+        def _send(self, status: int, payload: dict):
+            body = simulator.encode(payload)
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            log.debug("%s %s" % (self.address_string(), format % args))
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate a WeatherLink Live for load and soak testing")
+    parser.add_argument("--bind", default="0.0.0.0", help="Address of the HTTP server (default: 0.0.0.0)")
+    parser.add_argument("--http-port", type=int, default=80,
+                        help="Port of the HTTP server. The driver always connects to port 80 (default: 80)")
+    parser.add_argument("--broadcast-address", default="255.255.255.255",
+                        help="Address to send broadcasts to (default: 255.255.255.255)")
+    parser.add_argument("--broadcast-port", type=int, default=22222, help="Broadcast port (default: 22222)")
+    parser.add_argument("--rate", type=float, default=0.4,
+                        help="Broadcasts per second (default: 0.4, i.e. every 2.5 s like a real device)")
+    parser.add_argument("--did", default="001D0A7000FF", help="Device id (default: 001D0A7000FF)")
+    parser.add_argument("--sensors", default="iss:1,baro,th",
+                        help="Comma separated sensors: iss:TXID, leaf_soil:TXID, baro, th (default: iss:1,baro,th)")
+    parser.add_argument("--latency", type=float, default=0, help="Delay of each HTTP response in seconds")
+    parser.add_argument("--timeout-rate", type=float, default=0,
+                        help="Share of HTTP requests never answered (0..1)")
+    parser.add_argument("--timeout-delay", type=float, default=30,
+                        help="Time until an unanswered request is closed in seconds (default: 30)")
+    parser.add_argument("--malformed-rate", type=float, default=0,
+                        help="Share of responses and broadcasts with truncated JSON (0..1)")
+    parser.add_argument("--error-rate", type=float, default=0,
+                        help="Share of HTTP responses with an error object (0..1)")
+    parser.add_argument("--port-change-interval", type=int, default=0,
+                        help="Change the broadcast port every N broadcast requests (default: never)")
+    parser.add_argument("--stats-interval", type=float, default=60,
+                        help="Interval of logging counters in seconds (default: 60)")
+    parser.add_argument("--verbose", action="store_true", help="Log every request")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="%(asctime)s %(levelname)s %(message)s")
+
+    if args.rate <= 0:
+        parser.error("Rate must be greater than 0")
+
+    faults = Faults(args.latency, args.timeout_rate, args.timeout_delay, args.malformed_rate, args.error_rate,
+                    args.port_change_interval)
+    simulator = Simulator(args.did, create_sensors(args.sensors), faults, args.bind, args.broadcast_address,
+                          args.broadcast_port, args.rate)
+
+    server = ThreadingHTTPServer((args.bind, args.http_port), create_handler(simulator))
+    server.daemon_threads = True
+    threading.Thread(name="HTTP", target=server.serve_forever, daemon=True).start()
+    broadcast_thread = threading.Thread(name="Broadcast", target=simulator.run_broadcasts, daemon=True)
+    broadcast_thread.start()
+    log.info("Simulating device %s on %s:%d with sensors %s" % (args.did, args.bind, args.http_port, args.sensors))
+
+    start = time.time()
+    try:
+        while True:
+            time.sleep(args.stats_interval)
+            counters = simulator.stats.snapshot()
+            elapsed = time.time() - start
+            log.info("%s (%.1f broadcasts/s)" % (
+                ", ".join("%s: %d" % item for item in sorted(counters.items())),
+                counters.get("broadcasts", 0) / elapsed))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        simulator.stop_signal.set()
+        server.shutdown()
+        broadcast_thread.join()
+        log.info("Counters: %s" % simulator.stats.snapshot())
+
+
+if __name__ == '__main__':
+    main()
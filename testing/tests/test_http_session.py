@@ -0,0 +1,152 @@
+# Copyright © 2020-2021 Michael Schantl and contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Connection re-use of HttpSession, tested against a local stand-in HTTP server counting opened connections
+"""
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from user.weatherlink_live.davis_http import HttpSession
+
+RESPONSE = json.dumps({"data": {"did": "001D0A700002", "ts": 1646165700, "conditions": []}, "error": None})
+
+
+class CountingHTTPServer(ThreadingHTTPServer):
+    """HTTP server counting the connections opened by clients"""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.connections = 0
+        self.requests = 0
+        self.close_connections = False
+        self._lock = threading.Lock()
+
+    def get_request(self):
+        request = super().get_request()
+        with self._lock:
+            self.connections += 1
+        return request
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def url(self, path: str = "/v1/current_conditions") -> str:
+        return "http://127.0.0.1:%d%s" % (self.server_address[1], path)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.count_request()
+        body = RESPONSE.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if self.server.close_connections:
+            self.send_header("Connection", "close")
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = CountingHTTPServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def session():
+    session = HttpSession()
+    yield session
+    session.close()
+
+
+def test_keep_alive_reuses_connection(server, session):
+    for _ in range(10):
+        assert session.get(server.url(), timeout=5).json()["data"]["did"] == "001D0A700002"
+
+    assert server.requests == 10
+    assert server.connections == 1
+
+
+def test_without_keep_alive_opens_connection_per_request(server):
+    session = HttpSession(keep_alive=False)
+    try:
+        for _ in range(5):
+            session.get(server.url(), timeout=5)
+    finally:
+        session.close()
+
+    assert server.requests == 5
+    assert server.connections == 5
+
+
+def test_reset_opens_new_connection(server, session):
+    session.get(server.url(), timeout=5)
+    session.get(server.url(), timeout=5)
+    session.reset()
+    session.get(server.url(), timeout=5)
+
+    assert server.connections == 2
+
+
+def test_reconnects_when_server_closes_connection(server, session):
+    server.close_connections = True
+    for _ in range(3):
+        session.get(server.url(), timeout=5)
+
+    assert server.requests == 3
+    assert server.connections == 3
+
+
+def test_pool_size_limits_concurrent_connections(server):
+    session = HttpSession(pool_size=2)
+    try:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            for response in executor.map(lambda _: session.get(server.url(), timeout=5), range(20)):
+                assert response.status_code == 200
+    finally:
+        session.close()
+
+    assert server.requests == 20
+    assert 1 <= server.connections <= 2
+
+
+def test_invalid_pool_size():
+    with pytest.raises(ValueError):
+        HttpSession(pool_size=0)
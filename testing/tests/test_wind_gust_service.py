@@ -0,0 +1,81 @@
+# Copyright © 2020-2021 Michael Schantl and contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Max gusts written to LOOP packets by WllWindGustService
+"""
+import pytest
+
+import weewx
+from user.weatherlink_live.configuration import create_configuration
+from user.weatherlink_live.service import WllWindGustService
+
+DRIVER_NAME = "WeatherLinkLive"
+
+
+class ServiceEngine(object):
+    """Minimal engine binding the callbacks of services"""
+
+    def bind(self, event_type, callback):
+        pass
+
+
+def _create_service(gust_window: float) -> WllWindGustService:
+    configuration = create_configuration({DRIVER_NAME: {'host': "weatherlink", 'mapping': ["wind:1"]}}, DRIVER_NAME)
+    return WllWindGustService(ServiceEngine(), {}, configuration.create_mappers(), gust_window=gust_window)
+
+
+def _loop_packet(service: WllWindGustService, timestamp: int, speed: float) -> dict:
+    record = {'dateTime': timestamp, 'usUnits': weewx.US, 'windSpeed': speed, 'windDir': 180}
+    service.new_loop_packet(weewx.Event(weewx.NEW_LOOP_PACKET, packet=record))
+    return record
+
+
+@pytest.mark.parametrize("gust_window", [0, 600])
+def test_gust_written_when_changed(gust_window):
+    service = _create_service(gust_window)
+
+    assert _loop_packet(service, 0, 5.0)['windGust'] == 5.0
+    assert 'windGust' not in _loop_packet(service, 3, 2.0)
+    assert _loop_packet(service, 6, 7.0)['windGust'] == 7.0
+
+
+def test_gust_cleared_at_end_of_archive_period():
+    service = _create_service(0)
+
+    _loop_packet(service, 0, 5.0)
+    service.end_archive_period(weewx.Event(weewx.END_ARCHIVE_PERIOD))
+
+    assert _loop_packet(service, 300, 2.0)['windGust'] == 2.0
+
+
+def test_rolling_gust_carried_into_new_archive_period():
+    service = _create_service(600)
+
+    _loop_packet(service, 0, 5.0)
+    _loop_packet(service, 3, 2.0)
+    service.end_archive_period(weewx.Event(weewx.END_ARCHIVE_PERIOD))
+
+    # The max of the window didn't change, but the new archive period must contain it
+    record = _loop_packet(service, 300, 2.0)
+    assert record['windGust'] == 5.0
+    assert record['windGustDir'] == 180
+    assert 'windGust' not in _loop_packet(service, 303, 2.0)